@@ -0,0 +1,135 @@
+""" benchmark_adjustments.py: Fused color pipeline against the chain of PIL round trips.
+
+The chain converts QPixmap -> PIL -> QPixmap for every active slider, the way Gui.timerEvent
+used to apply Red, Green, Blue, Temperature, Saturation, Brightness and Contrast one after
+another. The fused pipeline applies all of them in one pass (see AdjustmentPipeline).
+
+    python benchmarks/benchmark_adjustments.py [--image images/xyz.jpg] [--width 6000] [--height 4000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+from PIL import Image, ImageEnhance
+from PIL.ImageQt import ImageQt
+from PyQt6.QtGui import QImage, QPixmap
+from PyQt6.QtWidgets import QApplication
+
+import AdjustTemperature
+from AdjustmentPipeline import ColorPipeline, _findClosest
+from QImageBuffer import imageToArray
+
+values = {
+    "Red": 120,
+    "Green": 100,
+    "Blue": 85,
+    "Temperature": 4500,
+    "Saturation": 130,
+    "Brightness": 110,
+    "Contrast": 120,
+}
+
+
+def QPixmapToImage(pixmap):
+    width = pixmap.width()
+    height = pixmap.height()
+    image = pixmap.toImage()
+
+    byteCount = image.bytesPerLine() * height
+    data = image.constBits().asstring(byteCount)
+    return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
+
+
+def ImageToQPixmap(image):
+    return QPixmap.fromImage(ImageQt(image))
+
+
+def scaleChannel(Pixmap, index, value):
+    channels = list(QPixmapToImage(Pixmap).split())
+    channels[index] = channels[index].point(lambda i: i * value)
+    return ImageToQPixmap(Image.merge('RGBA', channels))
+
+
+def enhance(Pixmap, Property, value):
+    return ImageToQPixmap(Property(QPixmapToImage(Pixmap)).enhance(float(value) / 100))
+
+
+def chain(Pixmap):
+    if values["Red"] != 100:
+        Pixmap = scaleChannel(Pixmap, 0, values["Red"] / 100)
+    if values["Green"] != 100:
+        Pixmap = scaleChannel(Pixmap, 1, values["Green"] / 100)
+    if values["Blue"] != 100:
+        Pixmap = scaleChannel(Pixmap, 2, values["Blue"] / 100)
+    if values["Temperature"] != 6000:
+        r, g, b, a = QPixmapToImage(Pixmap).split()
+        kelvin = _findClosest(list(AdjustTemperature.kelvin_table.keys()), values["Temperature"])
+        rgb = AdjustTemperature.convert_temp(Image.merge('RGB', (r, g, b)), kelvin)
+        Pixmap = ImageToQPixmap(Image.merge('RGBA', rgb.split() + (a,)))
+    if values["Saturation"] != 100:
+        Pixmap = enhance(Pixmap, ImageEnhance.Color, values["Saturation"])
+    if values["Brightness"] != 100:
+        Pixmap = enhance(Pixmap, ImageEnhance.Brightness, values["Brightness"])
+    if values["Contrast"] != 100:
+        Pixmap = enhance(Pixmap, ImageEnhance.Contrast, values["Contrast"])
+    return Pixmap
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=None, help="Image to resize to width x height, random noise if omitted")
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+
+    if args.image:
+        source = Image.open(args.image).convert("RGBA").resize((args.width, args.height))
+        image = ImageQt(source).copy()
+    else:
+        image = QImage(args.width, args.height, QImage.Format.Format_ARGB32)
+        imageToArray(image, writable=True)[...] = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 4), dtype=np.uint8)
+        imageToArray(image, writable=True)[..., 3] = 255
+    pixmap = QPixmap.fromImage(image)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        expected = chain(pixmap)
+    chainSeconds = (time.perf_counter() - start) / args.repeat
+
+    pipeline = ColorPipeline(pixmap.toImage())
+    pipeline.apply(values)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        result = QPixmap.fromImage(pipeline.apply(values))
+    fusedSeconds = (time.perf_counter() - start) / args.repeat
+
+    saturation = values["Saturation"]
+    values["Saturation"] = 100
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        QPixmap.fromImage(pipeline.apply(values))
+    tableSeconds = (time.perf_counter() - start) / args.repeat
+    values["Saturation"] = saturation
+
+    expected = expected.toImage().convertToFormat(QImage.Format.Format_ARGB32)
+    result = result.toImage().convertToFormat(QImage.Format.Format_ARGB32)
+    difference = np.abs(imageToArray(expected).astype(np.int16) - imageToArray(result).astype(np.int16))
+
+    print("Image                 : {}x{}".format(args.width, args.height))
+    print("Chain of PIL steps    : {:.0f} ms".format(1000 * chainSeconds))
+    print("Fused pipeline        : {:.0f} ms ({:.1f}x)".format(1000 * fusedSeconds, chainSeconds / fusedSeconds))
+    print("Fused, no saturation  : {:.0f} ms (lookup tables only)".format(1000 * tableSeconds))
+    print("Difference to chain   : max {}, mean {:.3f}, {:.2%} of values differ by more than 2".format(
+        difference.max(), difference.mean(), (difference > 2).mean()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+""" benchmark_flood_fill.py: Time and filled area of the Fill tool on a 24 MP image.
+
+The fill tool used to replace every pixel of the exact picked color anywhere in the image
+(see performFill before QFloodFill). QFloodFill fills the contiguous region around the click
+whose colors are within a tolerance. Both are run on synthetic scenes:
+
+    flat      : one color everywhere, the fill covers the whole image
+    sky       : a smooth vertical gradient with sensor noise above a noisy "ground" half
+    blobs     : 400 flat discs on a flat background, the click is on the background
+    spot      : a 200 px disc clicked in the middle of the sky scene, the fill stays small
+
+The old fill only matches exact colors, so on noisy scenes it recolors a scattering of pixels
+across the whole frame instead of the region.
+
+    python benchmarks/benchmark_flood_fill.py [--width 6000] [--height 4000] [--tolerance 32]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+
+from QFloodFill import floodFill
+
+
+def exactColorFill(pixels, x, y):
+    # The fill the tool used to do: every pixel of the color at (x, y), anywhere
+    words = pixels.view(np.uint32)[..., 0]
+    return words == words[y, x]
+
+
+def scenes(width, height):
+    rng = np.random.default_rng(0)
+
+    flat = np.empty((height, width, 4), dtype=np.uint8)
+    flat[...] = (200, 150, 100, 255)
+    yield "flat", flat, (width // 2, height // 2)
+
+    sky = np.empty((height, width, 4), dtype=np.uint8)
+    ramp = np.linspace(255, 180, height // 2)[:, np.newaxis]
+    noise = rng.normal(0, 3, (height // 2, width))
+    sky[:height // 2, :, 0] = np.clip(ramp + noise, 0, 255)
+    sky[:height // 2, :, 1] = np.clip(ramp * 0.8 + noise, 0, 255)
+    sky[:height // 2, :, 2] = np.clip(ramp * 0.5 + noise, 0, 255)
+    sky[height // 2:, :, :3] = rng.integers(0, 120, (height - height // 2, width, 3))
+    sky[..., 3] = 255
+    yield "sky", sky, (width // 2, height // 4)
+
+    blobs = flat.copy()
+    yy, xx = np.ogrid[:height, :width]
+    for cx, cy in zip(rng.integers(0, width, 400), rng.integers(0, height, 400)):
+        disc = (xx - cx) ** 2 + (yy - cy) ** 2 < 60 ** 2
+        blobs[disc] = (30, 60, 90, 255)
+    yield "blobs", blobs, (0, 0)
+
+    spot = sky.copy()
+    cx, cy = width // 2, height // 4
+    disc = (xx - cx) ** 2 + (yy - cy) ** 2 < 100 ** 2
+    spot[disc] = (20, 20, 200, 255)
+    yield "spot", spot, (cx, cy)
+
+
+def timed(function, repeat):
+    result = function()
+    start = time.perf_counter()
+    for _ in range(repeat - 1):
+        function()
+    return result, (time.perf_counter() - start) / max(repeat - 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--tolerance", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("Image: {}x{}, tolerance {}".format(args.width, args.height, args.tolerance))
+    print("{:<8}{:>24}{:>26}{:>26}".format("Scene", "Exact color (old)", "Scanline, 4-connected", "Scanline, 8-connected"))
+    for name, pixels, (x, y) in scenes(args.width, args.height):
+        mask, seconds = timed(lambda: exactColorFill(pixels, x, y), args.repeat)
+        cells = ["{:8.1f} ms {:6.2f} MP".format(1000 * seconds, mask.sum() / 1e6)]
+        for connectivity in (4, 8):
+            (rect, mask), seconds = timed(lambda: floodFill(pixels, x, y, args.tolerance, connectivity), args.repeat)
+            cells.append("{:8.1f} ms {:6.2f} MP".format(1000 * seconds, mask.sum() / 1e6))
+        print("{:<8}{:>24}{:>26}{:>26}".format(name, *cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+""" benchmark_qimage_bridge.py: Bytes copied per conversion, per-class helpers against QImageBuffer.
+
+The per-class helpers went through bytes objects: QPixmapToImage copied the pixels out of the
+QImage with asstring and decoded them again into a PIL image, ImageToQPixmap went through
+ImageQt, and QImageToCvMat always converted to RGBA8888. QImageBuffer exposes QImage buffers as
+NumPy views and wraps arrays as QImages without copying (see src/QImageBuffer.py).
+
+Bytes copied are measured as the growth of the peak resident memory of the process during one
+conversion (Linux only, /proc/self/clear_refs). Large buffers are always mmapped for this, so
+every copied byte lands on a freshly touched page, including the bytes of a result that does
+not share the memory of its source.
+
+    python benchmarks/benchmark_qimage_bridge.py [--width 6000] [--height 4000]
+"""
+
+import argparse
+import ctypes
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+from PIL import Image
+from PIL.ImageQt import ImageQt
+from PyQt6.QtGui import QImage, QPixmap
+from PyQt6.QtWidgets import QApplication
+
+from QImageBuffer import imageToArray, arrayToImage, QPixmapToImage, ImageToQPixmap
+
+
+def oldQPixmapToImage(pixmap):
+    width = pixmap.width()
+    height = pixmap.height()
+    image = pixmap.toImage()
+
+    byteCount = image.bytesPerLine() * height
+    data = image.constBits().asstring(byteCount)
+    return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
+
+
+def oldImageToQPixmap(image):
+    return QPixmap.fromImage(ImageQt(image))
+
+
+def oldQImageToCvMat(incomingImage):
+    incomingImage = incomingImage.convertToFormat(QImage.Format.Format_RGBA8888)
+
+    width = incomingImage.width()
+    height = incomingImage.height()
+
+    ptr = incomingImage.bits()
+    ptr.setsize(height * width * 4)
+    arr = np.frombuffer(ptr, np.uint8).reshape((height, width, 4))
+    return arr
+
+
+def oldArrayToQImage(array):
+    # The way tools turned NumPy results into images: through PIL and ImageQt
+    return ImageQt(Image.fromarray(array))
+
+
+def _status(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+def measure(convert, source, repeat):
+    """ Returns (bytes copied, seconds) of one conversion of source.
+    """
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as clear:
+        clear.write("5")
+    before = _status("VmRSS")
+    result = convert(source)
+    copied = _status("VmHWM") - before
+    del result
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        convert(source)
+    return copied, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Serve every allocation above 128 KB with its own mapping, see the module docstring
+    M_MMAP_THRESHOLD = -3
+    ctypes.CDLL(None).mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+
+    app = QApplication(sys.argv)
+
+    array = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 4), dtype=np.uint8)
+    array[..., 3] = 255
+    qimage = QImage(args.width, args.height, QImage.Format.Format_ARGB32)
+    imageToArray(qimage, writable=True)[...] = array
+    pixmap = QPixmap.fromImage(qimage)
+    pil = Image.fromarray(array)
+    frameBytes = array.nbytes
+
+    conversions = (
+        ("QPixmap -> PIL", pixmap, oldQPixmapToImage, QPixmapToImage),
+        ("PIL -> QPixmap", pil, oldImageToQPixmap, ImageToQPixmap),
+        ("QImage -> ndarray", qimage, oldQImageToCvMat, imageToArray),
+        ("ndarray -> QImage", array, oldArrayToQImage, arrayToImage),
+    )
+
+    print("Image: {}x{}, {:.1f} MB per frame".format(args.width, args.height, frameBytes / 2 ** 20))
+    print("{:<20}{:>24}{:>24}".format("Conversion", "Helpers", "QImageBuffer"))
+    for name, source, old, new in conversions:
+        cells = []
+        for convert in (old, new):
+            copied, seconds = measure(convert, source, args.repeat)
+            cells.append("{:5.2f} frames {:6.1f} ms".format(max(copied, 0) / frameBytes, 1000 * seconds))
+        print("{:<20}{:>24}{:>24}".format(name, *cells))
+
+    # Zero-copy views really share the memory of their source
+    view = imageToArray(qimage)
+    wrapped = arrayToImage(array)
+    print("imageToArray shares the QImage buffer : {}".format(view.ctypes.data == int(qimage.constBits())))
+    print("arrayToImage shares the array buffer  : {}".format(int(wrapped.constBits()) == array.ctypes.data))
+
+
+if __name__ == "__main__":
+    main()
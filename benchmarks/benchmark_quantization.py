@@ -0,0 +1,127 @@
+""" benchmark_quantization.py: Accuracy and CPU latency of the int8 variants of the AI models.
+
+For BSRGAN (RRDBNet), U^2-Net and the AnimeGANv2 generator, quantizes the model the way the
+tools do with PHOTOLAB_INT8=1 (see ModelQuantization), calibrated on all but the last of the
+tool's bundled sample images. It then runs the float32 model and the int8 variant on every
+sample image and prints how close the outputs are, PSNR for images and IoU of the mask for
+U^2-Net, the mean and the worst over the images, and the median time of a forward pass on the
+last image, which calibration did not see.
+
+The weights are read from models/ (see download_models.py). A model whose weights are missing
+runs with random weights, marked "random" in the table: its latency is representative, its
+accuracy is not.
+
+    python benchmarks/benchmark_quantization.py [--models RRDBNet U2NET AnimeGANv2] [--runs 5] [--threads 0]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "src"))
+
+import torch
+
+import ModelQuantization
+from AnimeGANv2Model import Generator as AnimeGanV2Generator
+from BackgroundRemovalDetect import norm_pred
+from BackgroundRemovalU2net import U2NET
+from QualityScaler import RRDBNet
+
+
+def u2netInputs(samples):
+    # Normalized as BackgroundRemovalDetect.preprocess does
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    return [(sample / sample.max() - mean) / std for sample in samples]
+
+
+# The models of the tools: how to build them, their weights, sample images, input size and
+# normalization, how to compare outputs, and the arguments after the input
+models = {
+    "RRDBNet": {
+        "build": lambda: RRDBNet(in_nc=3, out_nc=3, nf=64, nb=23, gc=32, sf=4),
+        "weights": "models/BSRGANx4.pth",
+        "images": "images/WhiteBalance*.jpg",
+        "size": (128, 128),
+        "inputs": lambda samples: samples,
+        "metric": ("PSNR", ModelQuantization.psnr),
+        "arguments": (),
+    },
+    "U2NET": {
+        "build": lambda: U2NET(3, 1),
+        "weights": "models/u2net.pth",
+        "images": "images/BackgroundRemoval*.jpg",
+        "size": (320, 320),
+        "inputs": u2netInputs,
+        "metric": ("IoU", lambda reference, output: ModelQuantization.maskIoU(norm_pred(reference[0]), norm_pred(output[0]))),
+        "arguments": (),
+    },
+    "AnimeGANv2": {
+        "build": AnimeGanV2Generator,
+        "weights": "models/face_paint_512_v2.pt",
+        "images": "images/AnimeGanV2*.jpg",
+        "size": (512, 512),
+        "inputs": lambda samples: [sample * 2 - 1 for sample in samples],
+        "metric": ("PSNR", lambda reference, output: ModelQuantization.psnr(reference + 1, output + 1, peak=2.0)),
+        "arguments": (False,),
+    },
+}
+
+
+def medianSeconds(model, input, arguments, runs):
+    with torch.no_grad():
+        # Warm up
+        model(input, *arguments)
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(input, *arguments)
+            seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", choices=list(models), default=list(models))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads, 0 keeps the torch default")
+    args = parser.parse_args()
+
+    os.chdir(root)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    print("CPU, {} threads".format(torch.get_num_threads()))
+    print("{:<12}{:>9}{:>11}{:>9}{:>11}{:>11}{:>9}{:>8}{:>9}{:>9}".format(
+        "Model", "Weights", "Input", "Images", "fp32 ms", "int8 ms", "Speedup", "Metric", "Mean", "Worst"))
+
+    for name in args.models:
+        spec = models[name]
+        model = spec["build"]()
+        weights = "random"
+        if os.path.exists(spec["weights"]):
+            model.load_state_dict(torch.load(spec["weights"], map_location="cpu"))
+            weights = "loaded"
+        model.eval()
+
+        inputs = spec["inputs"](ModelQuantization.sampleImages(spec["images"], spec["size"]))
+        arguments = spec["arguments"]
+        quantized = ModelQuantization.quantize(model, inputs[:-1], arguments)
+
+        metricName, metric = spec["metric"]
+        with torch.no_grad():
+            values = [metric(model(input, *arguments), quantized(input)) for input in inputs]
+
+        fp32 = medianSeconds(model, inputs[-1], arguments, args.runs)
+        int8 = medianSeconds(quantized, inputs[-1], arguments, args.runs)
+        print("{:<12}{:>9}{:>11}{:>9}{:>11.1f}{:>11.1f}{:>9.2f}{:>8}{:>9.3f}{:>9.3f}".format(
+            name, weights, "{}x{}".format(*spec["size"]), len(inputs), fp32 * 1000, int8 * 1000, fp32 / int8,
+            metricName, statistics.mean(values), min(values)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+""" benchmark_setimage.py: Frame allocations and time per edit in QtImageViewer.setImage.
+
+Runs a series of small edits on a 24 MP image, with a layer list attached as in the app, and
+checks that the edited image, the displayed image and the latest history entry share one pixel
+buffer and that no full-size pixmap of the layer is made for the layer list icon. For
+comparison, the copies the viewer used to make per edit (one for the history, one for the
+checkerboard composite) are timed on the same image.
+
+    python benchmarks/benchmark_setimage.py [--width 6000] [--height 4000] [--edits 20]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from PyQt6.QtCore import QPoint
+from PyQt6.QtGui import QImage, QPixmap, QPainter, QColor
+from PyQt6.QtWidgets import QApplication, QMainWindow
+
+from QImageViewer import QtImageViewer
+from QLayerList import QLayerList
+
+
+class Window(QMainWindow):
+    # The parts of the main window the layer list uses
+
+    def __init__(self):
+        super().__init__()
+        self.image_viewer = QtImageViewer(self)
+
+    def getCurrentLayerLatestPixmap(self):
+        return self.image_viewer.getCurrentLayerLatestPixmap()
+
+    def setIconPixmapWithColor(self, button, filename):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--edits", type=int, default=20)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    window = Window()
+    viewer = window.image_viewer
+
+    image = QImage(args.width, args.height, QImage.Format.Format_ARGB32_Premultiplied)
+    image.fill(QColor(120, 80, 40))
+    viewer.setImage(image, True, "Open")
+    viewer.layerListDock = QLayerList("Layers", window)
+    frameBytes = image.sizeInBytes()
+
+    setImageSeconds = 0.0
+    sharedEdits = 0
+    pixmapEdits = 0
+    for i in range(args.edits):
+        # The edit itself: the one frame allocation per edit
+        edited = viewer.getCurrentLayerLatestImage().copy()
+        painter = QPainter(edited)
+        painter.fillRect(50 * i, 50 * i, 200, 200, QColor(255, 0, 0))
+        painter.end()
+
+        start = time.perf_counter()
+        viewer.setImage(edited, True, "Paint", "Tool")
+        setImageSeconds += time.perf_counter() - start
+
+        history = viewer.layerHistory[viewer.currentLayer]
+        if int(edited.constBits()) == int(viewer.image().constBits()) == int(history.image(-1).constBits()):
+            sharedEdits += 1
+        if history._headPixmap is not None:
+            pixmapEdits += 1
+
+    # What setImage used to do with every edit
+    legacySeconds = 0.0
+    checkerBoard = QPixmap(args.width, args.height)
+    for i in range(args.edits):
+        pixmap = viewer.getCurrentLayerLatestPixmap()
+        start = time.perf_counter()
+        historyCopy = pixmap.copy()
+        historyCopy.toImage().convertToFormat(QImage.Format.Format_ARGB32)
+        original = pixmap.copy()
+        displayed = pixmap.copy()
+        painter = QPainter(displayed)
+        painter.drawPixmap(QPoint(), checkerBoard)
+        painter.drawPixmap(QPoint(), original)
+        painter.end()
+        legacySeconds += time.perf_counter() - start
+
+    pool = viewer.historyPool
+    print("Image                 : {}x{} ({:.1f} MB per frame)".format(args.width, args.height, frameBytes / (1024 * 1024)))
+    print("Edits sharing a buffer: {}/{}".format(sharedEdits, args.edits))
+    print("Full-size pixmaps made: {}/{} edits".format(pixmapEdits, args.edits))
+    print("setImage              : {:.1f} ms per edit".format(1000 * setImageSeconds / args.edits))
+    print("Legacy copies         : {:.1f} ms per edit, 3 frames allocated".format(1000 * legacySeconds / args.edits))
+    print(pool.report() + " for {} edits".format(args.edits + 1))
+
+
+if __name__ == "__main__":
+    main()
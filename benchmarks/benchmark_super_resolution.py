@@ -0,0 +1,95 @@
+""" benchmark_super_resolution.py: Tiles per second of BSRGAN upscaling, one tile at a time or batched.
+
+The per-tile loop is the way QualityScaler.upscale_image used to run the model: one tile per
+forward pass, a new input tensor for every tile and torch.cuda.empty_cache() after each one.
+The batched runs stack equally sized tiles into one forward pass (see BatchUpscaler) with the
+input and output tensors reused across batches, one stage after the other. The pipelined runs
+also normalize the next batch and denormalize the previous one while the model runs, the way
+upscale_array does. "auto" is the batch size picked from the free memory of the device.
+
+The model is RRDBNet with random weights, so no model file is needed. --blocks lowers the
+number of RRDB blocks (23 in BSRGAN) for a quicker run; the ratio between the rows does not
+depend much on it.
+
+    python benchmarks/benchmark_super_resolution.py [--width 1024] [--height 768] [--tile 128] [--blocks 23] [--device cpu]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+import torch
+
+import QualityScaler
+from QualityScalerUtilities import tile_boxes, upscale_tiled
+
+
+def perTileUpscaler(model, device):
+    # The loop upscale_image used to run, for a batch of one tile
+    def upscale(tiles):
+        tile_adapted = QualityScaler.adapt_image_for_deeplearning(tiles[0], device)
+        tile_upscaled = QualityScaler.tensor_to_uint(model(tile_adapted))
+        del tile_adapted
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return tile_upscaled[np.newaxis]
+    return upscale
+
+
+def timed(image, upscale, scale, tile, batchSize, prepare=None, finish=None):
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = upscale_tiled(image, upscale, scale, tile, QualityScaler.tiles_overlap, "cosine", None, batchSize,
+                               prepare, finish)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--tile", type=int, default=128)
+    parser.add_argument("--blocks", type=int, default=23)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = QualityScaler.RRDBNet(in_nc=3, out_nc=3, nf=64, nb=args.blocks, gc=32, sf=4).eval()
+    model = model.to(QualityScaler.torch_backend(args.device))
+    image = np.random.default_rng(0).integers(0, 256, (args.height, args.width, 3)).astype(np.uint8)
+
+    rows = tile_boxes(args.height, args.tile, QualityScaler.tiles_overlap)
+    columns = tile_boxes(args.width, args.tile, QualityScaler.tiles_overlap)
+    count = len(rows) * len(columns)
+    auto = QualityScaler.batch_size_for_memory(args.device, model.sf, rows[0][1] - rows[0][0], columns[0][1] - columns[0][0])
+
+    print("Image: {}x{}, {} tiles of {}x{}, {} RRDB blocks, {}, {} threads".format(
+        args.width, args.height, count, columns[0][1] - columns[0][0], rows[0][1] - rows[0][0],
+        args.blocks, args.device, torch.get_num_threads()))
+    print("{:<24}{:>12}{:>12}{:>14}".format("Run", "Batch", "Seconds", "Tiles/s"))
+
+    # Warm up the allocator and the kernels
+    timed(image[:rows[0][1], :columns[0][1]], perTileUpscaler(model, args.device), model.sf, args.tile, 1)
+
+    reference, seconds = timed(image, perTileUpscaler(model, args.device), model.sf, args.tile, 1)
+    print("{:<24}{:>12}{:>12.2f}{:>14.2f}".format("Per tile (old)", 1, seconds, count / seconds))
+
+    for pipelined in (False, True):
+        for batchSize in sorted({1, 2, 4, 8, auto}):
+            upscaler = QualityScaler.BatchUpscaler(model, args.device)
+            if pipelined:
+                output, seconds = timed(image, upscaler.infer, model.sf, args.tile, batchSize, upscaler.prepare, upscaler.finish)
+            else:
+                output, seconds = timed(image, upscaler, model.sf, args.tile, batchSize)
+            name = ("Pipelined" if pipelined else "Batched") + (" (auto)" if batchSize == auto else "")
+            difference = np.abs(output.astype(np.int16) - reference).max()
+            print("{:<24}{:>12}{:>12.2f}{:>14.2f}   max difference {}".format(name, batchSize, seconds, count / seconds, difference))
+
+
+if __name__ == "__main__":
+    main()
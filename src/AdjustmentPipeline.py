@@ -0,0 +1,133 @@
+""" AdjustmentPipeline.py: Fused color pipeline for the Adjustment Sliders.
+
+The Red/Green/Blue gains and the temperature scale single channels, so they are folded into
+one 256-entry lookup table per channel. Saturation, brightness and contrast are linear in RGB
+and are composed into one 3x3 matrix plus an offset. Both are applied to the image in a single
+vectorized pass over bands of rows. If saturation is unchanged the matrix is diagonal and the
+whole pipeline collapses into three uint8 lookup tables.
+
+Sharpness and blur look at neighbouring pixels and stay separate steps, see AdjustmentStack.
+"""
+
+import numpy as np
+from PyQt6.QtGui import QImage
+
+import AdjustTemperature
+from QImageBuffer import imageToArray
+
+# Names of the adjustments handled here, in the order they used to be applied one by one
+colorAdjustments = ("Red", "Green", "Blue", "Temperature", "Saturation", "Brightness", "Contrast")
+
+# ITU-R 601-2 luma transform, as used by PIL for the grayscale image of ImageEnhance
+_luma = np.array([299, 587, 114], dtype=np.float64) / 1000
+
+# Position of R, G, B in the bytes of a Format_ARGB32 pixel
+_channels = (2, 1, 0)
+
+
+class ColorPipeline:
+    """ Applies the color adjustments to one source image.
+
+    Keep the pipeline around while only the parameters change: the source is converted once
+    and its channel histograms, needed for contrast, are computed once.
+    """
+
+    # Rows processed at once, so that the float temporaries stay small
+    bandRows = 64
+
+    def __init__(self, image):
+        self.source = image.convertToFormat(QImage.Format.Format_ARGB32)
+        self._means = None
+
+    def apply(self, values, cancelled=None):
+        """ Returns a new Format_ARGB32 QImage with the adjustments in values applied.
+        values maps the names in colorAdjustments to slider values. If cancelled is given,
+        it is polled between bands of rows and None is returned once it is true.
+        """
+        tables = self.lookupTables(values)
+        matrix, offset = self.matrix(values, tables)
+
+        output = QImage(self.source.size(), QImage.Format.Format_ARGB32)
+        source = imageToArray(self.source)
+        target = imageToArray(output, writable=True)
+        target[..., 3] = source[..., 3]
+
+        # The matrix is diag(scale) plus the same row of weights for every channel, so
+        # out_c = scale * table_c[x_c] + offset_c + sum_k weights_k * table_k[x_k]
+        weights = matrix[(1, 2, 0), (0, 1, 2)]
+        scale = np.diag(matrix) - weights
+
+        if not weights.any():
+            # No channel mixing: one uint8 table per channel does everything
+            for c, channel in enumerate(_channels):
+                table = np.rint(np.clip(tables[c] * scale[c] + offset[c], 0, 255)).astype(np.uint8)
+                np.take(table, source[..., channel], out=target[..., channel])
+            return output
+
+        own = [(tables[c] * scale[c] + offset[c] + 0.5).astype(np.float32) for c in range(3)]
+        mixed = [(tables[c] * weights[c]).astype(np.float32) for c in range(3)]
+        for top in range(0, source.shape[0], self.bandRows):
+            if cancelled is not None and cancelled():
+                return None
+            band = source[top:top + self.bandRows]
+            shared = mixed[0][band[..., 2]]
+            shared += mixed[1][band[..., 1]]
+            shared += mixed[2][band[..., 0]]
+            for c, channel in enumerate(_channels):
+                value = own[c][band[..., channel]]
+                value += shared
+                np.clip(value, 0, 255, out=value)
+                target[top:top + self.bandRows, :, channel] = value
+        return output
+
+    def lookupTables(self, values):
+        """ Returns the per-channel float tables of the gains and the temperature.
+        """
+        x = np.arange(256, dtype=np.float64)
+        temperature = None
+        if values["Temperature"] != 6000:
+            kelvin = _findClosest(list(AdjustTemperature.kelvin_table.keys()), values["Temperature"])
+            temperature = np.array(AdjustTemperature.kelvin_table[kelvin], dtype=np.float64) / 255
+
+        tables = []
+        for c, name in enumerate(("Red", "Green", "Blue")):
+            table = x
+            if values[name] != 100:
+                table = np.minimum(np.rint(table * (values[name] / 100)), 255)
+            if temperature is not None:
+                table = np.rint(table * temperature[c])
+            tables.append(table)
+        return tables
+
+    def matrix(self, values, tables):
+        """ Returns the 3x3 matrix and offset of saturation, brightness and contrast.
+        Every row of the matrix is the same row of luma weights plus a value on the diagonal.
+        """
+        saturation = values["Saturation"] / 100
+        brightness = values["Brightness"] / 100
+        contrast = values["Contrast"] / 100
+
+        # Saturation blends with the grayscale image, brightness with black
+        matrix = saturation * np.eye(3) + (1 - saturation) * np.outer(np.ones(3), _luma)
+        matrix = brightness * matrix
+
+        # Contrast blends with the mean gray level of the image it is applied to
+        offset = np.zeros(3)
+        if contrast != 1:
+            means = np.array([np.dot(self._histogramMeans()[c], tables[c]) for c in range(3)])
+            mean = int(np.dot(_luma, matrix @ means) + 0.5)
+            offset[:] = (1 - contrast) * mean
+            matrix = contrast * matrix
+        return matrix, offset
+
+    def _histogramMeans(self):
+        # Normalized histogram of every channel, the mean after a table is dot(histogram, table)
+        if self._means is None:
+            source = imageToArray(self.source)
+            count = source.shape[0] * source.shape[1]
+            self._means = [np.bincount(source[..., channel].ravel(), minlength=256) / count for channel in _channels]
+        return self._means
+
+
+def _findClosest(lst, K):
+    return lst[min(range(len(lst)), key = lambda i: abs(lst[i]-K))]
@@ -0,0 +1,169 @@
+""" AdjustmentStack.py: Non-destructive stack of the Adjustment Sliders of a layer.
+
+The slider parameters of a layer are applied to the layer as it was before the first slider
+change instead of to the latest adjusted pixmap. Only the parameters are stored in the layer
+history ("Slider" entries without pixels), so undoing a slider is a parameter change.
+
+The color adjustments run as one fused pass (see AdjustmentPipeline), sharpness and blur as
+separate spatial steps. The result of every stage is cached together with the source key and
+the parameters it was rendered with. Changing a parameter re-renders its stage and the ones
+after it; the stages before it are reused.
+
+renderImage only works on QImages and never modifies a cached result, so it can run on a
+worker thread while the GUI thread keeps changing the parameters. The caches are looked up and
+replaced under a lock, the stages are rendered outside of it. Results are only stored for the
+parameters they were rendered with.
+"""
+
+import threading
+
+from PIL import ImageEnhance, ImageFilter
+from PyQt6.QtGui import QPixmap
+
+from AdjustmentPipeline import ColorPipeline, colorAdjustments
+from QImageBuffer import QImageToImage, ImageToQImage
+
+
+class AdjustmentStack:
+
+    # (name, slider, Gui attribute, default value) in the order the adjustments are applied
+    steps = (
+        ("Red", "RedColorSlider", "RedFactor", 100),
+        ("Green", "GreenColorSlider", "GreenFactor", 100),
+        ("Blue", "BlueColorSlider", "BlueFactor", 100),
+        ("Temperature", "TemperatureSlider", "Temperature", 6000),
+        ("Saturation", "ColorSlider", "Color", 100),
+        ("Brightness", "BrightnessSlider", "Brightness", 100),
+        ("Contrast", "ContrastSlider", "Contrast", 100),
+        ("Sharpness", "SharpnessSlider", "Sharpness", 100),
+        ("Gaussian Blur", "GaussianBlurSlider", "GaussianBlurRadius", 0),
+    )
+
+    # Names of the steps rendered together, in order
+    stages = (colorAdjustments, ("Sharpness",), ("Gaussian Blur",))
+
+    def __init__(self):
+        self.values = AdjustmentStack.defaults()
+
+        # Guards _pipeline, _results and _rendered, which worker threads read and replace
+        self._lock = threading.Lock()
+
+        # (key, ColorPipeline) of the source image
+        self._pipeline = None
+
+        # (signature, QImage) of every stage, see _signature
+        self._results = [None] * len(AdjustmentStack.stages)
+
+        # (signature, QPixmap) of the last render
+        self._pixmap = None
+
+        # (key, QImage) of the layer as last rendered with all its adjustments, see setRendered
+        self._rendered = None
+
+    @staticmethod
+    def defaults():
+        return {name: default for name, _, _, default in AdjustmentStack.steps}
+
+    def isIdentity(self):
+        return self.values == AdjustmentStack.defaults()
+
+    def setValues(self, values):
+        """ Update the parameters. Returns (name, slider, value) for every parameter that changed.
+        """
+        changed = []
+        for name, slider, _, _ in AdjustmentStack.steps:
+            if name in values and values[name] != self.values[name]:
+                self.values[name] = values[name]
+                changed.append((name, slider, values[name]))
+        return changed
+
+    def reset(self):
+        """ Set all parameters back to their defaults and drop the cached renders.
+        """
+        self.values = AdjustmentStack.defaults()
+        with self._lock:
+            self._pipeline = None
+            self._results = [None] * len(AdjustmentStack.stages)
+            self._rendered = None
+        self._pixmap = None
+
+    def setRendered(self, key, image):
+        """ Keep image as the layer rendered with its adjustments, key identifying the layer
+        image, the parameters and anything else it was rendered with. Rendering on a worker
+        thread stores its result here, so that the layer is not rendered again to show or bake it.
+        """
+        with self._lock:
+            self._rendered = (key, image)
+
+    def rendered(self, key):
+        """ Returns the image kept by setRendered for key, or None.
+        """
+        with self._lock:
+            rendered = self._rendered
+        if rendered is None or rendered[0] != key:
+            return None
+        return rendered[1]
+
+    def render(self, key, source):
+        """ Returns the adjusted image as a QPixmap, see renderImage.
+        """
+        signature = _signature(key, self.values, len(AdjustmentStack.stages) - 1)
+        if self._pixmap is None or self._pixmap[0] != signature:
+            self._pixmap = (signature, QPixmap.fromImage(self.renderImage(key, source)))
+        return self._pixmap[1]
+
+    def renderImage(self, key, source, values=None, cancelled=None):
+        """ Returns the adjusted image as a QImage, or None if cancelled() became true.
+
+        source is a callable returning the QImage to adjust. It is only called if key differs
+        from the key of the previous call, otherwise the cached results are reused.
+        values defaults to the current parameters.
+        """
+        values = dict(values if values is not None else self.values)
+
+        with self._lock:
+            pipeline = self._pipeline
+            if pipeline is None or pipeline[0] != key:
+                pipeline = (key, ColorPipeline(source()))
+                self._pipeline = pipeline
+
+        defaults = AdjustmentStack.defaults()
+        image = pipeline[1].source
+        for i, stage in enumerate(AdjustmentStack.stages):
+            if cancelled is not None and cancelled():
+                return None
+            signature = _signature(key, values, i)
+            with self._lock:
+                result = self._results[i]
+            if result is None or result[0] != signature:
+                if all(values[name] == defaults[name] for name in stage):
+                    result = (signature, image)
+                elif stage is colorAdjustments:
+                    adjusted = pipeline[1].apply(values, cancelled)
+                    if adjusted is None:
+                        return None
+                    result = (signature, adjusted)
+                else:
+                    result = (signature, _applySpatial(stage[0], image, values[stage[0]]))
+                with self._lock:
+                    self._results[i] = result
+            image = result[1]
+        return image
+
+
+def _signature(key, values, stage):
+    # Everything the result of a stage depends on
+    return (key,) + tuple(values[name] for s in AdjustmentStack.stages[:stage + 1] for name in s)
+
+
+def _applySpatial(name, image, value):
+    """ Apply sharpness or blur to a QImage with PIL. Returns a QImage.
+    """
+    image = QImageToImage(image)
+    if name == "Sharpness":
+        image = ImageEnhance.Sharpness(image).enhance(float(value) / 100)
+    elif name == "Gaussian Blur":
+        image = image.filter(ImageFilter.GaussianBlur(radius=float(value / 100)))
+    else:
+        raise ValueError("AdjustmentStack: Unknown adjustment " + name)
+    return ImageToQImage(image)
@@ -7,32 +7,51 @@ from PIL import Image
 from torchvision import transforms
 
 import BackgroundRemovalDataLoader, BackgroundRemovalU2net
+import ModelQuantization
+from ModelCache import modelCache
 
 U2NET_MODEL_LOCATION = "models"
 
 def load_model(model_name: str = "u2net"):
-    net = BackgroundRemovalU2net.U2NET(3, 1)
     path = os.path.join(U2NET_MODEL_LOCATION, model_name + ".pth")
-
-    try:
-        if torch.cuda.is_available():
-            net.load_state_dict(torch.load(path))
-            net.to(torch.device("cuda"))
-        else:
-            net.load_state_dict(
-                torch.load(
-                    path,
-                    map_location="cpu",
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    def load():
+        net = BackgroundRemovalU2net.U2NET(3, 1)
+        try:
+            if torch.cuda.is_available():
+                net.load_state_dict(torch.load(path))
+                net.to(torch.device("cuda"))
+            else:
+                net.load_state_dict(
+                    torch.load(
+                        path,
+                        map_location="cpu",
+                    )
                 )
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), model_name + ".pth"
             )
-    except FileNotFoundError:
-        raise FileNotFoundError(
-            errno.ENOENT, os.strerror(errno.ENOENT), model_name + ".pth"
-        )
 
-    net.eval()
+        net.eval()
+
+        return net
+
+    if ModelQuantization.useQuantized(device):
+        def samples():
+            # Normalized as in preprocess, see BackgroundRemovalDataLoader.ToTensorLab
+            mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+            std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+            return [(sample / sample.max() - mean) / std
+                    for sample in ModelQuantization.sampleImages(os.path.join("images", "BackgroundRemoval*.jpg"), (320, 320))]
+
+        def metric(reference, output):
+            return ModelQuantization.maskIoU(norm_pred(reference[0]), norm_pred(output[0]))
+
+        return ModelQuantization.quantizedModel("U2NET", path, load, samples, metric, ModelQuantization.minimumIoU)
 
-    return net
+    return modelCache.get("U2NET", path, device, load)
 
 
 def norm_pred(d):
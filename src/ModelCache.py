@@ -0,0 +1,148 @@
+""" ModelCache.py: Process-wide cache of loaded AI models, least recently used first out.
+
+Every AI tool used to build its network and read its weights from disk on each run, several
+seconds for the larger ones (MiDaS DPT-Large, U^2-Net, BSRGAN). The tools now ask modelCache
+for a model by (architecture, weights path, device, dtype) and pass a function that loads it
+on a miss. Loaded models stay warm while the parameters and buffers of all of them fit in
+budgetBytes; past that the least recently used ones are dropped. The first model is always
+kept, whatever its size.
+
+Tools run on worker threads, so the cache is locked. Two tools asking for the same model at
+once load it only once. Hits, misses and the time spent loading are kept per model and in
+total, see stats.
+"""
+
+import collections
+import os
+import threading
+from timeit import default_timer as timer
+
+
+class ModelCache:
+
+    # Parameters and buffers of the models kept loaded, in bytes
+    defaultBudgetBytes = 4 * 1024 ** 3
+
+    def __init__(self, budgetBytes=None):
+        self.budgetBytes = budgetBytes if budgetBytes is not None else self.defaultBudgetBytes
+
+        # key -> entry, least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # key -> lock held while the model is being loaded
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.loadSeconds = 0.0
+
+    @staticmethod
+    def key(architecture, weightsPath, device, dtype="float32"):
+        """ Returns the cache key of a model, device and dtype as strings, e.g., "cuda" and
+        "float32", so that torch.device and torch.dtype values give the same key.
+        """
+        path = os.path.abspath(weightsPath) if weightsPath is not None else None
+        return (architecture, path, str(device), str(dtype).replace("torch.", ""))
+
+    def get(self, architecture, weightsPath, device, load, dtype="float32"):
+        """ Returns the model of architecture with the weights at weightsPath on device. On a
+        miss it is load(), which must return the model ready to run: weights loaded, moved to
+        device and in eval mode.
+        """
+        key = self.key(architecture, weightsPath, device, dtype)
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry["model"]
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Lock()
+                    loading.acquire()
+                    break
+            # Another thread is loading this model, wait for it and look again
+            with loading:
+                pass
+
+        try:
+            start = timer()
+            model = load()
+            seconds = timer() - start
+            entry = {"model": model, "bytes": modelBytes(model), "loadSeconds": seconds, "hits": 0}
+            with self._lock:
+                self.misses += 1
+                self.loadSeconds += seconds
+                self._entries[key] = entry
+                evicted = self._evict()
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.release()
+
+        print("Model cache: loaded {} on {} in {:.2f} s".format(architecture, key[2], seconds))
+        if evicted and any("cuda" in evictedKey[2] for evictedKey in evicted):
+            _emptyCudaCache()
+        return model
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            entry["hits"] += 1
+            self.hits += 1
+        return entry
+
+    def _evict(self):
+        # Drop least recently used models until the rest fits in the budget, returns their keys
+        evicted = []
+        total = sum(entry["bytes"] for entry in self._entries.values())
+        while total > self.budgetBytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            total -= entry["bytes"]
+            evicted.append(key)
+            print("Model cache: evicted {} on {}".format(key[0], key[2]))
+        return evicted
+
+    def contains(self, architecture, weightsPath, device, dtype="float32"):
+        with self._lock:
+            return self.key(architecture, weightsPath, device, dtype) in self._entries
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._entries)
+            self._entries.clear()
+        if any("cuda" in key[2] for key in evicted):
+            _emptyCudaCache()
+
+    def stats(self):
+        """ Returns a dict with the total hits, misses, loadSeconds and bytes of the cache and
+        per model key the bytes, loadSeconds and hits of the model, most recently used last.
+        """
+        with self._lock:
+            models = collections.OrderedDict(
+                (key, {"bytes": entry["bytes"], "loadSeconds": entry["loadSeconds"], "hits": entry["hits"]})
+                for key, entry in self._entries.items())
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "loadSeconds": self.loadSeconds,
+                "bytes": sum(model["bytes"] for model in models.values()),
+                "models": models,
+            }
+
+
+def modelBytes(model):
+    """ Returns the bytes of the parameters and buffers of a torch.nn.Module, 0 for other objects.
+    """
+    tensors = list(getattr(model, "parameters", list)()) + list(getattr(model, "buffers", list)())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def _emptyCudaCache():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# The cache shared by all tools
+modelCache = ModelCache()
@@ -0,0 +1,151 @@
+""" ModelQuantization.py: Opt-in int8 inference on the CPU for the convolutional AI tools.
+
+BSRGAN (RRDBNet), U^2-Net and the AnimeGANv2 generator run in float32, which on a CPU takes
+minutes for a full-size upscale or cutout. With PHOTOLAB_INT8=1 in the environment, or enabled
+set to True, these tools run an int8 variant of their model whenever they run on the CPU.
+
+The variants are quantized statically: the weights and activations of the convolutions are
+int8, with activation ranges observed by running the model on some of the bundled sample
+images (images/). PyTorch's dynamic quantization would only convert Linear and recurrent
+layers, and these networks have none worth converting. Layers without an int8 kernel, e.g.,
+GroupNorm and the paddings of AnimeGANv2, stay in float32.
+
+Each variant is checked against the float32 model on a sample image it was not calibrated on,
+PSNR for images and IoU for masks. If it falls short of the minimum the tool keeps running the
+float32 model. Either way the result is kept in modelCache with dtype "qint8", so a model is
+quantized and checked once per session.
+"""
+
+import copy
+import glob
+import math
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from ModelCache import modelCache
+
+enabled = os.environ.get("PHOTOLAB_INT8", "0") not in ("", "0")
+
+# Least agreement with the float32 model for the int8 variant to be used
+minimumPSNR = 30.0
+minimumIoU = 0.95
+
+
+def useQuantized(device):
+    """ Returns whether a tool running on device (e.g., "cpu" or torch.device("cuda")) should
+    use the int8 variant of its model.
+    """
+    return enabled and str(device).startswith("cpu")
+
+
+def sampleImages(pattern, size):
+    """ Returns the bundled sample images matching pattern, e.g., "images/AnimeGanV2*.jpg",
+    sorted by name, as (1, 3, height, width) float32 RGB tensors in [0, 1] resized to size, a
+    (width, height) tuple.
+    """
+    samples = []
+    for path in sorted(glob.glob(pattern)):
+        image = Image.open(path)
+        # Decode large JPEGs at a fraction of their size, they are resized anyway
+        image.draft("RGB", size)
+        image = image.convert("RGB").resize(size, Image.BICUBIC)
+        array = np.asarray(image, dtype=np.float32) / 255
+        samples.append(torch.from_numpy(array.transpose(2, 0, 1).copy()).unsqueeze(0))
+    return samples
+
+
+def psnr(reference, output, peak=1.0):
+    """ Returns the peak signal-to-noise ratio in dB of output against reference, two tensors
+    or arrays of values in [0, peak].
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    output = np.asarray(output, dtype=np.float64)
+    mse = np.mean((np.clip(output, 0, peak) - np.clip(reference, 0, peak)) ** 2)
+    return math.inf if mse == 0 else 10 * math.log10(peak ** 2 / mse)
+
+
+def maskIoU(reference, output, threshold=0.5):
+    """ Returns the intersection over union of the masks of output and reference, two tensors
+    or arrays of values in [0, 1], above threshold.
+    """
+    reference = np.asarray(reference) > threshold
+    output = np.asarray(output) > threshold
+    union = np.logical_or(reference, output).sum()
+    return 1.0 if union == 0 else np.logical_and(reference, output).sum() / union
+
+
+def quantize(model, calibration, arguments=()):
+    """ Returns an int8 copy of model, a float32 torch.nn.Module, for the CPU. The ranges of
+    the activations are observed on calibration, a list of input tensors. arguments are passed
+    to model after the input, e.g., flags of its forward; they are fixed at quantization and
+    the copy ignores any passed to it.
+    """
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+
+    bound = _Bound(copy.deepcopy(model).cpu().eval(), arguments)
+    qconfig = {"": get_default_qconfig(engine)}
+    try:
+        prepared = prepare_fx(bound, qconfig, example_inputs=(calibration[0],))
+    except TypeError:
+        # torch < 1.13 takes no example inputs
+        prepared = prepare_fx(bound, qconfig)
+
+    with torch.no_grad():
+        for sample in calibration:
+            prepared(sample)
+    return _Unbound(convert_fx(prepared))
+
+
+def quantizedModel(architecture, weightsPath, load, samples, metric, minimum, arguments=()):
+    """ Returns the int8 variant of the model of architecture with the weights at weightsPath,
+    from modelCache or else quantized from load(), which returns the float32 model on the CPU.
+
+    samples() returns a list of inputs, only called if the variant is not cached. All but the
+    last one calibrate the variant (see quantize), the last one checks it:
+    metric(reference, output) of the outputs of the float32 model and of the variant must be
+    at least minimum, otherwise the float32 model is returned in its place.
+    """
+    def quantizeAndCheck():
+        model = load()
+        inputs = samples()
+        calibration, check = inputs[:-1], inputs[-1]
+        quantized = quantize(model, calibration, arguments)
+        with torch.no_grad():
+            value = metric(model(check, *arguments), quantized(check))
+        if value < minimum:
+            print("Model quantization: {} int8 {:.3f} < {:.3f}, using float32".format(architecture, value, minimum))
+            return model
+        print("Model quantization: {} int8 {:.3f}".format(architecture, value))
+        return quantized
+
+    return modelCache.get(architecture, weightsPath, "cpu", quantizeAndCheck, dtype="qint8")
+
+
+class _Bound(torch.nn.Module):
+    # model with the arguments after the input fixed, so that only the input is traced
+
+    def __init__(self, model, arguments):
+        super().__init__()
+        self.model = model
+        self.arguments = tuple(arguments)
+
+    def forward(self, input):
+        return self.model(input, *self.arguments)
+
+
+class _Unbound(torch.nn.Module):
+    # Takes the arguments of the float32 model and ignores those fixed at quantization
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input, *arguments):
+        return self.model(input)
@@ -0,0 +1,164 @@
+""" QBrushEngine.py: Circular brush stamps applied to a NumPy view of a layer.
+
+The paint and eraser tools used to collect every pixel of a square around the mouse in a
+Python list and set them one QImage.setPixelColor call at a time. Here a brush is a circular
+alpha mask computed once per (radius, hardness) and cached. A stroke segment places the mask
+every few pixels from the previous mouse position to the current one, so fast strokes have no
+gaps, merges the stamps into one coverage array and blends that into the pixels of the layer
+with a single NumPy operation over the rectangle the segment touches.
+
+Pixels are the (height, width, 4) uint8 view of imageToArray for Format_ARGB32_Premultiplied
+or Format_RGB32 images, B, G, R, A in memory. Premultiplied pixels blend linearly in every
+channel, alpha included, which is what makes paint and erase one expression each. The blur
+brush filters only the rectangle a segment touches, padded by the reach of the filter.
+"""
+
+import functools
+import math
+
+import numpy as np
+from PIL import Image, ImageFilter
+from PyQt6.QtCore import QRect
+
+
+@functools.lru_cache(maxsize=32)
+def brushMask(radius, hardness=1.0, antialiased=True):
+    """ Returns the coverage of a circular brush as a read-only (2n + 1, 2n + 1) float32 array
+    in [0, 1], centered on its middle pixel.
+
+    hardness in [0, 1] is the fraction of the radius painted at full strength, the rest fades
+    out smoothly. Antialiased masks fade out over at least one pixel at the edge, otherwise a
+    pixel is either inside the circle or not.
+    """
+    radius = max(float(radius), 0.5)
+    hardness = min(max(float(hardness), 0.0), 1.0)
+    n = int(math.ceil(radius + 0.5))
+    offsets = np.arange(-n, n + 1, dtype=np.float32)
+    distance = np.hypot(offsets[:, np.newaxis], offsets[np.newaxis, :])
+
+    if antialiased:
+        inner = min(radius * hardness, radius - 0.5)
+        outer = radius + 0.5
+    else:
+        if hardness >= 1.0:
+            mask = (distance <= radius).astype(np.float32)
+            mask.setflags(write=False)
+            return mask
+        inner = radius * hardness
+        outer = radius
+
+    t = np.clip((outer - distance) / (outer - inner), 0.0, 1.0)
+    mask = t * t * (3.0 - 2.0 * t)
+    if not antialiased:
+        mask[distance > radius] = 0.0
+    mask = mask.astype(np.float32)
+    mask.setflags(write=False)
+    return mask
+
+
+def stampPositions(start, end, spacing):
+    """ Returns the integer centers of the stamps of a stroke segment from start to end, both
+    (x, y) tuples, placed spacing pixels apart. start is the end of the previous segment and
+    already stamped; with start None the segment is a single stamp at end.
+    """
+    ex, ey = end
+    if start is None:
+        return [(int(round(ex)), int(round(ey)))]
+
+    sx, sy = start
+    length = math.hypot(ex - sx, ey - sy)
+    count = max(1, int(math.ceil(length / max(spacing, 1.0))))
+    return [(int(round(sx + (ex - sx) * k / count)), int(round(sy + (ey - sy) * k / count)))
+            for k in range(1, count + 1)]
+
+
+def stamp(pixels, positions, mask, color=None, opacity=1.0):
+    """ Blends mask at every position into pixels, in place, and returns the QRect of pixels
+    changed (empty if the stamps miss the image).
+
+    Overlapping stamps of one call do not add up, every pixel gets the largest coverage of
+    any of them. color is an (r, g, b) tuple painted opaque, None erases to transparent.
+    """
+    rect, coverage = _coverage(pixels.shape, positions, mask, opacity)
+    if rect.isEmpty():
+        return rect
+
+    region = pixels[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+    keep = region * (1.0 - coverage)
+    if color is not None:
+        r, g, b = color
+        keep += coverage * np.array((b, g, r, 255), dtype=np.float32)
+    region[...] = np.rint(keep).astype(np.uint8)
+    return rect
+
+
+def blurStamp(pixels, positions, mask, filter=ImageFilter.BLUR, opacity=1.0):
+    """ Blends a blurred copy of the pixels under the stamps into pixels, in place, and
+    returns the QRect of pixels changed, like stamp.
+
+    Only the rectangle of the stamps, padded by the reach of the filter kernel, is filtered,
+    so the cost depends on the brush size and not on the size of the image. Within the image
+    the result equals filtering the whole image.
+    """
+    rect, coverage = _coverage(pixels.shape, positions, mask, opacity)
+    if rect.isEmpty():
+        return rect
+
+    height, width = pixels.shape[:2]
+    pad = _filterReach(filter)
+    left = max(rect.left() - pad, 0)
+    top = max(rect.top() - pad, 0)
+    right = min(rect.right() + 1 + pad, width)
+    bottom = min(rect.bottom() + 1 + pad, height)
+
+    # The filter works on each channel alone, so the BGRA order of the pixels does not matter
+    padded = Image.fromarray(np.ascontiguousarray(pixels[top:bottom, left:right]), "RGBA")
+    blurred = np.asarray(padded.filter(filter))
+    blurred = blurred[rect.top() - top:rect.bottom() + 1 - top, rect.left() - left:rect.right() + 1 - left]
+
+    region = pixels[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+    mixed = region * (1.0 - coverage) + blurred * coverage
+    region[...] = np.rint(mixed).astype(np.uint8)
+    return rect
+
+
+def _filterReach(filter):
+    # Pixels a PIL filter reads on each side of the pixel it computes
+    if hasattr(filter, "filterargs"):
+        return filter.filterargs[0][0] // 2
+    if isinstance(filter, ImageFilter.GaussianBlur):
+        # Three box blurs of about the radius each
+        return int(math.ceil(3 * filter.radius)) + 1
+    if isinstance(filter, ImageFilter.BoxBlur):
+        return int(math.ceil(filter.radius)) + 1
+    return getattr(filter, "size", 3) // 2
+
+
+def _coverage(shape, positions, mask, opacity):
+    # Returns the QRect the stamps touch within an image of shape and their merged coverage
+    # over it as a (height, width, 1) float32 array
+    height, width = shape[:2]
+    n = mask.shape[0] // 2
+
+    xs = [x for x, _ in positions]
+    ys = [y for _, y in positions]
+    left = max(min(xs) - n, 0)
+    top = max(min(ys) - n, 0)
+    right = min(max(xs) + n + 1, width)
+    bottom = min(max(ys) + n + 1, height)
+    if left >= right or top >= bottom:
+        return QRect(), None
+
+    coverage = np.zeros((bottom - top, right - left), dtype=np.float32)
+    for x, y in positions:
+        x0 = max(x - n, left)
+        y0 = max(y - n, top)
+        x1 = min(x + n + 1, right)
+        y1 = min(y + n + 1, bottom)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        target = coverage[y0 - top:y1 - top, x0 - left:x1 - left]
+        np.maximum(target, mask[y0 - y + n:y1 - y + n, x0 - x + n:x1 - x + n], out=target)
+    if opacity != 1.0:
+        coverage *= opacity
+    return QRect(left, top, right - left, bottom - top), coverage[..., np.newaxis]
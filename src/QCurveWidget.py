@@ -5,11 +5,10 @@ import sys
 from random import random
 
 from PyQt6 import QtWidgets, QtGui, QtCore
-from PyQt6.QtGui import QPixmap
 from panda3d.core import NurbsCurve, Vec3, Notify, HermiteCurve, CurveFitter
 import numpy as np
 import cv2
-from PIL import Image
+from QImageBuffer import imageToArray, arrayToImage
 
 # https://discourse.panda3d.org/t/pyqt-curve-editor-curvefitter-example/15207
 # https://stackoverflow.com/questions/64718236/how-to-perform-color-tone-adjustments-and-write-a-look-up-table
@@ -125,6 +124,9 @@ class QCurveWidget(QtWidgets.QWidget):
         self.curves = []
         self.viewer = viewer
 
+        # The curve applies to the selection made before opening the widget, if any
+        self.selection = viewer.selectionMask()
+
         self.setWindowTitle("Curves")
 
         # Append initial curve
@@ -145,20 +147,6 @@ class QCurveWidget(QtWidgets.QWidget):
         # (CurveIndex, PointIndex)
         self._selected_point = None
 
-    def QPixmapToImage(self, pixmap):
-        from PIL import Image
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def ImageToQPixmap(self, image):
-        from PIL.ImageQt import ImageQt
-        return QPixmap.fromImage(ImageQt(image))
-
     def paintEvent(self, e):
         """ Internal QT paint event, draws the entire widget """
         qp = QtGui.QPainter()
@@ -212,9 +200,9 @@ class QCurveWidget(QtWidgets.QWidget):
 
     def updateImage(self):
         # Perform LUT on mouse release
-        pixmap = self.viewer.getCurrentLayerLatestPixmapBeforeLUTChange()
-        image = self.QPixmapToImage(pixmap)
-        arr = np.asarray(image)
+        base = self.viewer.getCurrentLayerLatestImageBeforeLUTChange()
+        image = base if self.selection is None else self.selection.crop(base)
+        arr = imageToArray(image.convertToFormat(QtGui.QImage.Format.Format_RGBA8888))
         b, g, r, a = cv2.split(arr)
         arr = np.dstack((b, g, r))
 
@@ -237,9 +225,7 @@ class QCurveWidget(QtWidgets.QWidget):
 
         # Save result
         newImage = np.dstack((result, a))
-        newImage = Image.fromarray(newImage)
-        updatedPixmap = self.ImageToQPixmap(newImage)
-        self.viewer.setImage(updatedPixmap, True, "LUT")
+        self.viewer.setSelectedImage(arrayToImage(newImage), self.selection, "LUT", base)
 
     def _get_y_value_for(self, local_value):
         """ Converts a value from 0 to 1 to a value from 0 .. canvas height """
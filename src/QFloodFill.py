@@ -0,0 +1,82 @@
+""" QFloodFill.py: Contiguous flood fill with a color tolerance over a NumPy view of a layer.
+
+The fill tool used to recolor every pixel of the picked color anywhere in the image. This is a
+scanline fill that works on runs: the first time the fill reaches a row, the pixels of the row
+that match the seed color are compared in one NumPy pass and split into runs of consecutive
+matching pixels. The fill then moves from run to run, from each filled run to the runs of the
+rows above and below that touch it. A run is visited once however long it is, and a small
+region of a large image only compares the rows it reaches. The mask of the region is drawn
+from the filled runs at the end.
+
+A pixel matches if none of its B, G, R, A bytes differs from the seed pixel by more than the
+tolerance. Pixels connect to their 4 neighbours, or also to the diagonal ones with
+connectivity 8.
+"""
+
+import bisect
+
+import numpy as np
+from PyQt6.QtCore import QRect
+
+
+def floodFill(pixels, x, y, tolerance=0, connectivity=4):
+    """ Returns (rect, mask) of the region of pixels, a (height, width, 4) uint8 array, that is
+    connected to (x, y) and matches its color. mask is a bool array the size of the QRect rect
+    that bounds the region. rect is empty if (x, y) is outside pixels.
+    """
+    height, width = pixels.shape[:2]
+    if not (0 <= x < width and 0 <= y < height):
+        return QRect(), np.zeros((0, 0), dtype=bool)
+
+    # Bounds of the matching bytes, repeated for a whole row: comparing arrays of the same
+    # shape is several times faster than broadcasting one pixel over the row
+    seed = pixels[y, x].astype(np.int16)
+    low = np.tile(np.clip(seed - tolerance, 0, 255).astype(np.uint8), (width, 1))
+    high = np.tile(np.clip(seed + tolerance, 0, 255).astype(np.uint8), (width, 1))
+    diagonal = 1 if connectivity == 8 else 0
+
+    # row -> (starts, ends, visited) of its runs of matching pixels, [start, end)
+    runs = {}
+
+    def rowRuns(r):
+        entry = runs.get(r)
+        if entry is None:
+            line = pixels[r]
+            # All four bytes of a pixel match if its four bools read as one word are all 1
+            match = ((line >= low) & (line <= high)).view(np.uint32)[:, 0] == 0x01010101
+            edges = np.flatnonzero(np.diff(match, prepend=False, append=False)).tolist()
+            entry = runs[r] = (edges[0::2], edges[1::2], [False] * (len(edges) // 2))
+        return entry
+
+    starts, ends, visited = rowRuns(y)
+    first = bisect.bisect_right(starts, x) - 1
+    visited[first] = True
+    stack = [(y, first)]
+    filled = []
+    while stack:
+        r, i = stack.pop()
+        entry = runs[r]
+        a, b = entry[0][i], entry[1][i]
+        filled.append((r, a, b))
+
+        # Runs of the rows above and below that touch [a, b)
+        for n in (r - 1, r + 1):
+            if 0 <= n < height:
+                starts, ends, visited = rowRuns(n)
+                j = bisect.bisect_right(ends, a - diagonal)
+                while j < len(starts) and starts[j] < b + diagonal:
+                    if not visited[j]:
+                        visited[j] = True
+                        stack.append((n, j))
+                    j += 1
+
+    rows, lefts, rights = (np.array(column) for column in zip(*filled))
+    top, bottom = int(rows.min()), int(rows.max()) + 1
+    left, right = int(lefts.min()), int(rights.max())
+
+    # +1 where a run starts and -1 after it ends, runs of a row never touch each other
+    edges = np.zeros((bottom - top, right - left + 1), dtype=np.int8)
+    edges[rows - top, lefts - left] = 1
+    edges[rows - top, rights - left] = -1
+    mask = np.cumsum(edges[:, :-1], axis=1, dtype=np.int8).astype(bool)
+    return QRect(left, top, right - left, bottom - top), mask
@@ -0,0 +1,125 @@
+""" QHistogram.py: Red, green, blue and luma histograms of the displayed image.
+
+The histogram plot used to be refreshed on every setImage, cursor overlays and slider previews
+included, by converting the whole pixmap to PIL, splitting its channels and weighting three
+histograms into a luma curve in Python. QHistogram counts all four histograms with a single
+bincount over the pixels, or over every sampleStep-th pixel of every sampleStep-th row for
+images larger than maxSamples pixels. Nothing is counted while the histogram is not shown;
+the counts are brought up to date when it is shown again. Full counts run at most once every
+interval milliseconds, the last request wins.
+
+Edits that change a known rectangle of the image counted last, e.g., brush strokes, update
+the counts by the difference of the histograms of that rectangle before and after the edit.
+
+Luma is the ITU-R 601-2 transform of PIL's "L" mode, per pixel.
+"""
+
+import math
+
+import numpy as np
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+from PyQt6.QtGui import QImage
+
+from QImageBuffer import imageToArray
+
+
+class QHistogram(QObject):
+
+    # (4, 256) array of counts: red, green, blue, luma
+    histogramChanged = pyqtSignal(object)
+
+    # Images with more pixels are counted on a regular subsample of about this many pixels
+    maxSamples = 1 << 22
+
+    def __init__(self, parent=None, interval=100):
+        super().__init__(parent)
+        self.enabled = False
+
+        # Image and region the counts belong to, and the sampling step used for them
+        self._image = None
+        self._region = None
+        self._step = 1
+        self._counts = None
+
+        # Latest image requested while the counts were out of date
+        self._pending = None
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._countPending)
+
+    def setEnabled(self, enabled):
+        """ Count only while the histogram is shown. Enabling it counts a pending image at once.
+        """
+        self.enabled = enabled
+        if enabled and self._pending is not None:
+            self._timer.stop()
+            self._countPending()
+
+    def counts(self):
+        return self._counts
+
+    def update(self, image, region=None, changedRect=None, base=None):
+        """ Request the histograms of image (a QImage), within region (a QRect) if it is given.
+
+        If image differs from base only inside changedRect and the current counts are those of
+        base, they are updated right away from the pixels of that rectangle.
+        """
+        if image is None:
+            return
+        if region is not None:
+            region = region.intersected(image.rect())
+
+        if (self.enabled and changedRect is not None and base is not None and self._image is not None
+                and self._pending is None and base.cacheKey() == self._image.cacheKey()
+                and base.size() == image.size() and region == self._region):
+            rect = changedRect.intersected(region if region is not None else image.rect())
+            if not rect.isEmpty():
+                self._counts = self._counts - self._countRect(base, rect) + self._countRect(image, rect)
+            self._image = QImage(image)
+            self.histogramChanged.emit(self._counts)
+            return
+
+        self._pending = (QImage(image), region)
+        if self.enabled and not self._timer.isActive():
+            self._timer.start()
+
+    def _countPending(self):
+        if self._pending is None or not self.enabled:
+            return
+        image, region = self._pending
+        self._pending = None
+
+        rect = region if region is not None else image.rect()
+        self._step = max(1, int(math.ceil(math.sqrt(rect.width() * rect.height() / self.maxSamples))))
+        self._image = image
+        self._region = region
+        self._counts = self._countRect(image, rect)
+        self.histogramChanged.emit(self._counts)
+
+    def _countRect(self, image, rect):
+        # Counts of the pixels of rect on the sampling grid, which is aligned to the image so
+        # that the counts of a rectangle and of the whole image agree
+        step = self._step
+        left = -(-rect.left() // step) * step
+        top = -(-rect.top() // step) * step
+        pixels = imageToArray(image)[top:rect.bottom() + 1:step, left:rect.right() + 1:step]
+        return histograms(pixels)
+
+
+def histograms(pixels):
+    """ Returns the (4, 256) red, green, blue and luma histograms of a (height, width, 4)
+    uint8 array of B, G, R, A pixels, counted in one pass.
+    """
+    b = pixels[..., 0].astype(np.uint32)
+    g = pixels[..., 1].astype(np.uint32)
+    r = pixels[..., 2].astype(np.uint32)
+
+    # Byte values of each histogram, moved into a range of bins of their own
+    values = np.empty(pixels.shape[:2] + (4,), dtype=np.uint16)
+    values[..., 0] = r
+    values[..., 1] = g + 256
+    values[..., 2] = b + 512
+    values[..., 3] = ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16) + 768
+    return np.bincount(values.ravel(), minlength=1024).reshape(4, 256)
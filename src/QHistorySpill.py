@@ -0,0 +1,138 @@
+""" QHistorySpill.py: Memory-mapped scratch file for undo history that does not fit in RAM.
+
+QHistoryPool moves cold history images (keyframes and delta tiles) here when the resident
+budget is exceeded and QLayerHistory pages them back in when an old entry is needed again,
+e.g., on undo or when switching to another layer.
+
+The file holds raw pixel rows back to back. The index maps a handle to the position of the
+pixels in the file and what is needed to rebuild the QImage (size, bytes per line, format).
+Freed ranges are reused first-fit. The file is created in the temp directory for the session
+and removed by the operating system when it is closed.
+"""
+
+import itertools
+import mmap
+import tempfile
+
+from PyQt6.QtGui import QImage
+
+
+class QHistorySpill:
+
+    # Grow the scratch file in steps of this many bytes
+    growBytes = 256 * 1024 * 1024
+
+    # Start of every stored image is aligned to this many bytes
+    alignment = 64
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix="PhotoLab-history-", dir=directory)
+        self._map = None
+        self._capacity = 0
+        self._end = 0
+        self._usedBytes = 0
+
+        # Sorted list of free (offset, size) ranges below self._end
+        self._free = []
+
+        # handle -> (offset, size, width, height, bytesPerLine, format)
+        self._index = {}
+        self._handles = itertools.count(1)
+
+    def usedBytes(self):
+        """ Bytes of pixel data currently stored in the scratch file.
+        """
+        return self._usedBytes
+
+    def fileBytes(self):
+        """ Size of the scratch file on disk.
+        """
+        return self._capacity
+
+    def sizeOf(self, handle):
+        return self._index[handle][1]
+
+    def store(self, image):
+        """ Copy the pixels of image into the scratch file and return a handle to them.
+        """
+        size = image.sizeInBytes()
+        offset = self._allocate(size)
+        ptr = image.constBits()
+        ptr.setsize(size)
+        self._map[offset:offset + size] = ptr
+
+        handle = next(self._handles)
+        self._index[handle] = (offset, size, image.width(), image.height(), image.bytesPerLine(), image.format())
+        self._usedBytes += size
+        return handle
+
+    def load(self, handle):
+        """ Returns a new QImage with the pixels stored under handle.
+        """
+        offset, size, width, height, bytesPerLine, format = self._index[handle]
+        image = QImage(width, height, format)
+        if image.bytesPerLine() != bytesPerLine:
+            # Row padding differs, e.g., for 24-bit formats: wrap the stored rows and copy
+            with memoryview(self._map) as view:
+                data = bytes(view[offset:offset + size])
+            return QImage(data, width, height, bytesPerLine, format).copy()
+
+        ptr = image.bits()
+        ptr.setsize(size)
+        with memoryview(self._map) as view:
+            memoryview(ptr)[:] = view[offset:offset + size]
+        return image
+
+    def release(self, handle):
+        offset, size = self._index.pop(handle)[:2]
+        self._usedBytes -= size
+        size = self._aligned(size)
+
+        # Insert into the free list and merge with neighbouring free ranges
+        self._free.append((offset, size))
+        self._free.sort()
+        merged = []
+        for start, length in self._free:
+            if merged and merged[-1][0] + merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], merged[-1][1] + length)
+            else:
+                merged.append((start, length))
+        if merged and merged[-1][0] + merged[-1][1] == self._end:
+            self._end = merged.pop()[0]
+        self._free = merged
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._index = {}
+        self._free = []
+        self._usedBytes = 0
+
+    def _aligned(self, size):
+        return -(-size // self.alignment) * self.alignment
+
+    def _allocate(self, size):
+        size = self._aligned(size)
+        for i, (offset, length) in enumerate(self._free):
+            if length >= size:
+                if length == size:
+                    del self._free[i]
+                else:
+                    self._free[i] = (offset + size, length - size)
+                return offset
+
+        offset = self._end
+        self._end += size
+        if self._end > self._capacity:
+            self._grow(self._end)
+        return offset
+
+    def _grow(self, minimumSize):
+        capacity = -(-minimumSize // self.growBytes) * self.growBytes
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(capacity)
+        self._map = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
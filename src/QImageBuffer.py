@@ -0,0 +1,122 @@
+""" QImageBuffer.py: Zero-copy conversions between QImage, NumPy and PIL.
+
+imageToArray exposes the pixels of a 32-bit QImage as a NumPy view of its buffer, no bytes are
+copied. The view holds a reference to the QImage, so the buffer stays valid as long as the view
+(or any array derived from it) is alive. Writable views detach the QImage from other QImages and
+QPixmaps sharing its pixels first, so they never change an image somebody else holds.
+
+arrayToImage wraps a NumPy array as a QImage without copying. The QImage keeps the array alive,
+but copies of it that Qt makes behind the scenes (e.g., QPixmap.fromImage of an RGB32 or
+ARGB32_Premultiplied image) share the buffer without doing so. Call copy() on the QImage before
+handing it to something that outlives it.
+
+The PIL helpers build on these: a PIL image of a QImage reads the RGBA8888 pixels in place, and
+a PIL image becomes a QImage with the one copy PIL needs to hand out its pixels.
+
+Byte order of the pixels in memory:
+    Format_RGB32, Format_ARGB32(_Premultiplied): B, G, R, A
+    Format_RGBA8888(_Premultiplied): R, G, B, A
+"""
+
+import numpy as np
+from PIL import Image
+from PyQt6.QtGui import QImage, QPixmap
+
+# 32-bit formats imageToArray exposes as they are, anything else is converted to Format_ARGB32
+arrayFormats = (
+    QImage.Format.Format_RGB32,
+    QImage.Format.Format_ARGB32,
+    QImage.Format.Format_ARGB32_Premultiplied,
+    QImage.Format.Format_RGBA8888,
+    QImage.Format.Format_RGBA8888_Premultiplied,
+    QImage.Format.Format_RGBX8888,
+)
+
+# Format of the QImage wrapping an array with this many channels, see arrayToImage
+_channelFormats = {
+    1: QImage.Format.Format_Grayscale8,
+    3: QImage.Format.Format_RGB888,
+    4: QImage.Format.Format_RGBA8888,
+}
+
+
+class _ImageBuffer:
+    """ Exports the pixels of a QImage through the NumPy array interface. Arrays made from it
+    keep it, and with it the QImage, alive through their base.
+    """
+
+    def __init__(self, image, writable):
+        self.image = image
+        ptr = image.bits() if writable else image.constBits()
+        self.__array_interface__ = {
+            "shape": (image.height(), image.width(), 4),
+            "strides": (image.bytesPerLine(), 4, 1),
+            "typestr": "|u1",
+            "data": (int(ptr), not writable),
+            "version": 3,
+        }
+
+
+def imageToArray(image, writable=False):
+    """ Returns the pixels of a QImage as a (height, width, 4) uint8 array.
+
+    Images in one of arrayFormats are exposed without copying, other images are converted to
+    Format_ARGB32 first. Row padding is skipped by the strides of the view.
+    """
+    if image.format() not in arrayFormats:
+        image = image.convertToFormat(QImage.Format.Format_ARGB32)
+    elif not writable:
+        # Our own reference, so that the buffer is not freed if the caller drops theirs
+        image = QImage(image)
+    return np.asarray(_ImageBuffer(image, writable))
+
+
+def arrayToImage(array, format=None):
+    """ Returns a QImage over the memory of array, no pixels are copied.
+
+    array is a (height, width), (height, width, 3) or (height, width, 4) uint8 array. format
+    defaults to Grayscale8, RGB888 or RGBA8888 by the number of channels. Arrays that are not
+    C-contiguous, e.g., slices, are copied first.
+    """
+    if array.dtype != np.uint8:
+        raise ValueError("arrayToImage: Expected a uint8 array, got " + str(array.dtype))
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    if format is None:
+        format = _channelFormats[channels]
+    array = np.ascontiguousarray(array)
+
+    # PyQt keeps a reference to the array for as long as the QImage exists
+    height, width = array.shape[:2]
+    return QImage(array, width, height, width * channels, format)
+
+
+def QImageToImage(qimage):
+    """ Returns a PIL RGBA image of qimage. Format_RGBA8888 images are read in place, other
+    formats are converted once. The PIL image is read-only and copies itself on write.
+    """
+    image = qimage.convertToFormat(QImage.Format.Format_RGBA8888)
+    pixels = imageToArray(image)
+    if image.bytesPerLine() != 4 * image.width():
+        pixels = np.ascontiguousarray(pixels)
+    return Image.frombuffer('RGBA', (image.width(), image.height()), pixels, 'raw', 'RGBA', 0, 1)
+
+
+def QPixmapToImage(pixmap):
+    """ Returns a PIL RGBA image of pixmap, see QImageToImage.
+    """
+    return QImageToImage(pixmap.toImage())
+
+
+def ImageToQImage(image):
+    """ Returns a QImage of a PIL image. The pixels are copied once, out of PIL, and the QImage
+    wraps that copy (see arrayToImage).
+    """
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return arrayToImage(np.asarray(image))
+
+
+def ImageToQPixmap(image):
+    """ Returns a QPixmap of a PIL image.
+    """
+    return QPixmap.fromImage(ImageToQImage(image))
@@ -1,6 +1,7 @@
 ﻿""" QtImageViewer.py: PyQt image viewer widget based on QGraphicsView with mouse zooming/panning and ROIs.
 """
 
+import functools
 import os.path
 
 from PyQt6 import QtCore, QtGui, QtWidgets
@@ -28,9 +29,14 @@ __author__ = "Marcel Goldschen-Ohm <marcel.goldschen@gmail.com>"
 __version__ = '2.0.0'
 
 from QCropItem import QCropItem
+from QTiledImageItem import QTiledImageItem
+from QLayerHistory import QLayerHistory, QHistoryPool
+from AdjustmentStack import AdjustmentStack
 import random
-from PIL import Image, ImageFilter, ImageDraw
-from PIL.ImageQt import ImageQt
+from QImageBuffer import imageToArray, arrayToImage
+from QBrushEngine import brushMask, stampPositions, stamp, blurStamp
+from QFloodFill import floodFill
+from QSelectionMask import QSelectionMask
 
 class QtImageViewer(QGraphicsView):
     """ PyQt image viewer widget based on QGraphicsView with mouse zooming/panning and ROIs.
@@ -45,7 +51,7 @@ class QtImageViewer(QGraphicsView):
         For display in the QGraphicsView the image will be converted to a QPixmap.
     Some useful image format conversion utilities:
         qimage2ndarray: NumPy ndarray <==> QImage    (https://github.com/hmeine/qimage2ndarray)
-        ImageQt: PIL Image <==> QImage  (https://github.com/python-pillow/Pillow/blob/master/PIL/ImageQt.py)
+        QImageBuffer: NumPy ndarray <==> QImage <==> PIL Image without copying where possible
     Mouse:
     ------
     Mouse interactions for zooming and panning is fully customizable by simply setting the desired button interactions:
@@ -95,14 +101,14 @@ class QtImageViewer(QGraphicsView):
         
         self.parent = parent
 
-        # Image is displayed as a QPixmap in a QGraphicsScene attached to this QGraphicsView.
+        # Image is displayed as tiles of a QTiledImageItem in a QGraphicsScene attached to this QGraphicsView.
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
 
         # Better quality pixmap scaling?
         # self.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
 
-        # Displayed image pixmap in the QGraphicsScene.
+        # Displayed image in the QGraphicsScene, see QTiledImageItem.
         self._current_filename = None
         self._image = None
 
@@ -144,9 +150,14 @@ class QtImageViewer(QGraphicsView):
         # Flags for painting
         self._isPainting = False
         self.paintBrushSize = 43
+        self.paintBrushHardness = 1.0
 
         # Flags for filling
+        # Largest difference of any color channel to the clicked pixel that is still filled,
+        # and whether diagonal neighbours connect (8) or not (4)
         self._isFilling = False
+        self.fillTolerance = 32
+        self.fillConnectivity = 4
 
         # Flags for rectangle select
         # Set to true when using the rectangle select tool with toolbar
@@ -179,16 +190,33 @@ class QtImageViewer(QGraphicsView):
         # Flags for blur tool
         self._isBlurring = False
         self.blurBrushSize = 43
+        self.blurBrushHardness = 1.0
 
         # Flags for erasing
         self._isErasing = False
         self.eraserBrushSize = 43
+        self.eraserBrushHardness = 1.0
+
+        # Distance between brush stamps as a fraction of the brush radius, and the
+        # scene position of the last stamp of the current stroke
+        self.brushSpacing = 0.25
+        self._lastStrokePosition = None
+
+        # Brush stroke in progress: the layer being painted into, a writable view of its
+        # pixels, the rectangle changed so far and the note of its history entry
+        self._strokeImage = None
+        self._strokePixels = None
+        self._strokeDirty = QRect()
+        self._strokeExplanation = None
 
         # Store temporary position in screen pixels or scene units.
         self._pixelPosition = QPoint()
         self._scenePosition = QPointF()
         self._lastMousePositionInScene = QPointF()
 
+        # Brush outline shown under the mouse by renderCursorOverlay
+        self._cursorItem = None
+
         # Track mouse position. e.g., For displaying coordinates in a UI.
         self.setMouseTracking(True)
 
@@ -210,15 +238,34 @@ class QtImageViewer(QGraphicsView):
         ##############################################################################################
         ##############################################################################################
 
+        # Undo history of every layer, all sharing one memory budget
+        self.historyPool = QHistoryPool()
         self.layerHistory = {
-            0: []    
+            0: QLayerHistory(self.historyPool)
         }
         self.currentLayer = 0
         self.numLayersCreated = 1
 
-        self.checkerBoard = None
-        self.checkerBoardWidth = 0
-        self.checkerBoardHeight = 0
+        # Proxy of the visible region shown while an adjustment slider is dragged
+        self._previewItem = None
+        self._previewAdjustments = None
+
+        # Healed window and brush outlines shown by the spot removal tool, and the layer
+        # pixels it works on (see getSpotRemovalPixels)
+        self._spotResultItem = None
+        self._spotOutlineItem = None
+        self._spotRemovalPixels = None
+
+        # Radius in pixels over which the edge of a selection fades out, and the (key,
+        # QSelectionMask) of the last selection (see selectionMask)
+        self.selectionFeather = 0
+        self._selectionMask = None
+
+        # Grid drawn behind transparent images, see drawBackground. Its cells are
+        # checkerBoardCellSize screen pixels at any zoom and image size, so one small tile
+        # made here is all it ever needs
+        self.checkerBoardCellSize = 8
+        self.checkerBoard = self.checkerBoardBrush(self.checkerBoardCellSize)
 
         # Reference to dock widget that shows layer list
         self.layerListDock = None
@@ -226,6 +273,39 @@ class QtImageViewer(QGraphicsView):
     def sizeHint(self):
         return QSize(900, 600)
 
+    def drawBackground(self, painter, rect):
+        """ Draw a grid behind the image so that transparent regions are visible.
+        """
+        super(QtImageViewer, self).drawBackground(painter, rect)
+        if not self.hasImage():
+            return
+
+        imageRect = self._image.sceneBoundingRect()
+        exposed = imageRect.intersected(rect)
+        if exposed.isEmpty():
+            return
+
+        # Fill in screen pixels, with the grid anchored to the corner of the image so that
+        # it pans along with it
+        transform = painter.worldTransform()
+        painter.save()
+        painter.resetTransform()
+        painter.setBrushOrigin(transform.map(imageRect.topLeft()))
+        painter.fillRect(transform.mapRect(exposed), self.checkerBoard)
+        painter.restore()
+
+    @staticmethod
+    def checkerBoardBrush(cellSize):
+        """ Returns a QBrush that tiles a grid of cellSize x cellSize pixel checks.
+        """
+        tile = QPixmap(2 * cellSize, 2 * cellSize)
+        tile.fill(Qt.GlobalColor.transparent)
+        tilePainter = QPainter(tile)
+        tilePainter.fillRect(cellSize, 0, cellSize, cellSize, QtGui.QColor(83, 83, 83))
+        tilePainter.fillRect(0, cellSize, cellSize, cellSize, QtGui.QColor(83, 83, 83))
+        tilePainter.end()
+        return QtGui.QBrush(tile)
+
     def hasImage(self):
         """ Returns whether the scene contains an image pixmap.
         """
@@ -237,6 +317,9 @@ class QtImageViewer(QGraphicsView):
         if self.hasImage():
             self.scene.removeItem(self._image)
             self._image = None
+            self._previewItem = None
+            self._spotResultItem = None
+            self._spotOutlineItem = None
 
     def pixmap(self):
         """ Returns the scene's current image pixmap as a QPixmap, or else None if no image exists.
@@ -258,18 +341,34 @@ class QtImageViewer(QGraphicsView):
         :rtype: QImage | None
         """
         if self.hasImage():
-            return self._image.pixmap().toImage()
+            return self._image.image()
         return None
 
+    def resetLayerHistory(self):
+        """ Drop all layers and their history, e.g., before opening a new image.
+        """
+        for history in self.layerHistory.values():
+            history.clear()
+        self.numLayersCreated = 1
+        self.currentLayer = 0
+        self.layerHistory = {
+            0: QLayerHistory(self.historyPool)
+        }
+
+    def setCurrentLayer(self, layerIndex):
+        """ Switch to another layer. The history of the layer being left is suspended
+        so that its memory can be spilled to disk while it is not displayed.
+        """
+        if layerIndex != self.currentLayer and self.currentLayer in self.layerHistory:
+            self.layerHistory[self.currentLayer].suspend()
+        self.currentLayer = layerIndex
+
     def getCurrentLayerPixmapBeforeChangeTo(self, changeName):
         if self.currentLayer in self.layerHistory:
             history = self.layerHistory[self.currentLayer]
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if entry["note"] != changeName:
-                    return entry["pixmap"]
-                i -= 1
+            i = history.lastIndexWithNoteOtherThan(changeName)
+            if i is not None:
+                return history.pixmap(i)
         return None
 
     def undoCurrentLayerLatestChange(self):
@@ -279,7 +378,7 @@ class QtImageViewer(QGraphicsView):
                 previous = history[-2]
                 latest = history[-1]
 
-                if latest["type"] == "Tool" and latest["note"] == "Path Select":
+                if latest.type == "Tool" and latest.note == "Path Select":
                     # Undo path selection
                     if self.path:
                         self.path.clear()
@@ -292,118 +391,132 @@ class QtImageViewer(QGraphicsView):
                         if pathPointItem and pathPointItem in self.scene.items():
                             self.scene.removeItem(pathPointItem)
 
-                    if previous["note"] == "Path Select":
-                        self.selectPoints, self.selectPainterPaths, self.selectPainterPointPaths = previous["value"]
+                    if previous.note == "Path Select":
+                        self.selectPoints, self.selectPainterPaths, self.selectPainterPointPaths = previous.value
                         if len(self.selectPoints) > 1:
                             self.buildPath(addToHistory=False)
 
                             # Remove the last entry from the history
-                            self.layerHistory[self.currentLayer] = history[:-1]
+                            history.truncate(len(history) - 1)
                         else:
                             # Remove the last 2 entries from the history
-                            self.layerHistory[self.currentLayer] = history[:-2]
+                            history.truncate(len(history) - 2)
                             self.selectPoints = []
                             self.selectPainterPaths = []
                             self.selectPainterPointPaths = []
                     else:
                         # Previous is not a path select
-                        # Remove the last 2 entries from the history
-                        self.layerHistory[self.currentLayer] = history[:-1]
+                        # Remove the last entry from the history
+                        history.truncate(len(history) - 1)
                         self.selectPoints = []
                         self.selectPainterPaths = []
                         self.selectPainterPointPaths = []
 
-                elif previous["type"] == "Slider":
-                    if previous["value"]:
-                        slider = getattr(self.parent, previous["object"])
-                        slider.setValue(previous["value"])
-                        setattr(self.parent, previous["object"], slider)
-
-                        # Remove the last two entries
-                        self.layerHistory[self.currentLayer] = history[:-2]
-                        self.setImage(previous["pixmap"], True, previous["note"], previous["type"], previous["value"], previous["object"])
-                        # Update GUI object value, e.g., slider setting
-                
-                        if len(self.layerHistory[self.currentLayer]) == 0:
-                            self.layerHistory[self.currentLayer].append(previous)
                 else:
                     # Generic undo
-                    # Remove the last two entries
-                    self.layerHistory[self.currentLayer] = history[:-2]
-                    self.setImage(previous["pixmap"], True, previous["note"], previous["type"], previous["value"], previous["object"])
-                    # Update GUI object value, e.g., slider setting
-                
-                    if len(self.layerHistory[self.currentLayer]) == 0:
-                        self.layerHistory[self.currentLayer].append(previous)
+                    # Remove the last entry, the previous one becomes the latest. Slider entries
+                    # only hold a parameter: the sliders are set to the parameters latest afterwards
+                    history.pop()
+                    self.restoreAdjustments()
+
+    def showCurrentLayerLatestPixmap(self):
+        image = self.getCurrentLayerLatestImage()
+        if image is not None:
+            if self.layerListDock:
+                self.layerListDock.setButtonImage(image)
+            self.setImage(image, False)
 
     def getCurrentLayerLatestPixmap(self):
         if self.currentLayer in self.layerHistory:
             # Layer name checks out
             history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
 
+            # See QLayerHistory for the history structure
             if len(history) > 0:
+                if not self.getCurrentLayerAdjustments().isIdentity():
+                    return QPixmap.fromImage(self.adjustedLayer())
                 # Get most recent
-                entry = history[-1]
-                if "pixmap" in entry:
-                    return entry["pixmap"]
+                return history.pixmap(-1)
+        return None
+
+    def getCurrentLayerLatestImage(self):
+        """ Returns the current layer as a QImage, with the adjustment sliders that are not baked
+        into it yet applied. This is the state the layer is kept in, the pixmaps are only made
+        for display. The image shares its pixels with the layer history; painting into it
+        detaches it, the history is never changed.
+        """
+        if self.currentLayer in self.layerHistory:
+            history = self.layerHistory[self.currentLayer]
+            if len(history) > 0:
+                return QImage(self.adjustedLayer())
         return None
 
+    def getCurrentLayerLatestImageBeforeSliderChange(self):
+        """ Returns the pixels of the current layer as a QImage, without the adjustment sliders
+        that are not baked into it yet. "Slider" entries hold no pixels, so these are the pixels
+        of the latest entry. The adjustments are rendered from this image.
+        """
+        if self.currentLayer in self.layerHistory:
+            history = self.layerHistory[self.currentLayer]
+            if len(history) > 0:
+                return QImage(history.image(-1))
+        return None
+
+    def adjustedLayer(self, render=True):
+        """ Returns the current layer with its adjustment sliders applied as a QImage. The layer
+        is rendered on the thread pool (see the parent's renderSliderChange), this returns that
+        render if it was made with the current parameters and selection. If it was not, e.g.,
+        a tool runs before the render is done, the layer is rendered here, or None is returned
+        if render is false.
+        """
+        adjustments = self.getCurrentLayerAdjustments()
+        if adjustments.isIdentity():
+            return self.getCurrentLayerLatestImageBeforeSliderChange()
+        key = self.adjustedLayerKey()
+        image = adjustments.rendered(key)
+        if image is None and render:
+            image = self.adjustmentJob()()
+            adjustments.setRendered(key, image)
+        return image
+
+    def adjustedLayerKey(self, values=None):
+        """ Returns the key of the current layer rendered with the adjustment sliders at values
+        (default: the current parameters) and the current selection, see AdjustmentStack.setRendered.
+        """
+        values = values if values is not None else self.getCurrentLayerAdjustments().values
+        key = (self.getCurrentLayerLatestImageBeforeSliderChange().cacheKey(),)
+        selection = self.selectionMask()
+        if selection is not None:
+            key += selection.key()
+        return key + tuple(values[name] for name, _, _, _ in AdjustmentStack.steps)
+
+    def getCurrentLayerLatestArray(self):
+        """ Returns the current layer as a read-only (height, width, 4) uint8 array of B, G, R, A
+        bytes with straight alpha. It is a view of the layer image unless that has premultiplied alpha.
+        """
+        image = self.getCurrentLayerLatestImage()
+        if image is None:
+            return None
+        if image.format() == QImage.Format.Format_ARGB32_Premultiplied:
+            image = image.convertToFormat(QImage.Format.Format_ARGB32)
+        return imageToArray(image)
+
     def getCurrentLayerPreviousPixmap(self):
         if self.currentLayer in self.layerHistory:
             # Layer name checks out
             history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
 
             if len(history) > 1:
-                # Get most recent
-                entry = history[-2]
-                if "pixmap" in entry:
-                    return entry["pixmap"]
+                return history.pixmap(-2)
         return None
 
     def getCurrentLayerLatestPixmapBeforeSliderChange(self):
         if self.currentLayer in self.layerHistory:
             # Layer name checks out
             history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "Type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if "pixmap" in entry and entry["type"] != "Slider":
-                    return entry["pixmap"]
-                i -= 1
+            i = history.lastIndexWithTypeOtherThan("Slider")
+            if i is not None:
+                return history.pixmap(i)
 
         return None
 
@@ -411,61 +524,249 @@ class QtImageViewer(QGraphicsView):
         if self.currentLayer in self.layerHistory:
             # Layer name checks out
             history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "Type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if "pixmap" in entry and entry["note"] != "LUT":
-                    return entry["pixmap"]
-                i -= 1
+            i = history.lastIndexWithNoteOtherThan("LUT")
+            if i is not None:
+                return history.pixmap(i)
 
         return None
 
-    def addToHistory(self, pixmap, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
-        self.layerHistory[self.currentLayer].append({
-            "note": explanationOfChange,
-            "pixmap": pixmap,
-            "type": typeOfChange,
-            "value": valueOfChange,
-            "object": objectOfChange
-        })
+    def getCurrentLayerLatestImageBeforeLUTChange(self):
+        if self.currentLayer in self.layerHistory:
+            history = self.layerHistory[self.currentLayer]
+            i = history.lastIndexWithNoteOtherThan("LUT")
+            if i == len(history) - 1:
+                # No LUT change yet, adjustment sliders not baked into the layer included
+                return self.getCurrentLayerLatestImage()
+            if i is not None:
+                return QImage(history.image(i))
+
+        return None
+
+    def selectionMask(self):
+        """ Returns the QSelectionMask of the active rectangle or path selection on the current
+        layer, or None if nothing is selected. It is made once per selection, feather radius
+        and image size, so its mask is rendered only once.
+        """
+        image = self.getCurrentLayerLatestImageBeforeSliderChange()
+        if image is None:
+            return None
+
+        if self._isSelectingRect and self._selectRectItem is not None:
+            rect = QRectF(self._selectRectItem.intern_rect)
+            key = ("rect", rect.x(), rect.y(), rect.width(), rect.height())
+        elif self._isSelectingPath and self.pathSelected is not None and len(self.selectPoints) > 2:
+            key = ("path",) + tuple((p.x(), p.y()) for p in self.selectPoints)
+        else:
+            return None
+
+        key += (self.selectionFeather, image.width(), image.height())
+        if self._selectionMask is None or self._selectionMask[0] != key:
+            if key[0] == "rect":
+                selection = QSelectionMask(image.size(), rect=rect, feather=self.selectionFeather)
+            else:
+                selection = QSelectionMask(image.size(), path=QPainterPath(self.pathSelected), feather=self.selectionFeather)
+            self._selectionMask = (key, selection)
+        return self._selectionMask[1]
+
+    def getCurrentLayerSelectedImage(self):
+        """ Returns (image, selection): the QImage a tool should process and the QSelectionMask
+        to pass to setSelectedImage with its result. With a selection active image is the
+        bounding box of the selection, otherwise it is the whole layer and selection is None.
+        """
+        image = self.getCurrentLayerLatestImage()
+        selection = self.selectionMask()
+        if image is None or selection is None or selection.isEmpty():
+            return image, None
+        return selection.crop(image), selection
+
+    def setSelectedImage(self, image, selection, explanationOfChange, base=None):
+        """ Add image, the result of a tool on the image of getCurrentLayerSelectedImage, to the
+        history of the current layer, blended into base (default: the latest image of the layer)
+        through selection. Without a selection image replaces the layer.
+        """
+        if type(image) is QPixmap:
+            image = image.toImage()
+        if selection is None:
+            self.setImage(image, True, explanationOfChange)
+        elif base is None:
+            self.setImage(selection.blend(self.getCurrentLayerLatestImage(), image), True, explanationOfChange,
+                          changedRect=selection.rect)
+        else:
+            self.setImage(selection.blend(base, image), True, explanationOfChange)
+
+    def addToHistory(self, pixmap, explanationOfChange, typeOfChange, valueOfChange, objectOfChange, changedRect=None):
+        self.layerHistory[self.currentLayer].append(pixmap, explanationOfChange, typeOfChange, valueOfChange, objectOfChange, changedRect)
+
+    def addParameterToHistory(self, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
+        self.layerHistory[self.currentLayer].appendParameter(explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
+
+    def getCurrentLayerAdjustments(self):
+        history = self.layerHistory[self.currentLayer]
+        if history.adjustments is None:
+            history.adjustments = AdjustmentStack()
+        return history.adjustments
+
+    def bakeAdjustments(self):
+        """ Add the current layer with its adjustment sliders applied to the history as a
+        "Sliders" change and set the sliders back to their defaults. Returns False if there was
+        nothing to bake. The display is not changed.
+        """
+        if self.currentLayer not in self.layerHistory or len(self.layerHistory[self.currentLayer]) == 0:
+            return False
+        adjustments = self.getCurrentLayerAdjustments()
+        if adjustments.isIdentity():
+            return False
+
+        self.addToHistory(self.adjustedLayer(), "Sliders", None, None, None)
+        adjustments.reset()
+        if getattr(self.parent, "UpdateSliders", None):
+            self.parent.UpdateSliders(adjustments.values)
+        return True
+
+    def adjustmentJob(self, values=None):
+        """ Returns a function job(cancelled=None) that renders the current layer with the adjustment
+        sliders at values (default: the current parameters) and returns it as a QImage, or None
+        if cancelled() became true. Call this on the GUI thread; job itself only works on QImages
+        and can run on a worker thread.
+        """
+        adjustments = self.getCurrentLayerAdjustments()
+        values = dict(values if values is not None else adjustments.values)
+        image = self.getCurrentLayerLatestImageBeforeSliderChange()
+
+        # With a selection only its bounding box is adjusted, and blended back through its mask
+        selection = self.selectionMask()
+        if selection is not None:
+            # Render the mask here, the job only reads it
+            selection.alpha()
+            key = (image.cacheKey(),) + selection.key()
+            source = lambda: selection.crop(image)
+        else:
+            key = (image.cacheKey(),)
+            source = lambda: image
+
+        def job(cancelled=None):
+            adjusted = adjustments.renderImage(key, source, values, cancelled)
+            if adjusted is None or selection is None:
+                return adjusted
+            return selection.blend(image, adjusted)
+
+        return job
+
+    def previewAdjustments(self, values):
+        """ Show the adjustment sliders at values on a proxy of the visible part of the current
+        layer, at the resolution it is displayed with. The layer and its history are not changed,
+        the next setImage replaces the preview.
+        """
+        image = self.getCurrentLayerLatestImageBeforeSliderChange()
+        if image is None:
+            return
+
+        region = QRectF(image.rect())
+        selection = self.selectionMask()
+        if selection is not None:
+            region = region.intersected(QRectF(selection.rect))
+        visible = self.mapToScene(self.viewport().rect()).boundingRect().intersected(region).toAlignedRect()
+        if visible.isEmpty():
+            return
+        scale = min(1.0, self.transform().m11())
+        size = QSize(max(1, int(visible.width() * scale)), max(1, int(visible.height() * scale)))
+
+        # The blur radius is in image pixels
+        values = dict(values)
+        values["Gaussian Blur"] = int(values["Gaussian Blur"] * size.width() / visible.width())
+
+        if self._previewAdjustments is None:
+            self._previewAdjustments = AdjustmentStack()
+        self._previewAdjustments.setValues(values)
+        key = (image.cacheKey(), visible.x(), visible.y(), visible.width(), visible.height(), size.width(), size.height())
+        preview = self._previewAdjustments.render(key, lambda: image.copy(visible).scaled(
+            size, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation))
+
+        alpha = selection.alpha() if selection is not None else None
+        if alpha is not None:
+            # Fade the proxy out through the mask, over the layer it then shows like the result
+            x = visible.left() - selection.rect.left()
+            y = visible.top() - selection.rect.top()
+            mask = arrayToImage(np.rint(alpha[y:y + visible.height(), x:x + visible.width()] * 255).astype(np.uint8))
+            mask = imageToArray(mask.scaled(size, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation))
+            faded = preview.toImage().convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+            pixels = imageToArray(faded, writable=True)
+            pixels[...] = np.rint(pixels * (mask[..., :1] / 255.0)).astype(np.uint8)
+            preview = QPixmap.fromImage(faded)
+
+        if self._previewItem is None:
+            # Child of the image: drawn over it but under selections and other overlays
+            self._previewItem = QtWidgets.QGraphicsPixmapItem(preview, self._image)
+        else:
+            self._previewItem.setPixmap(preview)
+        self._previewItem.setPos(QPointF(visible.topLeft()))
+        self._previewItem.setTransform(QtGui.QTransform.fromScale(visible.width() / size.width(), visible.height() / size.height()))
+        self._previewItem.show()
+
+    def hidePreview(self):
+        if self._previewItem is not None:
+            self._previewItem.hide()
+
+    def restoreAdjustments(self):
+        """ Set the adjustment sliders of the current layer to the parameters in the "Slider"
+        history entries after its latest pixels, e.g., after undo, and show the result. A layer
+        that is not rendered with them yet is shown with a preview of them while the parent
+        renders it on the thread pool.
+        """
+        history = self.layerHistory[self.currentLayer]
+        values = AdjustmentStack.defaults()
+        latest = {}
+        for entry in reversed(history):
+            # Other parameters, e.g., a path selection, can be in between
+            if not entry.parameter:
+                break
+            if entry.type == "Slider":
+                latest.setdefault(entry.note, entry.value)
+        values.update(latest)
+
+        self.getCurrentLayerAdjustments().setValues(values)
+        if getattr(self.parent, "UpdateSliders", None):
+            self.parent.UpdateSliders(values)
+
+        renderSliderChange = getattr(self.parent, "renderSliderChange", None)
+        image = self.adjustedLayer(render=renderSliderChange is None)
+        if image is None:
+            self.setImage(self.getCurrentLayerLatestImageBeforeSliderChange(), False)
+            self.previewAdjustments(values)
+            renderSliderChange()
+            return
+
+        if self.layerListDock:
+            self.layerListDock.setButtonImage(image)
+        self.setImage(image, False)
 
     def duplicateCurrentLayer(self):
         if self.currentLayer in self.layerHistory:
             history = self.layerHistory[self.currentLayer]
             if len(history) > 0:
-                latest = history[-1]
+                latest = self.getCurrentLayerLatestImage()
 
                 # Create a new layer with latest as the starting point
-                self.currentLayer = self.numLayersCreated
+                self.setCurrentLayer(self.numLayersCreated)
                 self.numLayersCreated += 1
-                self.layerHistory[self.currentLayer] = []
-                self.addToHistory(latest["pixmap"], "Open", None, None, None)
+                self.layerHistory[self.currentLayer] = QLayerHistory(self.historyPool)
+                self.addToHistory(latest, "Open", None, None, None)
 
-    def setImage(self, image, addToHistory=True, explanationOfChange="", typeOfChange=None, valueOfChange=None, objectOfChange=None):
+    def setImage(self, image, addToHistory=True, explanationOfChange="", typeOfChange=None, valueOfChange=None, objectOfChange=None, changedRect=None):
         """ Set the scene's current image pixmap to the input QImage or QPixmap.
         Raises a RuntimeError if the input image has type other than QImage or QPixmap.
+        The layer history keeps the layer as a QImage, the pixmap is only made for display.
+        changedRect optionally bounds the pixels that differ from the latest history entry.
         :type image: QImage | QPixmap
         """
+        pixmap = None
         if type(image) is QPixmap:
             pixmap = image
         elif type(image) is QImage:
-            pixmap = QPixmap.fromImage(image)
+            pass
         elif (np is not None) and (type(image) is np.ndarray):
             if qimage2ndarray is not None:
-                qimage = qimage2ndarray.array2qimage(image, True)
-                pixmap = QPixmap.fromImage(qimage)
+                image = qimage2ndarray.array2qimage(image, True)
             else:
                 image = image.astype(np.float32)
                 image -= image.min()
@@ -476,100 +777,51 @@ class QtImageViewer(QGraphicsView):
                 image = image.astype(np.uint8)
                 height, width, _ = image.shape
                 bytes = image.tobytes()
-                qimage = QImage(bytes, width, height, QImage.Format.Format_Grayscale8)
-                pixmap = QPixmap.fromImage(qimage)
+                image = QImage(bytes, width, height, QImage.Format.Format_Grayscale8)
         else:
             raise RuntimeError("ImageViewer.setImage: Argument must be a QImage, QPixmap, or numpy.ndarray.")
 
         # Add to layer history
+        # The history keeps the pixels of the image without copying them. QPixmap and QImage are
+        # implicitly shared, so whoever paints into this image later gets a copy of their own.
         if addToHistory:
-            if self.layerListDock:
-                # Update the layer button pixmap to the new 
-                self.layerListDock.setButtonPixmap(pixmap)
-            self.addToHistory(pixmap.copy(), explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
-        
-        ##########################################################################################
-        # Grid for transparent images
-        #########################################################################################
-
-        # https://stackoverflow.com/a/67073067
-        def checkerboard(w, h):
-            from itertools import chain
-            from math import ceil
-            from PIL import Image
-
-            m, n = (int(w / 100), int(h / 100))             # Checker dimension (x, y)
-
-            if m < 100:
-                if m == 0:
-                    m = 1
-                m *= 100/m
-                m = int(m)
-                n = int(m * h / w)
-            elif n < 100:
-                if n == 0:
-                    n = 1
-                n *= 100/n 
-                n = int(n)
-                m = int(n * w / h)
-
-            c1 = (225, 255, 255, 0)                  # First color
-            c2 = (83, 83, 83)                        # Second color
-            mode = 'L' if isinstance(c1, int) else 'RGBA'   # Mode from first color
-
-            # Generate pixel-wise checker, even x dimension
-            if m % 2 == 0:
-                pixels = [[c1, c2] for i in range(int(m/2))] + \
-                         [[c2, c1] for i in range(int(m/2))]
-                pixels = [list(chain(*pixels)) for i in range(ceil(n/2))]
-
-            # Generate pixel-wise checker, odd x dimension
-            else:
-                pixels = [[c1, c2] for i in range(ceil(m*n/2))]
+            # The change was made to the layer as shown, with the adjustment sliders applied.
+            # Keep those in the history under it, undo then brings the sliders back.
+            self.bakeAdjustments()
 
-            # Generate final Pillow-compatible pixel values
-            pixels = list(chain(*pixels))[:(m*n)]
+        # Image before an edit of a known rectangle, the histogram is updated from the difference
+        base = None
+        if addToHistory and changedRect is not None and len(self.layerHistory[self.currentLayer]) > 0:
+            base = self.layerHistory[self.currentLayer].image(-1)
 
-            # Generate Pillow image from pixel values, resize to final image size, and save
-            checker = Image.new(mode, (m, n))
-            checker.putdata(pixels)
-            checker = checker.resize((w, h), Image.NEAREST)
-            return checker
-
-        original = pixmap.copy()
-
-        width = pixmap.width()
-        height = pixmap.height()
+        if addToHistory:
+            self.addToHistory(pixmap if pixmap is not None else image, explanationOfChange, typeOfChange, valueOfChange, objectOfChange, changedRect)
+            image = self.layerHistory[self.currentLayer].image(-1)
+            if self.layerListDock:
+                # Update the layer button to a thumbnail of the new image
+                self.layerListDock.setButtonImage(image)
+        elif pixmap is not None:
+            image = pixmap
 
-        if not self.checkerBoard:
-            self.checkerBoard = checkerboard(width, height)
-            self.checkerBoard = self.ImageToQPixmap(self.checkerBoard)
-        else:
-            if self.checkerBoardHeight != height or self.checkerBoardWidth != width:
-                self.checkerBoard = checkerboard(width, height)
-                self.checkerBoard = self.ImageToQPixmap(self.checkerBoard)
-        if self.checkerBoard:
-            painter = QPainter(pixmap)
-            painter.drawPixmap(QPoint(), self.checkerBoard)
-            painter.drawPixmap(QPoint(), original)
-            painter.end()
-
-        #########################################################################################
-        
+        # The image is drawn in tiles of a mip pyramid, no pixmap of the whole image is needed
+        self.hidePreview()
         if self.hasImage():
-            self._image.setPixmap(pixmap)
+            self._image.setImage(image)
         else:
-            self._image = self.scene.addPixmap(pixmap)
+            self._image = QTiledImageItem(image)
+            self.scene.addItem(self._image)
 
         # Better quality pixmap scaling?
         # !!! This will distort actual pixel data when zoomed way in.
         #     For scientific image analysis, you probably don't want this.
         # self._pixmap.setTransformationMode(Qt.SmoothTransformation)
 
-        self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size.
+        self.setSceneRect(self._image.boundingRect())  # Set scene size to image size.
         self.updateViewer()
         if getattr(self.parent, "UpdateHistogramPlot", None):
-            self.parent.UpdateHistogramPlot()
+            self.parent.UpdateHistogramPlot(changedRect, base)
+        if getattr(self.parent, "UpdateStatusBar", None):
+            self.parent.UpdateStatusBar()
 
     # Nikon NEF raw file
     def read_nef(self, path):
@@ -629,40 +881,6 @@ class QtImageViewer(QGraphicsView):
         """
         self.updateViewer()
 
-    def QPixmapToImage(self, pixmap):
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def QImageToImage(self, qimage):
-        width = qimage.width()
-        height = qimage.height()
-        image = qimage
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def ImageToQPixmap(self, image):
-        return QPixmap.fromImage(ImageQt(image))
-
-    def QImageToCvMat(self, incomingImage):
-        '''  Converts a QImage into an opencv MAT format  '''
-
-        incomingImage = incomingImage.convertToFormat(QtGui.QImage.Format.Format_RGBA8888)
-
-        width = incomingImage.width()
-        height = incomingImage.height()
-
-        ptr = incomingImage.bits()
-        ptr.setsize(height * width * 4)
-        arr = np.frombuffer(ptr, np.uint8).reshape((height, width, 4))
-        return arr
-
     def mousePressEvent(self, event):
         """ Start mouse pan or zoom mode.
         """
@@ -676,6 +894,7 @@ class QtImageViewer(QGraphicsView):
 
         if event.button() == self.regionZoomButton:
             self._isLeftMouseButtonPressed = True
+            self._lastStrokePosition = None
 
         # # Draw ROI
         # if self.drawROI is not None:
@@ -809,6 +1028,8 @@ class QtImageViewer(QGraphicsView):
 
         if event.button() == self.regionZoomButton:
             self._isLeftMouseButtonPressed = False
+            self._lastStrokePosition = None
+            self.endBrushStroke()
 
         if self._isSelectingRect:
             if self._isSelectingRectStarted:
@@ -825,7 +1046,7 @@ class QtImageViewer(QGraphicsView):
                     if zoomPixelWidth > 3 and zoomPixelHeight > 3:
                         if self._selectRect.isValid() and (self._selectRect != self.sceneRect()):
                             # Create a new crop item using user-drawn rectangle
-                            pixmap = self.getCurrentLayerLatestPixmap()
+                            pixmap = self.getCurrentLayerLatestImageBeforeSliderChange()
                             if self._selectRectItem:
                                 self._selectRectItem.setRect(self._selectRect)
                             else:
@@ -981,6 +1202,9 @@ class QtImageViewer(QGraphicsView):
                     self._lastMousePositionInScene = QPointF(self.mapToScene(event.pos()))
                 self.renderCursorOverlay(self._lastMousePositionInScene, self.spotsBrushSize)
             if self._targetSelected:
+                # The result drawn below shows the brush outlines
+                self.hideCursorOverlay()
+
                 # A target has been selected
                 # Show blemish fix around the mouse position
                 # If the user is happy with the result, they will click again and the fix
@@ -990,6 +1214,8 @@ class QtImageViewer(QGraphicsView):
             if self.scene:
                 self._lastMousePositionInScene = QPointF(self.mapToScene(event.pos()))
             self.renderCursorOverlay(self._lastMousePositionInScene, self.blurBrushSize)
+            if self._isLeftMouseButtonPressed:
+                self.blur(event)
 
         scenePos = self.mapToScene(event.pos())
         if self.sceneRect().contains(scenePos):
@@ -1009,6 +1235,7 @@ class QtImageViewer(QGraphicsView):
 
     def leaveEvent(self, event):
         self.setCursor(Qt.CursorShape.ArrowCursor)
+        self.hideCursorOverlay()
 
     def addROIs(self, rois):
         for roi in rois:
@@ -1089,71 +1316,37 @@ class QtImageViewer(QGraphicsView):
         event.accept()
 
     def performColorPick(self, event):
-        currentPixmap = self.getCurrentLayerLatestPixmap()
-        currentImage = self.QPixmapToImage(currentPixmap)
-        pixelAccess = currentImage.load()
+        currentImage = self.getCurrentLayerLatestImage()
         scene_pos = self.mapToScene(event.pos())
         x = scene_pos.x()
         y = scene_pos.y()
-        r, g, b, _ = pixelAccess[x, y]
-        self.ColorPicker.setRGB((r, g, b))
+        color = currentImage.pixelColor(int(x), int(y))
+        self.ColorPicker.setRGB((color.red(), color.green(), color.blue()))
 
     def performPaint(self, event):
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = currentPixmap.toImage()
-        scene_pos = self.mapToScene(event.pos())
-        x = scene_pos.x()
-        y = scene_pos.y()
-        w = currentImage.width()
-        h = currentImage.height()
-
-        brush_size = self.paintBrushSize
-        sample_size = 2 * brush_size
         r, g, b = self.ColorPicker.getRGB()
-
-        # Find neighbor pixels in a circle around (x, y)
-        pixels = []
-        for i in range(int(x - sample_size), int(x + sample_size)):
-            for j in range(int(y - sample_size), int(y + sample_size)):
-                dist = (i - x) * (i - x) + (j - y) * (j - y)
-
-                if dist <= brush_size * brush_size:
-                    # point is inside circle
-
-                    # is the point inside the image?
-                    if i >= 0 and i < w and j >= 0 and j < h:
-                        pixels.append([i, j])
-
-        # For each point, update the pixel by averaging
-        for point in pixels:
-            i, j = point
-            currentImage.setPixelColor(i, j, QtGui.QColor(int(r), int(g), int(b), 255))
-
-        # Update the pixmap
-        self.setImage(currentImage, True, "Paint")
+        self.performBrushStroke(event, self.paintBrushSize, self.paintBrushHardness, "Paint",
+                                functools.partial(stamp, color=(int(r), int(g), int(b))))
 
     def performFill(self, event):
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = self.QPixmapToImage(currentPixmap)
-        pixelAccess = currentImage.load()
+        currentImage = self.getCurrentLayerLatestImage()
         scene_pos = self.mapToScene(event.pos())
-        x = scene_pos.x()
-        y = scene_pos.y()
-
-        # https://stackoverflow.com/questions/8629085/qt-pyqt-other-how-do-i-change-specific-colors-in-a-pixmap
-
-        r, g, b, _ = pixelAccess[x, y]
+        x = int(scene_pos.x())
+        y = int(scene_pos.y())
         cr, cg, cb = self.ColorPicker.getRGB()
 
-        mask = currentPixmap.createMaskFromColor(QtGui.QColor(r, g, b), Qt.MaskMode.MaskOutColor)
-
-        p = QPainter(currentPixmap)
-        p.setPen(QtGui.QColor(int(cr), int(cg), int(cb)))
-        p.drawPixmap(currentPixmap.rect(), mask, mask.rect())
-        p.end()
+        # Fill the region around (x, y) whose colors are within fillTolerance of its color.
+        # Layer images are 32-bit with the pixels stored as 0xAARRGGBB words.
+        pixels = imageToArray(currentImage)
+        rect, mask = floodFill(pixels, x, y, self.fillTolerance, self.fillConnectivity)
+        if rect.isEmpty():
+            return
+        pixels = imageToArray(currentImage, writable=True).view(np.uint32)[..., 0]
+        region = pixels[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        region[mask] = QtGui.QColor(int(cr), int(cg), int(cb)).rgb()
 
         # Update the pixmap
-        self.setImage(currentPixmap, True, "Fill")
+        self.setImage(currentImage, True, "Fill", changedRect=rect)
 
     def exitSelectRect(self):
         # Remove the selected rectangle from the scene
@@ -1189,12 +1382,12 @@ class QtImageViewer(QGraphicsView):
         self.path.quadTo(self.selectPoints[-1], self.selectPoints[-1])
         self.pathSelected.quadTo(self.selectPoints[-1], self.selectPoints[-1])
 
-        currentImage = self.getCurrentLayerLatestPixmap()
-        output = QImage(currentImage.toImage().size(), QImage.Format.Format_ARGB32)
+        currentImage = self.getCurrentLayerLatestImage()
+        output = QImage(currentImage.size(), QImage.Format.Format_ARGB32)
         output.fill(Qt.GlobalColor.transparent)
         painter = QPainter(output)
         painter.setClipPath(self.pathSelected)
-        painter.drawImage(QPoint(), currentImage.toImage())
+        painter.drawImage(QPoint(), currentImage)
         painter.end()
         # To avoid useless transparent background you can crop it like that:
         output = output.copy(self.pathSelected.boundingRect().toRect())
@@ -1221,29 +1414,15 @@ class QtImageViewer(QGraphicsView):
         self.pathItem = None
         self.pathPointItem = None
 
-    def getSelectedRegionAsPixmap(self):
-        self.path.quadTo(self.selectPoints[-1], self.selectPoints[-1])
-        self.pathSelected.quadTo(self.selectPoints[-1], self.selectPoints[-1])
-
-        currentImage = self.getCurrentLayerLatestPixmap()
-        output = QImage(currentImage.toImage().size(), QImage.Format.Format_ARGB32)
-        output.fill(Qt.GlobalColor.transparent)
-        painter = QPainter(output)
-        painter.setClipPath(self.pathSelected)
-        painter.drawImage(QPoint(), currentImage.toImage())
-        painter.end()
-        
-        return QPixmap.fromImage(output)
-
     def performCrop(self):
         try:
             if self._isSelectingRect and self._isSelectingRectStarted:
                 rect = self._selectRectItem.intern_rect.toAlignedRect()
 
-                # Crop the pixmap
-                cropQPixmap = self.getCurrentLayerLatestPixmap().copy(rect)
+                # Crop the layer
+                cropQImage = self.getCurrentLayerLatestImage().copy(rect)
 
-                self.setImage(cropQPixmap, True, "RectCrop")
+                self.setImage(cropQImage, True, "RectCrop")
 
                 self.exitSelectRect()
                 self.clearZoom()
@@ -1258,8 +1437,7 @@ class QtImageViewer(QGraphicsView):
                 if self.currentLayer in self.layerHistory:
                     history = self.layerHistory[self.currentLayer]
                     if len(history) > 1:
-                        history = [h for h in history if h["note"] != "Path Select"]
-                        self.layerHistory[self.currentLayer] = history
+                        history.removeWhere(lambda h: h.note == "Path Select")
             self.parent.DisableAllTools()
         except RuntimeError as e:
             print(e)
@@ -1282,7 +1460,7 @@ class QtImageViewer(QGraphicsView):
         # Create a painter path for the points
         # Add ellipses/circles for each point selected so far
         self.pointPainter = QtGui.QPainterPath()
-        maxDim = max(self._image.pixmap().width(), self._image.pixmap().height())
+        maxDim = max(self._image.boundingRect().width(), self._image.boundingRect().height())
         for point in self.selectPoints:
             squareSide = int(maxDim / 200)
             self.pointPainter.addRect(point.x() - (squareSide / 2), point.y() - (squareSide / 2), squareSide, squareSide)
@@ -1351,7 +1529,7 @@ class QtImageViewer(QGraphicsView):
         self.selectPainterPointPaths.append(self.pathPointItem)
 
         if addToHistory:
-            self.addToHistory(self.pixmap(), "Path Select", "Tool", [self.selectPoints.copy(), self.selectPainterPaths.copy(), self.selectPainterPointPaths.copy()], None)
+            self.addParameterToHistory("Path Select", "Tool", [self.selectPoints.copy(), self.selectPainterPaths.copy(), self.selectPainterPointPaths.copy()], None)
 
     def Luminance(self, pixel):
         return (0.299 * pixel[0] + 0.587 * pixel[1] + 0.114 * pixel[2])
@@ -1360,50 +1538,79 @@ class QtImageViewer(QGraphicsView):
         return abs(self.Luminance(pixel_a) - self.Luminance(pixel_b)) < threshold
     
     def fixBlemish(self, image, source_pos, target_pos, brush_size):
+        """ Heal the spot at target_pos with the texture around source_pos of image, a BGR array.
+        Returns (x, y, fix): the healed window of image with its top left corner at (x, y), or
+        None if either brush does not fit in the image.
+        """
         import cv2
         # Trying to construct a good method to identify a "good" region seems really difficult. 
         # There are multiple factors to consider, such as how big of a search region to include, how to determine proper textured regions vs incorrect near by regions, how to optimize a search, whether to just search until you find one, or try to optimize, etc. 
         # So instead, I will build a tool similar to the Photoshop healing brush tool, where the user manually selects a better region. 
         # Personally, having used photoshop, I actually prefer this method, as it gives the user more control. Plus, since I am more familiar with it, it'll be easier for me to implement.
 
-        image_original = image.copy()
+        height, width = image.shape[:2]
+        for x, y in (source_pos, target_pos):
+            if x - brush_size < 0 or y - brush_size < 0 or x + brush_size > width or y + brush_size > height:
+                return None
+
         # Get ROI
-        clone_source_roi = image_original[source_pos[1]-brush_size:source_pos[1]+brush_size, source_pos[0]-brush_size:source_pos[0]+brush_size]
+        clone_source_roi = np.ascontiguousarray(image[source_pos[1]-brush_size:source_pos[1]+brush_size, source_pos[0]-brush_size:source_pos[0]+brush_size])
         
         # Get mask
         clone_source_mask = np.ones(clone_source_roi.shape, clone_source_roi.dtype) * 255
         # Feather mask
         # clone_source_mask = cv2.GaussianBlur(clone_source_mask, (5, 5), 0, 0)
 
+        # seamlessClone changes only the pixels under the mask and reads the ones just around
+        # it, so cloning into a window around the target gives the same pixels as the full frame
+        margin = 2
+        x0 = max(target_pos[0] - brush_size - margin, 0)
+        y0 = max(target_pos[1] - brush_size - margin, 0)
+        x1 = min(target_pos[0] + brush_size + margin, width)
+        y1 = min(target_pos[1] + brush_size + margin, height)
+        window = np.ascontiguousarray(image[y0:y1, x0:x1])
+
         # Apply clone
-        fix = cv2.seamlessClone(clone_source_roi, image_original, clone_source_mask, target_pos, cv2.NORMAL_CLONE)
-        return fix
-    
-    def showSpotRemovalResultAtMousePosition(self, event):
-        import cv2
+        fix = cv2.seamlessClone(clone_source_roi, window, clone_source_mask, (target_pos[0] - x0, target_pos[1] - y0), cv2.NORMAL_CLONE)
+        return x0, y0, fix
+
+    def getSpotRemovalPixels(self):
+        """ Returns the current layer as B, G, R, A bytes with straight alpha, see
+        getCurrentLayerLatestArray. Kept while the spot removal tool is in use so that moving
+        the mouse does not convert the layer again.
+        """
+        image = self.getCurrentLayerLatestImage()
+        if image is None:
+            return None
+        if self._spotRemovalPixels is None or self._spotRemovalPixels[0] != image.cacheKey():
+            self._spotRemovalPixels = (image.cacheKey(), self.getCurrentLayerLatestArray())
+        return self._spotRemovalPixels[1]
 
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = self.QPixmapToImage(currentPixmap)
-        image_view = np.asarray(currentImage)
+    def exitSpotRemoval(self):
+        self.hideSpotRemovalResult()
+        self._spotRemovalPixels = None
+
+    def showSpotRemovalResultAtMousePosition(self, event):
+        pixels = self.getSpotRemovalPixels()
+        if pixels is None:
+            return
         scenePos = self.mapToScene(event.pos())
         scenePos = (int(scenePos.x()), int(scenePos.y()))
 
-        b, g, r, a = cv2.split(image_view)
-        image_view = np.dstack((b, g, r))
-
         # Show ROI
         # Show target
-        image_view = self.fixBlemish(image_view, scenePos, self._targetPos, self.spotsBrushSize)
-
-        image_view = np.dstack((image_view, a))
-        currentImage = Image.fromarray(image_view).convert("RGBA")
-        blemishFixedPixmap = self.ImageToQPixmap(currentImage)
+        result = self.fixBlemish(pixels[..., :3], scenePos, self._targetPos, self.spotsBrushSize)
+        if result is None:
+            self.hideSpotRemovalResult()
+            return
+        x, y, fix = result
+        alpha = pixels[y:y + fix.shape[0], x:x + fix.shape[1], 3]
+        window = QPixmap.fromImage(arrayToImage(np.dstack((fix, alpha)), QImage.Format.Format_ARGB32))
 
         # Show cursor overlay
-        # pixmapTmp = currentPixmap.copy()
-        cursorPainter = QPainter(blemishFixedPixmap)
-        cursorPainter.drawEllipse(QPointF(self._targetPos[0], self._targetPos[1]), self.spotsBrushSize, self.spotsBrushSize)
-        cursorPainter.drawEllipse(QPointF(scenePos[0], scenePos[1]), self.spotsBrushSize, self.spotsBrushSize)
+        outline = QPainterPath()
+        outline.addEllipse(QPointF(self._targetPos[0], self._targetPos[1]), self.spotsBrushSize, self.spotsBrushSize)
+        outline.addEllipse(QPointF(scenePos[0], scenePos[1]), self.spotsBrushSize, self.spotsBrushSize)
 
         # Draw line
         # Whole bunch of vector code to draw the proper connecting line
@@ -1417,121 +1624,144 @@ class QtImageViewer(QGraphicsView):
             line_vector = v / np.linalg.norm(v)
             # Subtract off the parts that we don't want 
             t = t - line_vector * self.spotsBrushSize
-            t = tuple(t.astype(np.int64))
             m = m + line_vector * self.spotsBrushSize
-            m = tuple(m.astype(np.int64))
-            cursorPainter.drawLine(t[0], t[1], m[0], m[1])
-
-        cursorPainter.end() 
-        self.setImage(blemishFixedPixmap, False, "Cursor Overlay")
+            outline.moveTo(float(t[0]), float(t[1]))
+            outline.lineTo(float(m[0]), float(m[1]))
+
+        # The healed window and the outlines are items over the image, which stays as it is
+        if self._spotResultItem is None:
+            self._spotResultItem = QtWidgets.QGraphicsPixmapItem(self._image)
+            pen = QPen(Qt.GlobalColor.black)
+            pen.setCosmetic(True)
+            self._spotOutlineItem = QtWidgets.QGraphicsPathItem(self._image)
+            self._spotOutlineItem.setPen(pen)
+        self._spotResultItem.setPixmap(window)
+        self._spotResultItem.setPos(x, y)
+        self._spotResultItem.show()
+        self._spotOutlineItem.setPath(outline)
+        self._spotOutlineItem.show()
+
+    def hideSpotRemovalResult(self):
+        if self._spotResultItem is not None:
+            self._spotResultItem.hide()
+            self._spotOutlineItem.hide()
 
     def removeSpots(self, event):
-        import cv2
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = self.QPixmapToImage(currentPixmap)
-        image_view = np.asarray(currentImage)
+        pixels = self.getSpotRemovalPixels()
+        if pixels is None:
+            return
         scenePos = self.mapToScene(event.pos())
         scenePos = (int(scenePos.x()), int(scenePos.y()))
 
-        b, g, r, a = cv2.split(image_view)
-        image_view = np.dstack((b, g, r))
-
-        image_view = self.fixBlemish(image_view, scenePos, self._targetPos, self.spotsBrushSize)
-
-        image_view = np.dstack((image_view, a))
-        currentImage = Image.fromarray(image_view).convert("RGBA")
-
-        # Update the pixmap
-        updatedPixmap = self.ImageToQPixmap(currentImage)
-        self.setImage(updatedPixmap, True, "Spot Removal")
+        result = self.fixBlemish(pixels[..., :3], scenePos, self._targetPos, self.spotsBrushSize)
+        self.hideSpotRemovalResult()
         self._targetSelected = False
         self._targetPos = None
+        if result is None:
+            return
+        x, y, fix = result
+
+        # Update the layer in its own format. The writable view detaches it from the history
+        # once, only the healed window is written
+        updatedImage = self.getCurrentLayerLatestImage()
+        if updatedImage.format() not in (QImage.Format.Format_RGB32, QImage.Format.Format_ARGB32, QImage.Format.Format_ARGB32_Premultiplied):
+            updatedImage = updatedImage.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        window = imageToArray(updatedImage, writable=True)[y:y + fix.shape[0], x:x + fix.shape[1]]
+        if updatedImage.format() == QImage.Format.Format_ARGB32_Premultiplied:
+            # fix has straight alpha
+            fix = np.rint(fix * (window[..., 3:] / 255.0)).astype(np.uint8)
+        window[..., :3] = fix
+        self.setImage(updatedImage, True, "Spot Removal", changedRect=QRect(x, y, fix.shape[1], fix.shape[0]))
 
         return
         
     def blur(self, event):
-        brush_size = self.blurBrushSize
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = self.QPixmapToImage(currentPixmap)
-        scene_pos = self.mapToScene(event.pos())
-        x = scene_pos.x()
-        y = scene_pos.y()
-
-        # Make a mask the same size as the image filled with black
-        mask = Image.new('L',currentImage.size)
-
-        # Draw a filled white circle onto the black mask
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse([x - brush_size, y - brush_size, x + brush_size, y + brush_size],fill=255)
-
-        # Blur the entire image
-        blurred = currentImage.filter(ImageFilter.BLUR)
-
-        # Composite blurred image over sharp one within mask
-        currentImage = Image.composite(blurred, currentImage, mask)
-
-        # Update the pixmap
-        updatedPixmap = self.ImageToQPixmap(currentImage)
-        self.setImage(updatedPixmap, True, "Blur")
-        # self.OriginalImage = updatedPixmap
+        self.performBrushStroke(event, self.blurBrushSize, self.blurBrushHardness, "Blur", blurStamp)
 
     def performErase(self, event):
-        currentPixmap = self.getCurrentLayerLatestPixmap().copy()
-        currentImage = currentPixmap.toImage()
+        self.performBrushStroke(event, self.eraserBrushSize, self.eraserBrushHardness, "Eraser", stamp, transparent=True)
 
-        # First convert to a format that supports transparency
-        # https://stackoverflow.com/questions/16910905/set-alpha-channel-per-pixel-in-qimage
-        currentImage = currentImage.convertToFormat(QImage.Format.Format_ARGB32)
+    def performBrushStroke(self, event, brushSize, hardness, explanation, stampFunction, transparent=False):
+        """ Stamp the brush from the previous mouse position of the stroke to the current one.
+        stampFunction(pixels, positions, mask) applies the stamps and returns the changed QRect
+        (see QBrushEngine). transparent strokes need a layer with an alpha channel. The stroke
+        is painted into a copy of the layer and added to the history as one entry by endBrushStroke.
+        """
+        if self._strokeImage is not None and self._strokeExplanation != explanation:
+            # Another tool started without a mouse release in between
+            self.endBrushStroke()
+            self._lastStrokePosition = None
+
+        if self._strokeImage is None:
+            currentImage = self.getCurrentLayerLatestImage()
+            if currentImage is None:
+                return
 
-        scene_pos = self.mapToScene(event.pos())
-        x = scene_pos.x()
-        y = scene_pos.y()
-        w = currentImage.width()
-        h = currentImage.height()
+            # Blend in premultiplied alpha. Opaque layers can stay RGB32 for painting and
+            # blurring, erasing needs a format that supports transparency
+            if transparent or currentImage.format() != QImage.Format.Format_RGB32:
+                currentImage = currentImage.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
 
-        brush_size = self.eraserBrushSize
-        sample_size = 2 * brush_size
+            # The writable view detaches the stroke from the history, once per stroke. The
+            # displayed item shares the pixels with it from here on and sees every stamp
+            self._strokePixels = imageToArray(currentImage, writable=True)
+            self._strokeImage = currentImage
+            self._strokeDirty = QRect()
+            self._strokeExplanation = explanation
+            self.hidePreview()
+            self._image.setImage(currentImage)
 
-        # Find neighbor pixels in a circle around (x, y)
-        pixels = []
-        for i in range(int(x - sample_size), int(x + sample_size)):
-            for j in range(int(y - sample_size), int(y + sample_size)):
-                dist = (i - x) * (i - x) + (j - y) * (j - y)
+        scenePos = self.mapToScene(event.pos())
+        end = (scenePos.x(), scenePos.y())
+        positions = stampPositions(self._lastStrokePosition, end, brushSize * self.brushSpacing)
+        self._lastStrokePosition = end
 
-                if dist <= brush_size * brush_size:
-                    # point is inside circle
+        mask = brushMask(brushSize, hardness)
+        dirty = stampFunction(self._strokePixels, positions, mask)
+        if dirty.isEmpty():
+            return
+        self._strokeDirty = self._strokeDirty.united(dirty)
+        self._image.updateRect(dirty)
 
-                    # is the point inside the image?
-                    if i >= 0 and i < w and j >= 0 and j < h:
-                        pixels.append([i, j])
+    def endBrushStroke(self):
+        """ Add the brush stroke in progress to the layer history as a single entry that
+        compares only the pixels the stroke changed.
+        """
+        if self._strokeImage is None:
+            return
+        image = self._strokeImage
+        dirty = self._strokeDirty
+        self._strokeImage = None
+        self._strokePixels = None
+        self._strokeDirty = QRect()
 
-        # For each point, update the pixel by averaging
-        for point in pixels:
-            i, j = point
-            color = QtGui.QColor(255, 255, 255, 0)
-            rgba = color.rgba()
-            currentImage.setPixel(i, j, rgba)
+        if dirty.isEmpty():
+            return
+        self.setImage(image, True, self._strokeExplanation, changedRect=dirty)
 
-        # Update the pixmap
-        self.setImage(currentImage, True, "Eraser")
-    
     def renderCursorOverlay(self, scenePosition, brushSize):
-        pixmap = self.getCurrentLayerLatestPixmap()
-
-        if pixmap:
-            pixmapTmp = pixmap.copy()
-            cursorPainter = QPainter()
-            cursorPainter.begin(pixmapTmp)
+        """ Show the brush outline of brushSize around scenePosition. The outline is an item
+        of its own that moves over the image, the image is not redrawn.
+        """
+        if not self.hasImage():
+            return
+        if self._cursorItem is None:
             brush = QtGui.QBrush()
             brush.setColor(QtGui.QColor(255, 0, 0, 127))
             brush.setStyle(QtCore.Qt.BrushStyle.SolidPattern)
-            pen = QtGui.QPen()
-            pen.setBrush(brush)
-            cursorPainter.setBrush(brush)
-            cursorPainter.setPen(pen)
-            cursorPainter.drawEllipse(scenePosition, brushSize, brushSize)
-            cursorPainter.end() 
-            self.setImage(pixmapTmp, False, "Cursor Overlay")
+            pen = QtGui.QPen(QtGui.QColor(255, 0, 0, 127))
+            pen.setCosmetic(True)
+            self._cursorItem = QGraphicsEllipseItem()
+            self._cursorItem.setBrush(brush)
+            self._cursorItem.setPen(pen)
+            self._cursorItem.setZValue(1)
+            self.scene.addItem(self._cursorItem)
+        self._cursorItem.setRect(scenePosition.x() - brushSize, scenePosition.y() - brushSize, 2 * brushSize, 2 * brushSize)
+        self._cursorItem.show()
+
+    def hideCursorOverlay(self):
+        if self._cursorItem is not None:
+            self._cursorItem.hide()
 
     def paintEvent(self, event):
         if self._isCropping:
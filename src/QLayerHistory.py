@@ -0,0 +1,547 @@
+""" QLayerHistory.py: Memory-budgeted undo history for the layers of QtImageViewer.
+
+Every edit used to store a full copy of the layer pixmap, so a 45 MP photo cost ~180 MB per
+brush stroke. Here only some entries keep a full frame (a keyframe); all other entries keep
+the tiles that changed with respect to the previous entry together with their position.
+
+    - The first entry of a layer, and any entry that changes the image size or pixel format (crop, rotate,
+      stack, super-resolution) or most of its pixels, is an "anchor": a keyframe that
+      cannot be dropped.
+    - Every keyframeInterval entries an additional keyframe is kept so that reconstructing
+      an old entry never has to replay more than a handful of deltas. These keyframes are
+      a cache and are evicted least-recently-used first when the pool runs over budget.
+    - Before anything is dropped, the coldest entries are moved to a memory-mapped scratch
+      file (see QHistorySpill) and paged back in when they are needed again.
+    - If the history is still over budget with all optional keyframes evicted, the oldest
+      undo steps are folded into the first remaining entry.
+"""
+
+import itertools
+import weakref
+
+import numpy as np
+from PyQt6.QtCore import QRect
+from PyQt6.QtGui import QImage, QPixmap, QPainter
+
+from QHistorySpill import QHistorySpill
+from QImageBuffer import imageToArray
+
+
+class QHistoryPool:
+    """ Byte budget shared by the histories of all layers of one viewer.
+
+    budgetBytes limits the history kept in memory, spillBudgetBytes the history moved to the
+    scratch file. Set spillBudgetBytes to 0 to never touch the disk.
+    """
+
+    # Default budget for all undo histories of a viewer, in bytes.
+    defaultBudgetBytes = 1024 * 1024 * 1024
+    defaultSpillBudgetBytes = 8 * 1024 * 1024 * 1024
+
+    def __init__(self, budgetBytes=None, spillBudgetBytes=None, spillDirectory=None):
+        self.budgetBytes = budgetBytes if budgetBytes is not None else QHistoryPool.defaultBudgetBytes
+        self.spillBudgetBytes = spillBudgetBytes if spillBudgetBytes is not None else QHistoryPool.defaultSpillBudgetBytes
+        self.spillDirectory = spillDirectory
+        self.spill = None
+        self._histories = weakref.WeakSet()
+        self._clock = itertools.count()
+
+    def register(self, history):
+        self._histories.add(history)
+
+    def tick(self):
+        """ Returns a monotonically increasing counter used to order keyframe use.
+        """
+        return next(self._clock)
+
+    def usedBytes(self):
+        """ Bytes of history held in memory.
+        """
+        return sum(history.usedBytes() for history in self._histories)
+
+    def spilledBytes(self):
+        """ Bytes of history moved to the scratch file.
+        """
+        return sum(history.spilledBytes() for history in self._histories)
+
+    def report(self):
+        return "History: {:.1f} MB in memory, {:.1f} MB on disk".format(
+            self.usedBytes() / (1024 * 1024), self.spilledBytes() / (1024 * 1024))
+
+    def setBudget(self, budgetBytes, spillBudgetBytes=None):
+        self.budgetBytes = budgetBytes
+        if spillBudgetBytes is not None:
+            self.spillBudgetBytes = spillBudgetBytes
+        self.enforceBudget()
+
+    def close(self):
+        """ Delete the scratch file. Histories must not be used afterwards.
+        """
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+    def enforceBudget(self):
+        used = self.usedBytes()
+        while used > self.budgetBytes:
+            # Move the coldest entry of any layer to the scratch file
+            if self.spillBudgetBytes > 0 and (self.spill is None or self.spill.usedBytes() < self.spillBudgetBytes):
+                candidates = [h for h in self._histories if h.hasSpillableEntry()]
+                if candidates:
+                    if self.spill is None:
+                        self.spill = QHistorySpill(self.spillDirectory)
+                    history = min(candidates, key=lambda h: h.coldestEntryTick())
+                    used -= history.spillColdestEntry()
+                    continue
+
+            # Evict the least recently used optional keyframe of any layer
+            candidates = [h for h in self._histories if h.hasEvictableKeyframe()]
+            if candidates:
+                history = min(candidates, key=lambda h: h.oldestKeyframeTick())
+                used -= history.evictOldestKeyframe()
+                continue
+
+            # Fold the oldest undo step of the largest history
+            candidates = [h for h in self._histories if len(h) > 1]
+            if not candidates:
+                break
+            history = max(candidates, key=lambda h: h.usedBytes())
+            used -= history.dropOldest()
+
+
+class HistoryEntry:
+    """ One step of a layer history.
+
+    note         : "Crop"
+    type         : "Tool" or "Slider"
+    value        : None or some value e.g., 10
+    object       : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
+    keyframe     : Full QImage or None
+    anchor       : True if the keyframe cannot be rebuilt from older entries
+    tiles        : List of (x, y, QImage) changed with respect to the previous entry
+    spilled      : True if the QImages above were replaced by QHistorySpill handles
+    tick         : Pool clock when the entry was last used, for LRU decisions
+    position     : Position of the entry counted from the first entry ever added to the layer
+    noteRunStart : Position of the first entry of the run of consecutive entries with this note
+    typeRunStart : Position of the first entry of the run of consecutive entries with this type
+    parameter    : True if the entry only holds a parameter and no pixels, see appendParameter
+    """
+
+    __slots__ = ("note", "type", "value", "object", "keyframe", "anchor", "tiles", "spilled", "tick",
+                 "position", "noteRunStart", "typeRunStart", "parameter")
+
+    def __init__(self, note, type=None, value=None, object=None):
+        self.note = note
+        self.type = type
+        self.value = value
+        self.object = object
+        self.keyframe = None
+        self.anchor = False
+        self.tiles = None
+        self.spilled = False
+        self.tick = 0
+        self.position = 0
+        self.noteRunStart = 0
+        self.typeRunStart = 0
+        self.parameter = False
+
+
+class QLayerHistory:
+    """ Undo history of a single layer: a list of HistoryEntry.
+
+    Use image(i) or pixmap(i) to get the layer as it was after entry i.
+    """
+
+    # Store an optional keyframe after this many delta entries
+    keyframeInterval = 8
+
+    # Edge length of the square tiles used to find changed regions
+    tileSize = 128
+
+    # Changes touching more than this fraction of the image are stored as anchors
+    maxDeltaFraction = 0.5
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else QHistoryPool()
+        self.pool.register(self)
+        self._entries = []
+
+        # Position of self._entries[0], advanced when old entries are folded away
+        self._first = 0
+
+        self._bytes = 0
+        self._spilledBytes = 0
+        self._sinceKeyframe = 0
+
+        # Optional keyframe entries in least recently used order: id(entry) -> entry
+        self._lru = {}
+
+        # Latest image, the state of the layer the tools work on, and a pixmap of it for display
+        self._head = None
+        self._headPixmap = None
+
+        # Adjustment slider parameters of the layer, see AdjustmentStack
+        self.adjustments = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def usedBytes(self):
+        return self._bytes
+
+    def spilledBytes(self):
+        return self._spilledBytes
+
+    def append(self, image, explanationOfChange, typeOfChange=None, valueOfChange=None, objectOfChange=None, region=None):
+        """ Add a new entry with image (QImage or QPixmap) as the state of the layer after the change.
+        region is an optional QRect outside of which image is known to equal the latest entry,
+        e.g., the dirty rectangle of a brush stroke. Only pixels inside it are compared.
+        """
+        pixmap = None
+        if type(image) is QPixmap:
+            # Shares the pixels of the pixmap, no copy is made
+            pixmap = image
+            image = image.toImage()
+        if image.format() not in _formats:
+            image = image.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        else:
+            # Our own QImage sharing the pixels: the caller painting into theirs detaches it
+            image = QImage(image)
+
+        entry = self._newEntry(explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
+
+        previous = self._latestImage() if len(self._entries) else None
+        tiles = None
+        if previous is not None and previous.size() == image.size() and previous.format() == image.format():
+            tiles = self._changedTiles(previous, image, region)
+
+        if tiles is None:
+            self._setKeyframe(entry, image, anchor=True)
+        else:
+            entry.tiles = tiles
+            self._bytes += sum(tile.sizeInBytes() for _, _, tile in tiles)
+            self._sinceKeyframe += 1
+            if self._sinceKeyframe >= self.keyframeInterval:
+                self._setKeyframe(entry, image, anchor=False)
+
+        self._entries.append(entry)
+        self._head = image
+        self._headPixmap = pixmap
+        self.pool.enforceBudget()
+
+    def appendParameter(self, explanationOfChange, typeOfChange=None, valueOfChange=None, objectOfChange=None):
+        """ Add a new entry that leaves the pixels of the layer as they are, e.g., a slider
+        parameter that is applied when the layer is rendered. No image is stored for it.
+        """
+        entry = self._newEntry(explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
+        entry.tiles = []
+        entry.parameter = True
+        self._entries.append(entry)
+
+    def lastIndexWithNoteOtherThan(self, note):
+        """ Returns the index of the latest entry whose note is not note, or None.
+        """
+        if not self._entries:
+            return None
+        latest = self._entries[-1]
+        if latest.note != note:
+            return len(self._entries) - 1
+        return self._indexOf(latest.noteRunStart - 1)
+
+    def lastIndexWithTypeOtherThan(self, type):
+        """ Returns the index of the latest entry whose type is not type, or None.
+        """
+        if not self._entries:
+            return None
+        latest = self._entries[-1]
+        if latest.type != type:
+            return len(self._entries) - 1
+        return self._indexOf(latest.typeRunStart - 1)
+
+    def truncate(self, length):
+        """ Remove every entry from index length onwards.
+        """
+        # Parameter entries leave the pixels as they are, the latest image stays valid without them
+        changesPixels = not all(entry.parameter for entry in self._entries[max(length, 0):])
+        while len(self._entries) > max(length, 0):
+            self._release(self._entries.pop())
+        if changesPixels:
+            self._head = None
+            self._headPixmap = None
+        self._sinceKeyframe = 0
+        for entry in reversed(self._entries):
+            if entry.keyframe is not None:
+                break
+            self._sinceKeyframe += 1
+
+    def pop(self):
+        entry = self._entries[-1]
+        self.truncate(len(self._entries) - 1)
+        return entry
+
+    def clear(self):
+        self.truncate(0)
+
+    def suspend(self):
+        """ Drop the cached latest image, e.g., when the layer is no longer displayed,
+        so that its memory can be reclaimed. It is rebuilt on the next access.
+        """
+        self._head = None
+        self._headPixmap = None
+
+    def removeWhere(self, predicate):
+        """ Remove all entries for which predicate(entry) is true, keeping the images of the others.
+        Parameter entries stay parameter entries.
+        """
+        if not any(predicate(entry) for entry in self._entries):
+            return
+        kept = [(entry, None if entry.parameter else self.image(i)) for i, entry in enumerate(self._entries) if not predicate(entry)]
+        self.clear()
+        for entry, image in kept:
+            if entry.parameter:
+                self.appendParameter(entry.note, entry.type, entry.value, entry.object)
+            else:
+                self.append(image, entry.note, entry.type, entry.value, entry.object)
+
+    def image(self, index):
+        """ Returns the layer after entry index as a QImage.
+        """
+        index = range(len(self._entries))[index]
+        if index == len(self._entries) - 1:
+            return self._latestImage()
+        return self._reconstruct(index)
+
+    def pixmap(self, index):
+        """ Returns the layer after entry index as a QPixmap.
+        """
+        index = range(len(self._entries))[index]
+        if index == len(self._entries) - 1:
+            if self._headPixmap is None:
+                self._headPixmap = QPixmap.fromImage(self._latestImage())
+            return self._headPixmap
+        return QPixmap.fromImage(self._reconstruct(index))
+
+    def hasEvictableKeyframe(self):
+        return len(self._lru) > 0
+
+    def oldestKeyframeTick(self):
+        return next(iter(self._lru.values())).tick
+
+    def evictOldestKeyframe(self):
+        """ Drop the least recently used optional keyframe. Returns the number of bytes freed in memory.
+        """
+        entry = self._lru.pop(next(iter(self._lru)))
+        before = self._bytes
+        self._releaseImage(entry.keyframe)
+        entry.keyframe = None
+        return before - self._bytes
+
+    def hasSpillableEntry(self):
+        return self.coldestEntryTick() is not None
+
+    def coldestEntryTick(self):
+        ticks = [entry.tick for entry in self._spillable()]
+        return min(ticks) if ticks else None
+
+    def spillColdestEntry(self):
+        """ Move the least recently used entry to the scratch file. Returns the number of bytes freed in memory.
+        """
+        entry = min(self._spillable(), key=lambda e: e.tick)
+        spill = self.pool.spill
+        before = self._bytes
+        if entry.keyframe is not None:
+            entry.keyframe = self._spillImage(spill, entry.keyframe)
+        if entry.tiles:
+            entry.tiles = [(x, y, self._spillImage(spill, tile)) for x, y, tile in entry.tiles]
+        entry.spilled = True
+        return before - self._bytes
+
+    def dropOldest(self):
+        """ Fold the oldest entry into the next one. Returns the number of bytes freed.
+        """
+        before = self._bytes
+        first = self._entries[0]
+        second = self._entries[1]
+        if second.keyframe is None:
+            self._setKeyframe(second, self._reconstruct(1), anchor=True)
+        else:
+            self._lru.pop(id(second), None)
+            second.anchor = True
+        self._release(first)
+        for _, _, tile in second.tiles or []:
+            self._releaseImage(tile)
+        second.tiles = None
+        second.spilled = not isinstance(second.keyframe, QImage)
+        del self._entries[0]
+        self._first += 1
+        return before - self._bytes
+
+    def _newEntry(self, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
+        entry = HistoryEntry(explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
+        entry.tick = self.pool.tick()
+        entry.position = self._first + len(self._entries)
+        entry.noteRunStart = entry.position
+        entry.typeRunStart = entry.position
+        if self._entries:
+            latest = self._entries[-1]
+            if latest.note == entry.note:
+                entry.noteRunStart = latest.noteRunStart
+            if latest.type == entry.type:
+                entry.typeRunStart = latest.typeRunStart
+        return entry
+
+    def _indexOf(self, position):
+        index = position - self._first
+        return index if index >= 0 else None
+
+    def _spillable(self):
+        # The latest entry shares its pixels with the displayed image, spilling it frees nothing
+        return [entry for entry in self._entries[:-1]
+                if not entry.spilled and (entry.keyframe is not None or entry.tiles)]
+
+    def _latestImage(self):
+        if self._head is None:
+            # The latest entry is about to be edited or displayed again: page it back in
+            self._head = self._reconstruct(len(self._entries) - 1, pageIn=True)
+        return self._head
+
+    def _reconstruct(self, index, pageIn=False):
+        base = index
+        while self._entries[base].keyframe is None:
+            base -= 1
+        for entry in self._entries[base:index + 1]:
+            self._touch(entry)
+            if pageIn and entry.spilled:
+                self._pageIn(entry)
+        image = self._load(self._entries[base].keyframe)
+        if base == index:
+            return image
+
+        image = image.copy()
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+        for entry in self._entries[base + 1:index + 1]:
+            for x, y, tile in entry.tiles:
+                painter.drawImage(x, y, self._load(tile))
+        painter.end()
+        return image
+
+    def _pageIn(self, entry):
+        if entry.keyframe is not None:
+            entry.keyframe = self._pageInImage(entry.keyframe)
+        if entry.tiles:
+            entry.tiles = [(x, y, self._pageInImage(tile)) for x, y, tile in entry.tiles]
+        entry.spilled = False
+
+    def _load(self, item):
+        """ Returns a stored image as QImage, reading it from the scratch file if it was spilled.
+        """
+        if isinstance(item, QImage):
+            return item
+        return self.pool.spill.load(item)
+
+    def _spillImage(self, spill, image):
+        handle = spill.store(image)
+        self._bytes -= image.sizeInBytes()
+        self._spilledBytes += spill.sizeOf(handle)
+        return handle
+
+    def _pageInImage(self, item):
+        if isinstance(item, QImage):
+            return item
+        image = self.pool.spill.load(item)
+        self._releaseImage(item)
+        self._bytes += image.sizeInBytes()
+        return image
+
+    def _releaseImage(self, item):
+        if isinstance(item, QImage):
+            self._bytes -= item.sizeInBytes()
+        else:
+            self._spilledBytes -= self.pool.spill.sizeOf(item)
+            self.pool.spill.release(item)
+
+    def _changedTiles(self, previous, image, region=None):
+        """ Returns the changed regions of image as (x, y, QImage) tiles,
+        or None if the change is too large to be worth storing as a delta.
+        Only the tiles intersecting region are compared if it is given.
+        """
+        width = image.width()
+        height = image.height()
+        size = self.tileSize
+
+        rows = -(-height // size)
+        cols = -(-width // size)
+        grid = np.zeros((rows, cols), dtype=bool)
+
+        region = image.rect() if region is None else region.intersected(image.rect())
+        if not region.isEmpty():
+            # Compare the tiles the region touches
+            top = region.top() // size
+            left = region.left() // size
+            bottom = region.bottom() // size + 1
+            right = region.right() // size + 1
+            x0, y0 = left * size, top * size
+            x1, y1 = min(right * size, width), min(bottom * size, height)
+
+            changed = _pixels(previous)[y0:y1, x0:x1] != _pixels(image)[y0:y1, x0:x1]
+            padded = np.zeros(((bottom - top) * size, (right - left) * size), dtype=bool)
+            padded[:y1 - y0, :x1 - x0] = changed
+            grid[top:bottom, left:right] = padded.reshape(bottom - top, size, right - left, size).any(axis=(1, 3))
+
+        if grid.sum() > self.maxDeltaFraction * rows * cols:
+            return None
+
+        # Merge horizontal runs of changed tiles into a single rectangle
+        tiles = []
+        for row in range(rows):
+            col = 0
+            while col < cols:
+                if not grid[row, col]:
+                    col += 1
+                    continue
+                start = col
+                while col < cols and grid[row, col]:
+                    col += 1
+                rect = QRect(start * size, row * size, (col - start) * size, size).intersected(image.rect())
+                tiles.append((rect.x(), rect.y(), image.copy(rect)))
+        return tiles
+
+    def _setKeyframe(self, entry, image, anchor):
+        entry.keyframe = image
+        entry.anchor = anchor
+        self._bytes += image.sizeInBytes()
+        self._sinceKeyframe = 0
+        if not anchor:
+            self._touch(entry)
+
+    def _touch(self, entry):
+        entry.tick = self.pool.tick()
+        if entry.keyframe is not None and not entry.anchor:
+            self._lru.pop(id(entry), None)
+            self._lru[id(entry)] = entry
+
+    def _release(self, entry):
+        self._lru.pop(id(entry), None)
+        if entry.keyframe is not None:
+            self._releaseImage(entry.keyframe)
+            entry.keyframe = None
+        for _, _, tile in entry.tiles or []:
+            self._releaseImage(tile)
+        entry.tiles = None
+
+
+# Formats stored as they are. Pixmaps hand out RGB32 or ARGB32_Premultiplied images.
+_formats = (QImage.Format.Format_RGB32, QImage.Format.Format_ARGB32, QImage.Format.Format_ARGB32_Premultiplied)
+
+
+def _pixels(image):
+    """ Returns the pixels of a 32-bit QImage as a (height, width) uint32 array without copying.
+    """
+    return imageToArray(image).view(np.uint32)[..., 0]
@@ -3,6 +3,10 @@ from PyQt6.QtCore import Qt
 from QFlowLayout import QFlowLayout
 
 class QLayerList(QtWidgets.QDockWidget):
+
+    # Largest icon of a layer button, see setButtonImage
+    iconSize = QtCore.QSize(100, 100)
+
     def __init__(self, title, parent):
         super(QLayerList, self).__init__(title, parent)
 
@@ -26,14 +30,14 @@ class QLayerList(QtWidgets.QDockWidget):
         
         selectedLayerIndex = button.objectName().split("Layer ")[-1]
         selectedLayerIndex = int(selectedLayerIndex)
-        self.parent.image_viewer.currentLayer = selectedLayerIndex
+        self.parent.image_viewer.setCurrentLayer(selectedLayerIndex)
         for lb in self.layerButtons:
             if lb.objectName() == button.objectName():
                 lb.setChecked(True)
                 lb.setStyleSheet("background-color: rgb(22, 22, 22);")
                 self.currentButton = lb
-                pixmap = self.parent.image_viewer.getCurrentLayerLatestPixmap()
-                self.parent.image_viewer.setImage(pixmap, False)
+                image = self.parent.image_viewer.getCurrentLayerLatestImage()
+                self.parent.image_viewer.setImage(image, False)
             else:
                 lb.setChecked(False)
                 lb.setIconSize(QtCore.QSize(50, 50))
@@ -60,11 +64,11 @@ class QLayerList(QtWidgets.QDockWidget):
         self.currentButton.setStyleSheet("background-color: rgb(44, 44, 44);")
 
         self.currentLayer = self.parent.image_viewer.currentLayer
-        pixmap = self.parent.getCurrentLayerLatestPixmap()
+        icon = self.thumbnail(self.parent.image_viewer.getCurrentLayerLatestImage())
 
         button = QtWidgets.QToolButton(self)
         button.setText("Layer " + str(self.currentLayer + 1))
-        button.setIcon(QtGui.QIcon(pixmap))
+        button.setIcon(QtGui.QIcon(icon))
         button.setIconSize(QtCore.QSize(100, 100))
         button.setMinimumHeight(50)
         button.setMinimumWidth(180)
@@ -116,9 +120,9 @@ class QLayerList(QtWidgets.QDockWidget):
                                 self.currentButton = nextLayer
                                 self.currentButton.setIconSize(QtCore.QSize(100, 100))
                                 self.currentButton.setStyleSheet("background-color: rgb(22, 22, 22);")
-                                self.parent.image_viewer.currentLayer = nextLayerIndex
-                                pixmap = self.parent.image_viewer.getCurrentLayerLatestPixmap()
-                                self.parent.image_viewer.setImage(pixmap, False)
+                                self.parent.image_viewer.setCurrentLayer(nextLayerIndex)
+                                image = self.parent.image_viewer.getCurrentLayerLatestImage()
+                                self.parent.image_viewer.setImage(image, False)
                                 del self.parent.image_viewer.layerHistory[layerIndex]
                     else:
                         newLayerButtons.append(l)
@@ -128,7 +132,7 @@ class QLayerList(QtWidgets.QDockWidget):
     def init(self):
         self.numLayers = self.getNumberOfLayers()
         self.currentLayer = self.parent.image_viewer.currentLayer
-        pixmap = self.parent.getCurrentLayerLatestPixmap()
+        icon = self.thumbnail(self.parent.image_viewer.getCurrentLayerLatestImage())
 
         if not self.currentButton:
             titleBar = QtWidgets.QWidget()
@@ -165,7 +169,7 @@ class QLayerList(QtWidgets.QDockWidget):
         for i in range(self.numLayers):
             button = QtWidgets.QToolButton(self)
             button.setText("Layer " + str(i + 1))
-            button.setIcon(QtGui.QIcon(pixmap))
+            button.setIcon(QtGui.QIcon(icon))
             button.setIconSize(QtCore.QSize(100, 100))
             button.setMinimumHeight(50)
             # button.setMinimumWidth(180)
@@ -188,5 +192,20 @@ class QLayerList(QtWidgets.QDockWidget):
     def update(self):
         self.init()
 
-    def setButtonPixmap(self, pixmap):
-        self.currentButton.setIcon(QtGui.QIcon(pixmap))
\ No newline at end of file
+    def setButtonImage(self, image):
+        """ Show image, the current layer as a QImage or QPixmap, on its button.
+        """
+        self.currentButton.setIcon(QtGui.QIcon(self.thumbnail(image)))
+
+    @staticmethod
+    def thumbnail(image):
+        """ Returns image (a QImage or QPixmap) scaled down to the icon size as a QPixmap. An
+        icon of the whole layer would keep a full-size pixmap alive for every edit.
+        """
+        if image is None:
+            return QtGui.QPixmap()
+        thumbnail = image.scaled(QLayerList.iconSize, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        if isinstance(thumbnail, QtGui.QImage):
+            thumbnail = QtGui.QPixmap.fromImage(thumbnail)
+        return thumbnail
\ No newline at end of file
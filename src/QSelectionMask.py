@@ -0,0 +1,111 @@
+""" QSelectionMask.py: The selected part of a layer as a bounding rectangle and an alpha mask over it.
+
+With a selection active, tools used to process a copy of the whole selection, or for a path
+selection a full-size image clipped by the path, and then paint the result back over the whole
+layer. A QSelectionMask bounds the selection by the rectangle of pixels it can change, clipped
+to the image, so that a tool processes only crop(image) and blend puts the result back through
+the mask. The mask is rendered antialiased and feathered once per selection, on first use; a
+rectangle selection without feathering needs no mask at all.
+"""
+
+import math
+
+import numpy as np
+from PIL import Image, ImageFilter
+from PyQt6.QtCore import Qt, QRect, QRectF
+from PyQt6.QtGui import QImage, QPainter, QPainterPath
+
+from QImageBuffer import imageToArray
+
+
+class QSelectionMask:
+
+    def __init__(self, imageSize, rect=None, path=None, feather=0):
+        """ Selection of an image of imageSize (a QSize): rect (a QRectF or QRect) or path (a
+        QPainterPath), both in image pixels. feather is the radius in pixels over which the
+        edge of the selection fades out.
+        """
+        self.imageSize = imageSize
+        self.feather = max(0.0, float(feather))
+        self.isRectangle = path is None
+
+        if path is None:
+            path = QPainterPath()
+            path.addRect(QRectF(rect))
+        self.path = path
+
+        # Pixels the feathered edge reaches beyond the path
+        self._reach = int(math.ceil(3 * self.feather)) + 1 if self.feather > 0 else 0
+        bounds = path.boundingRect().toAlignedRect()
+        self._bounds = bounds.adjusted(-self._reach, -self._reach, self._reach, self._reach)
+        self.rect = self._bounds.intersected(QRect(0, 0, imageSize.width(), imageSize.height()))
+        self._alpha = None
+
+    def key(self):
+        """ Returns a hashable identity of the selection, for caches of results.
+        """
+        elements = tuple((e.x, e.y) for e in (self.path.elementAt(i) for i in range(self.path.elementCount())))
+        return (self.rect.x(), self.rect.y(), self.rect.width(), self.rect.height(), self.feather) + elements
+
+    def isEmpty(self):
+        return self.rect.isEmpty()
+
+    def alpha(self):
+        """ Returns the coverage of the selection over rect as a read-only (height, width)
+        float32 array in [0, 1], or None if rect is selected as a whole.
+        """
+        if self._alpha is None and not (self.isRectangle and self.feather == 0) and not self.isEmpty():
+            # Rendered over the unclipped bounds so that the image border does not fade out
+            bounds = self._bounds
+            mask = QImage(bounds.size(), QImage.Format.Format_ARGB32_Premultiplied)
+            mask.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(mask)
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            painter.translate(-bounds.left(), -bounds.top())
+            painter.fillPath(self.path, Qt.GlobalColor.white)
+            painter.end()
+
+            coverage = np.ascontiguousarray(imageToArray(mask)[..., 3])
+            if self.feather > 0:
+                coverage = np.asarray(Image.fromarray(coverage, "L").filter(ImageFilter.GaussianBlur(self.feather)))
+
+            left = self.rect.left() - bounds.left()
+            top = self.rect.top() - bounds.top()
+            alpha = coverage[top:top + self.rect.height(), left:left + self.rect.width()].astype(np.float32) / 255
+            alpha.setflags(write=False)
+            self._alpha = alpha
+        return self._alpha
+
+    def crop(self, image):
+        """ Returns the part of image (a QImage) a tool processes: its pixels within rect.
+        """
+        return image.copy(self.rect)
+
+    def blend(self, image, processed):
+        """ Returns a copy of image (a QImage) with processed, the result of a tool on
+        crop(image), blended into rect through the mask. processed is scaled to rect if a tool
+        changed its size.
+        """
+        if self.isEmpty():
+            return QImage(image)
+        if processed.size() != self.rect.size():
+            processed = processed.scaled(self.rect.size(), Qt.AspectRatioMode.IgnoreAspectRatio,
+                                         Qt.TransformationMode.SmoothTransformation)
+
+        # Premultiplied pixels blend linearly in every channel, alpha included
+        if image.hasAlphaChannel() or processed.hasAlphaChannel():
+            format = QImage.Format.Format_ARGB32_Premultiplied
+        else:
+            format = QImage.Format.Format_RGB32
+        result = image.convertToFormat(format)
+        source = imageToArray(processed.convertToFormat(format))
+        rect = self.rect
+        target = imageToArray(result, writable=True)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+
+        alpha = self.alpha()
+        if alpha is None:
+            target[...] = source
+        else:
+            alpha = alpha[..., np.newaxis]
+            target[...] = np.rint(target * (1.0 - alpha) + source * alpha).astype(np.uint8)
+        return result
@@ -0,0 +1,232 @@
+""" QTiledImageItem.py: Graphics item that displays a large image as tiles of a mip pyramid.
+
+A single QGraphicsPixmapItem rescales the whole pixmap on every paint and needs one pixmap of
+the size of the image, which some graphics drivers refuse for 100 MP panoramas. This item keeps
+the image as a QImage and a pyramid of levels, each half the size of the one before. A paint
+picks the level closest to the zoom of the view and draws only the tiles of it that intersect
+the exposed rectangle. Tiles become QPixmaps of tileSize x tileSize pixels on first use and are
+kept in a least recently used cache.
+
+Level 0 is the image itself. The other levels are built on a worker thread the first time they
+are needed. Until then the exposed part of the image is drawn as it is.
+"""
+
+import collections
+import math
+
+from PyQt6.QtCore import Qt, QRect, QRectF, QThreadPool, pyqtSlot
+from PyQt6.QtGui import QPixmap, QPainter
+from PyQt6.QtWidgets import QGraphicsItem, QGraphicsObject, QStyleOptionGraphicsItem
+
+from QWorker import QWorker
+
+
+class QTiledImageItem(QGraphicsObject):
+
+    # Edge length of a tile in pixels of its level
+    tileSize = 512
+
+    # Tile pixmaps kept for redraws, in bytes
+    cacheBytes = 256 * 1024 * 1024
+
+    def __init__(self, image=None, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+        # levels[k] is the image scaled by 1 / 2^k, None until it is built
+        self._levels = []
+        self._pixmap = None
+
+        # (level, column, row) -> QPixmap, least recently used first
+        self._tiles = collections.OrderedDict()
+        self._tileBytes = 0
+
+        # Incremented on every setImage so that levels built for an older image are dropped
+        self._generation = 0
+        self._building = False
+
+        if image is not None:
+            self.setImage(image)
+
+    def setImage(self, image):
+        """ Display image, a QImage or QPixmap.
+        """
+        self._pixmap = None
+        if type(image) is QPixmap:
+            self._pixmap = image
+            image = image.toImage()
+
+        self.prepareGeometryChange()
+        self._generation += 1
+        self._levels = [image] + [None] * _levelCount(image.width(), image.height(), self.tileSize)
+        self._tiles.clear()
+        self._tileBytes = 0
+        self.update()
+
+    def updateRect(self, rect):
+        """ Redraw rect (a QRect in image pixels) after the pixels of the image changed in place,
+        e.g., under a brush stroke. Built levels are rescaled only where rect covers them.
+        """
+        rect = rect.intersected(self._levels[0].rect()) if self._levels else QRect()
+        if rect.isEmpty():
+            return
+        self._pixmap = None
+        if self._building:
+            # The levels being built are made from the old pixels, drop them when they arrive
+            self._generation += 1
+
+        # Covered part of each level, from even coordinates of the level before so that the
+        # rescaled region lines up with the pixels of the whole level
+        region = rect
+        self._dropTiles(0, region)
+        for level in range(1, len(self._levels)):
+            image = self._levels[level]
+            if image is None:
+                break
+            source = self._levels[level - 1]
+            left = region.left() & ~1
+            top = region.top() & ~1
+            right = min((region.right() + 2) & ~1, source.width())
+            bottom = min((region.bottom() + 2) & ~1, source.height())
+            region = QRect(left // 2, top // 2, max(1, (right - left) // 2), max(1, (bottom - top) // 2)).intersected(image.rect())
+            if region.isEmpty():
+                break
+            scaled = source.copy(QRect(left, top, right - left, bottom - top)).scaled(
+                region.width(), region.height(), Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            painter = QPainter(image)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.drawImage(region.topLeft(), scaled)
+            painter.end()
+            self._dropTiles(level, region)
+
+        self.update(QRectF(rect))
+
+    def setPixmap(self, pixmap):
+        self.setImage(pixmap)
+
+    def image(self):
+        return self._levels[0] if self._levels else None
+
+    def pixmap(self):
+        """ Returns the whole image as one QPixmap, made on first use. Painting does not need it.
+        """
+        if self._pixmap is None and self._levels:
+            self._pixmap = QPixmap.fromImage(self._levels[0])
+        return self._pixmap
+
+    def boundingRect(self):
+        if not self._levels:
+            return QRectF()
+        return QRectF(self._levels[0].rect())
+
+    def levelOfDetail(self, scale):
+        """ Returns the pyramid level for a view that shows one image pixel as scale device pixels.
+        """
+        if scale >= 1 or len(self._levels) == 1:
+            return 0
+        return min(len(self._levels) - 1, int(math.floor(math.log2(1 / scale))))
+
+    def paint(self, painter, option, widget=None):
+        if not self._levels:
+            return
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.levelOfDetail(scale)
+        if self._levels[level] is None:
+            # Draw the exposed part of the image as it is until the level is built, without tiles
+            self._buildLevels()
+            painter.drawImage(exposed, self._levels[0], exposed)
+            return
+
+        image = self._levels[level]
+        base = self._levels[0]
+        sx = base.width() / image.width()
+        sy = base.height() / image.height()
+
+        # Tiles of the level that intersect the exposed part
+        left = int(exposed.left() / sx) // self.tileSize
+        top = int(exposed.top() / sy) // self.tileSize
+        right = min(int(math.ceil(exposed.right() / sx)), image.width() - 1) // self.tileSize
+        bottom = min(int(math.ceil(exposed.bottom() / sy)), image.height() - 1) // self.tileSize
+
+        # Smooth only where the level is shown smaller than its pixels, zoomed in pixels stay sharp
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, scale * sx < 1)
+        for row in range(top, bottom + 1):
+            for column in range(left, right + 1):
+                source = QRect(column * self.tileSize, row * self.tileSize, self.tileSize, self.tileSize).intersected(image.rect())
+                target = QRectF(source.x() * sx, source.y() * sy, source.width() * sx, source.height() * sy)
+                painter.drawPixmap(target, self._tile(level, column, row, source), QRectF(0, 0, source.width(), source.height()))
+
+    def _tile(self, level, column, row, source):
+        key = (level, column, row)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+
+        pixmap = QPixmap.fromImage(self._levels[level].copy(source))
+        self._tiles[key] = pixmap
+        self._tileBytes += _bytesOf(pixmap)
+        while self._tileBytes > self.cacheBytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._tileBytes -= _bytesOf(evicted)
+        return pixmap
+
+    def _dropTiles(self, level, region):
+        # Forget the cached tiles of level that intersect region
+        first = (region.left() // self.tileSize, region.top() // self.tileSize)
+        last = (region.right() // self.tileSize, region.bottom() // self.tileSize)
+        for row in range(first[1], last[1] + 1):
+            for column in range(first[0], last[0] + 1):
+                pixmap = self._tiles.pop((level, column, row), None)
+                if pixmap is not None:
+                    self._tileBytes -= _bytesOf(pixmap)
+
+    def _buildLevels(self):
+        # Build all missing levels in one job, each from the one before
+        if self._building:
+            return
+        self._building = True
+        first = self._levels.index(None)
+        worker = QWorker(_buildLevels, self._levels[first - 1], len(self._levels) - first, self._generation)
+        worker.signals.result.connect(self.onLevelsBuilt)
+        QThreadPool.globalInstance().start(worker)
+
+    @pyqtSlot(object)
+    def onLevelsBuilt(self, result):
+        self._building = False
+        generation, levels = result
+        if generation != self._generation:
+            # The image changed while building, start over for the current one on the next paint
+            self.update()
+            return
+        first = self._levels.index(None)
+        self._levels[first:first + len(levels)] = levels
+        self.update()
+
+
+def _buildLevels(image, count, generation):
+    levels = []
+    for _ in range(count):
+        image = image.scaled(max(1, image.width() // 2), max(1, image.height() // 2),
+                             Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        levels.append(image)
+    return generation, levels
+
+
+def _levelCount(width, height, tileSize):
+    # Levels after level 0 until the image fits in a single tile
+    count = 0
+    while max(width, height) > tileSize:
+        width = max(1, width // 2)
+        height = max(1, height // 2)
+        count += 1
+    return count
+
+
+def _bytesOf(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
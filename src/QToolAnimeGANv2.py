@@ -2,8 +2,6 @@ from QTool import QTool
 
 class QToolAnimeGANv2(QTool):
 
-    net = None
-
     def __init__(self, parent=None, toolInput=None, onCompleted=None):
         super(QToolAnimeGANv2, self).__init__(parent, "Anime GAN v2", 
                                               "Transform photos of real-world scenes into anime style images\nhttps://github.com/bryandlee/animegan2-pytorch",
@@ -17,6 +15,8 @@ class QToolAnimeGANv2(QTool):
 
         from torchvision.transforms.functional import to_tensor, to_pil_image
         from AnimeGANv2Model import Generator as AnimeGanV2Generator
+        from ModelCache import modelCache
+        import ModelQuantization
         import torch
         import cv2
         import numpy as np
@@ -37,10 +37,22 @@ class QToolAnimeGANv2(QTool):
             try:
                 progressSignal.emit(20, "Loading model")
 
-                if QToolAnimeGANv2.net == None:
+                def load():
                     net = AnimeGanV2Generator()
                     net.load_state_dict(torch.load("models/face_paint_512_v2.pt", map_location=device))
-                    net.to(device).eval()
+                    return net.to(device).eval()
+
+                if ModelQuantization.useQuantized(device):
+                    def samples():
+                        return [sample * 2 - 1 for sample in ModelQuantization.sampleImages("images/AnimeGanV2*.jpg", (256, 256))]
+
+                    def metric(reference, output):
+                        return ModelQuantization.psnr(reference + 1, output + 1, peak=2.0)
+
+                    net = ModelQuantization.quantizedModel("AnimeGANv2Generator", "models/face_paint_512_v2.pt", load,
+                                                           samples, metric, ModelQuantization.minimumPSNR, (False,))
+                else:
+                    net = modelCache.get("AnimeGANv2Generator", "models/face_paint_512_v2.pt", device, load)
 
                 progressSignal.emit(30, "Loading current pixmap")
 
@@ -69,7 +81,6 @@ class QToolAnimeGANv2(QTool):
                     out_np = np.dstack((np.asarray(out), alpha)).astype(np.uint8)
 
                     del image_tensor
-                    del net
                     del out
 
                     i += 1
@@ -44,6 +44,7 @@ class QToolColorizer(QTool):
         import torch
         import os
         from FileUtils import merge_files
+        from ModelCache import modelCache
 
         # Merge NN model files into pth file if not exists
         if not os.path.exists("models/icolorit_base_4ch_patch16_224.pth"):
@@ -64,10 +65,14 @@ class QToolColorizer(QTool):
             return model
 
         device = "cuda" if torch.cuda.is_available() else "cpu"
+        model_path = os.path.join("models", "icolorit_base_4ch_patch16_224.pth")
 
-        model = get_model()
-        model.to(device)
-        checkpoint = torch.load(os.path.join("models", "icolorit_base_4ch_patch16_224.pth"), map_location=torch.device(device))
-        model.load_state_dict(checkpoint['model'], strict=False)
-        model.eval()
-        self.output = model
\ No newline at end of file
+        def load():
+            model = get_model()
+            model.to(device)
+            checkpoint = torch.load(model_path, map_location=torch.device(device))
+            model.load_state_dict(checkpoint['model'], strict=False)
+            model.eval()
+            return model
+
+        self.output = modelCache.get("icolorit_base_4ch_patch16_224", model_path, device, load)
\ No newline at end of file
@@ -3,12 +3,15 @@ from PyQt6.QtGui import QIcon
 from PyQt6.QtCore import QSize
 from PyQt6 import QtCore
 from QFlowLayout import QFlowLayout
+from QImageBuffer import ImageToQImage, ImageToQPixmap
 
 class QToolInstagramFilters(QScrollArea):
-    def __init__(self, parent=None, toolInput=None):
+    def __init__(self, parent=None, toolInput=None, selection=None):
         super(QToolInstagramFilters, self).__init__(None)
         self.parent = parent
         self.toolInput = toolInput
+        # QSelectionMask toolInput was cropped to, if any
+        self.selection = selection
         self.output = None
         self.layout = QHBoxLayout()
         self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
@@ -87,7 +90,7 @@ class QToolInstagramFilters(QScrollArea):
         buttonIconSize = QSize(200, 200)
 
         noFilterButton = QToolButton()
-        unfilteredPixmap = self.parent.ImageToQPixmap(image)
+        unfilteredPixmap = ImageToQPixmap(image)
         unfilteredPixmap = unfilteredPixmap.scaled(buttonIconSize, QtCore.Qt.AspectRatioMode.KeepAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
         icon = QIcon(unfilteredPixmap)
         noFilterButton.setIcon(icon)
@@ -101,7 +104,7 @@ class QToolInstagramFilters(QScrollArea):
         for i, f in enumerate(filters):
             filterButton = QToolButton()
             filtered = f(image).convert("RGBA")
-            filteredPixmap = self.parent.ImageToQPixmap(filtered)
+            filteredPixmap = ImageToQPixmap(filtered)
             filteredPixmap = filteredPixmap.scaled(buttonIconSize, QtCore.Qt.AspectRatioMode.KeepAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
 
             icon = QIcon(filteredPixmap)
@@ -124,7 +127,10 @@ class QToolInstagramFilters(QScrollArea):
             self.output = filterFunction(self.toolInput).convert("RGBA")
         else:
             self.output = self.toolInput
-        self.parent.image_viewer.setImage(self.parent.ImageToQPixmap(self.output), False)
+        output = ImageToQImage(self.output)
+        if self.selection is not None:
+            output = self.selection.blend(self.parent.getCurrentLayerLatestImage(), output)
+        self.parent.image_viewer.setImage(output, False)
 
     def closeEvent(self, event):
         self.destroyed.emit()
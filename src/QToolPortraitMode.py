@@ -37,6 +37,7 @@ class QToolPortraitMode(QTool):
         from torchvision.transforms import Compose
         import numpy as np
         import MiDaS
+        from ModelCache import modelCache
         import cv2
         from PIL import Image, ImageFilter
 
@@ -69,11 +70,16 @@ class QToolPortraitMode(QTool):
         progressSignal.emit(80, "Using depth predictor model " + model_path + " on " + "cuda" if torch.cuda.is_available() else "cpu")
 
         # DPT Large
-        model = MiDaS.DPTDepthModel(
-            path=model_path,
-            backbone="vitl16_384",
-            non_negative=True,
-        )
+        def load():
+            model = MiDaS.DPTDepthModel(
+                path=model_path,
+                backbone="vitl16_384",
+                non_negative=True,
+            )
+            model.eval()
+            return model.to(device)
+
+        model = modelCache.get("DPTDepthModel/vitl16_384", model_path, device, load)
         net_w, net_h = 384, 384
         resize_mode = "minimal"
         normalization = MiDaS.NormalizeImage(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
@@ -94,9 +100,6 @@ class QToolPortraitMode(QTool):
             ]
         )
 
-        model.eval()
-        model.to(device)
-
         # Prepare input
         img_input = transform({"image": img})["image"]
 
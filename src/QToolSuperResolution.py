@@ -44,7 +44,8 @@ class QToolSuperResolution(QTool):
                 progressSignal.emit(40, "Loading model " + model + " on " + device)
 
                 model = QualityScaler.prepare_AI_model(model, device)
-                tiles_resolution = 700 # If the image is smaller than this on both sides, it'll be upscaled without any tiling
+                # Largest tiles that fit in memory, an image smaller than this on both sides is upscaled without any tiling
+                tiles_resolution = QualityScaler.tile_size_for_memory(device, model.sf)
 
                 progressSignal.emit(50, "Setting tile resolution " + str(tiles_resolution))
 
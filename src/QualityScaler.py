@@ -1,9 +1,11 @@
 import ctypes
 import functools
+import math
 import multiprocessing
 import os
 import os.path
 import platform
+import queue
 import shutil
 import sys
 import threading
@@ -24,7 +26,9 @@ from moviepy.audio.AudioClip import CompositeAudioClip
 from moviepy.audio.io import AudioFileClip
 from moviepy.video.io import ImageSequenceClip, VideoFileClip
 from PIL import Image, ImageDraw, ImageFont
-from QualityScalerUtilities import reverse_split, split_image
+from QualityScalerUtilities import tile_boxes, upscale_tiled
+from ModelCache import modelCache
+import ModelQuantization
 
 def create_temp_dir(name_dir):
     if os.path.exists(name_dir):
@@ -267,111 +271,158 @@ def check_compatibility(supported_file_dropped_number, not_supported_file_droppe
 
     return all_supported, single_file, multiple_files, video_files, more_than_one_video
 
-def upscale_image_and_save(img, model, result_path, device, tiles_resolution):
-    multiplier_num_tiles = 3
+# Input pixels of overlap between neighbouring tiles, cross-faded in the output
+tiles_overlap = 32
 
-    img_tmp          = cv2.imread(img)
-    image_resolution = max(img_tmp.shape[1], img_tmp.shape[0])
-    num_tiles        = image_resolution/tiles_resolution
+# Share of the free memory of the device a batch of tiles may use
+tiles_memory_fraction = 0.5
 
-    if num_tiles <= 1:
-        num_tiles = 2
-    #if num_tiles <= 1:
-    #    img_adapted  = adapt_image_for_deeplearning(img, device)
-    #    with torch.no_grad():
-    #        img_upscaled_tensor = model(img_adapted)
-    #        img_upscaled = tensor_to_uint(img_upscaled_tensor)
-    #    save_image(img_upscaled, result_path)
-
-    num_tiles = round(num_tiles)
-    if (num_tiles % 2) != 0: num_tiles += 1
-    num_tiles = round(num_tiles * multiplier_num_tiles)
-
-    num_tiles_applied = int(num_tiles/2)
-    how_many_tiles = int(pow(num_tiles/2, 2))
-
-    split_image(img, num_tiles_applied, num_tiles_applied)
-
-    print("Num tiles:", how_many_tiles)
-    print(img)
-
-    basename, ext = os.path.splitext(img)
-
-    tiles = []
-    for index in range(how_many_tiles):
-        tiles.append(basename + "_" + str(index) + ext)
+# Largest tiles and batches; larger images are upscaled in batches of tiles this size
+tiles_max_resolution = 512
+tiles_max_batch = 16
 
+def torch_backend(device):
+    if 'cuda' in device:
+        return torch.device('cuda')
+    elif 'dml' in device:
+        return torch.device('dml')
+    return torch.device('cpu')
+
+def available_memory(device):
+    """ Free memory in bytes on device, or a conservative guess if it cannot be queried. """
+    if 'cuda' in device and torch.cuda.is_available() and hasattr(torch.cuda, "mem_get_info"):
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 2 * 1024 ** 3
+
+def bytes_per_input_pixel(upscale_factor):
+    # Besides the trunk, about 1 KB per input pixel, the upsampling layers of RRDBNet keep a
+    # few 64 channel float32 feature maps of the output size alive
+    return 1024 + upscale_factor * upscale_factor * 3 * 64 * 4
+
+def tile_size_for_memory(device, upscale_factor):
+    """ Edge length of the largest square tile, up to tiles_max_resolution, that RRDBNet can
+    upscale within the free memory of device.
+    """
+    pixels = available_memory(device) * tiles_memory_fraction / bytes_per_input_pixel(upscale_factor)
+    return int(min(max(math.sqrt(pixels), 128), tiles_max_resolution)) // 8 * 8
+
+def batch_size_for_memory(device, upscale_factor, tile_height, tile_width):
+    """ Number of tiles of tile_height x tile_width pixels, up to tiles_max_batch, that
+    RRDBNet can upscale in one forward pass within the free memory of device.
+    """
+    budget = available_memory(device) * tiles_memory_fraction
+    return int(max(1, min(tiles_max_batch, budget // (bytes_per_input_pixel(upscale_factor) * tile_height * tile_width))))
+
+class BatchUpscaler:
+    """ Upscales batches of equally sized RGB uint8 tiles, (n, height, width, 3) arrays, with
+    model in one forward pass each, in the three stages of upscale_tiled: prepare normalizes
+    a batch into an input tensor on the device, infer runs the model and finish denormalizes
+    its output into a uint8 array. Calling the object runs all three.
+
+    Tensors are allocated for the first batch and reused: slots input tensors, enough for
+    the batches in flight between the stages of upscale_tiled, and one output array that
+    each finish overwrites. On CUDA the host side of both is pinned memory.
+    """
+
+    def __init__(self, model, device, slots=4):
+        self.model = model
+        self.backend = torch_backend(device)
+        self.pinned = self.backend.type == 'cuda'
+        self._slots = [{} for _ in range(slots)]
+        self._free = queue.Queue()
+        for slot in self._slots:
+            self._free.put(slot)
+        self._output = None
+
+    def _reuse(self, tensor, shape, dtype, device, pin=False):
+        if tensor is None or tensor.shape[0] < shape[0] or tensor.shape[1:] != shape[1:]:
+            tensor = torch.empty(shape, dtype=dtype, device=device, pin_memory=pin)
+        return tensor
+
+    def prepare(self, tiles):
+        n, height, width, channels = tiles.shape
+        tiles = torch.from_numpy(np.ascontiguousarray(tiles))
+        slot = self._free.get()
+        if self.pinned:
+            # The copy of the last batch of this slot to the device must be done
+            if "copied" in slot:
+                slot["copied"].synchronize()
+            slot["staging"] = self._reuse(slot.get("staging"), tiles.shape, torch.uint8, 'cpu', True)
+            staging = slot["staging"][:n]
+            staging.copy_(tiles)
+            tiles = staging
+
+        slot["input"] = self._reuse(slot.get("input"), (n, channels, height, width), torch.float32, self.backend)
+        batch = slot["input"][:n]
+        batch.copy_(tiles.permute(0, 3, 1, 2), non_blocking=True)
+        batch.div_(255.)
+        if self.pinned:
+            slot["copied"] = torch.cuda.Event()
+            slot["copied"].record()
+        return slot, n
+
+    def infer(self, prepared):
+        slot, n = prepared
+        try:
+            # Kernels run in order on the device, the next batch of the slot is copied after this one is read
+            return self.model(slot["input"][:n])
+        finally:
+            self._free.put(slot)
+
+    def finish(self, upscaled):
+        upscaled = upscaled.clamp_(0, 1).mul_(255.).round_().permute(0, 2, 3, 1)
+        self._output = self._reuse(self._output, upscaled.shape, torch.uint8, 'cpu', self.pinned)
+        output = self._output[:upscaled.shape[0]]
+        output.copy_(upscaled)
+        return output.numpy()
+
+    def __call__(self, tiles):
+        return self.finish(self.infer(self.prepare(tiles)))
+
+def upscale_array(img, model, device, tiles_resolution=None, progress=None, batch_size=None):
+    """ Upscale img, an RGB uint8 array, with model in overlapping tiles of tiles_resolution
+    pixels, or of the size that fits in the memory of device if it is None. Tiles are
+    upscaled batch_size at a time, by default as many as fit in memory.
+    """
+    if tiles_resolution is None:
+        tiles_resolution = tile_size_for_memory(device, model.sf)
+
+    rows = tile_boxes(img.shape[0], tiles_resolution, tiles_overlap)
+    columns = tile_boxes(img.shape[1], tiles_resolution, tiles_overlap)
+    if batch_size is None:
+        batch_size = batch_size_for_memory(device, model.sf, rows[0][1] - rows[0][0], columns[0][1] - columns[0][0])
+    batch_size = max(1, min(batch_size, len(rows) * len(columns)))
+
+    upscaler = BatchUpscaler(model, device)
     with torch.no_grad():
-        for tile in tiles:
-            tile_adapted  = adapt_image_for_deeplearning(tile, device)
-            tile_upscaled = tensor_to_uint(model(tile_adapted))
-            save_image(tile_upscaled, tile)
-            print("Upscaled", tile)
+        upscaled = upscale_tiled(img, upscaler.infer, model.sf, tiles_resolution, tiles_overlap,
+                                 "cosine", progress, batch_size, upscaler.prepare, upscaler.finish)
 
-    reverse_split(tiles, num_tiles_applied, num_tiles_applied, result_path, True, False)
+    # Clean up CUDA resources
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return upscaled
+
+def upscale_image_and_save(img, model, result_path, device, tiles_resolution=None):
+    img_tmp = cv2.cvtColor(cv2.imread(img), cv2.COLOR_BGR2RGB)
+    save_image(upscale_array(img_tmp, model, device, tiles_resolution), result_path)
     print("Done upscale_image_and_save")
 
 def upscale_image(img, model, device, tiles_resolution, progressSignal):
-    multiplier_num_tiles = 3
-
-    img_tmp          = np.asarray(img)
-    image_resolution = max(img_tmp.shape[1], img_tmp.shape[0])
-    num_tiles        = image_resolution/tiles_resolution
-
-    if num_tiles <= 1:
-        progressSignal.emit(55, "Adapting image for deep learning")
-        img_adapted  = adapt_image_for_deeplearning(img, device)
-        with torch.no_grad():
-            progressSignal.emit(60, "Scaling the quality...")
-            img_upscaled_tensor = model(img_adapted)
-            del img_adapted
-            progressSignal.emit(90, "Upscaling completed")
-            img_upscaled = tensor_to_uint(img_upscaled_tensor)
-            del img_upscaled_tensor
-            progressSignal.emit(95, "Postprocessing image...")
-        return Image.fromarray(img_upscaled)
-    else:
-        num_tiles = round(num_tiles)
-        if (num_tiles % 2) != 0: num_tiles += 1
-        num_tiles = round(num_tiles * multiplier_num_tiles)
-
-        num_tiles_applied = int(num_tiles/2)
-        how_many_tiles = int(pow(num_tiles/2, 2))
-
-        progressSignal.emit(55, "Splitting image into " + str(how_many_tiles) + " tiles")
-
-        # Build a list of tiles from image
-        tiles = split_image(img, num_tiles_applied, num_tiles_applied)
-
-        # Convert to np arrays
-        tiles = [np.asarray(im) for im in tiles]
-
-        upscaled_tiles = []
-
-        currentProgress = 60
-        progressPerTile = float(40) / len(tiles)
-        i = 0
-
-        with torch.no_grad():
-            for tile in tiles:
-                progressSignal.emit(currentProgress, "Upscaling tile {}/{}".format(i + 1, len(tiles)))
-                tile_adapted  = adapt_image_for_deeplearning(tile, device)
-                tile_upscaled = tensor_to_uint(model(tile_adapted))
-                del tile
-                del tile_adapted
-                # Clean up CUDA resources
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                upscaled_tiles.append(tile_upscaled)
-
-                i += 1
-                currentProgress = int(currentProgress + progressPerTile)
-
-        del tiles
-
-        upscaled_tiles = [Image.fromarray(arr) for arr in upscaled_tiles]
-
-        return reverse_split(upscaled_tiles, num_tiles_applied, num_tiles_applied)
+    progressSignal.emit(55, "Adapting image for deep learning")
+    start = timer()
+
+    def progress(done, count):
+        message = "Upscaled tile {}/{} ({:.2f} tiles/s)".format(done, count, done / (timer() - start))
+        progressSignal.emit(60 + 40 * done // count, message)
+
+    upscaled = upscale_array(np.asarray(img), model, device, tiles_resolution, progress)
+    print("Upscaled in {:.1f} s".format(timer() - start))
+    return Image.fromarray(upscaled)
 
 def optimize_torch():
     torch.autograd.set_detect_anomaly(False)
@@ -391,17 +442,29 @@ def prepare_AI_model(AI_model, device):
     if "x2" in AI_model: upscale_factor = 2
     elif "x4" in AI_model: upscale_factor = 4
 
-    model = RRDBNet(in_nc = 3, out_nc = 3, nf = 64, 
-                    nb = 23, gc = 32, sf = upscale_factor)
-    model.load_state_dict(torch.load(model_path), strict=True)
-    model.eval()
+    def load():
+        model = RRDBNet(in_nc = 3, out_nc = 3, nf = 64, 
+                        nb = 23, gc = 32, sf = upscale_factor)
+        model.load_state_dict(torch.load(model_path, map_location = backend), strict=True)
+        model.eval()
 
-    for _, v in model.named_parameters():
-        v.requires_grad = False
-        
-    model = model.to(backend, non_blocking = True)
+        for _, v in model.named_parameters():
+            v.requires_grad = False
+
+        return model.to(backend, non_blocking = True)
+
+    if ModelQuantization.useQuantized(backend):
+        # Calibrated on downscaled photos, tile-sized inputs would take long in float32
+        def samples():
+            return ModelQuantization.sampleImages(os.path.join('images', 'WhiteBalance*.jpg'), (64, 64))
+
+        model = ModelQuantization.quantizedModel("RRDBNet", model_path, load, samples,
+                                                 ModelQuantization.psnr, ModelQuantization.minimumPSNR)
+        # upscale_array reads the upscale factor off the model
+        model.sf = upscale_factor
+        return model
 
-    return model
+    return modelCache.get("RRDBNet", model_path, backend, load)
 
 supported_file_list     = ['.jpg', '.jpeg', '.JPG', '.JPEG',
                             '.png', '.PNG',
@@ -1,35 +1,203 @@
 #!usr/bin/env python
-from PIL import Image
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-def split_image(im, rows, cols):
-    image = Image.fromarray(im)
-    im_width, im_height = image.size
-    row_width = int(im_width / rows)
-    row_height = int(im_height / cols)
+import numpy as np
 
-    result = [] # list of tiles; smaller images
+def tile_boxes(length, tile_size, overlap):
+    """ Split [0, length) into tiles of the same size, at most tile_size pixels, as a list of
+    (start, end). Consecutive tiles share at least overlap pixels, the last one ends at length.
+    """
+    if length <= tile_size:
+        return [(0, length)]
 
-    n = 0
-    for i in range(0, cols):
-        for j in range(0, rows):
-            box = (j * row_width, i * row_height, j * row_width +
-                   row_width, i * row_height + row_height)
-            outp = image.crop(box)
-            result.append(outp)
-            n += 1
+    # Keep the overlaps at both ends of a tile apart
+    overlap = max(0, min(overlap, tile_size // 4))
+    count = -(-(length - overlap) // (tile_size - overlap))
+    size = -(-(length - overlap) // count) + overlap
+    starts = [round(i * (length - size) / (count - 1)) for i in range(count)]
+    return [(start, start + size) for start in starts]
 
-    return result
+def blend_ramp(length, window="cosine"):
+    """ Weights of the tile that fades in over an overlap of length pixels. The tile that
+    fades out has 1 - ramp, so the two always add up to 1.
+    """
+    t = (np.arange(length, dtype=np.float64) + 0.5) / max(length, 1)
+    if window == "linear":
+        ramp = t
+    elif window == "cosine":
+        ramp = (1.0 - np.cos(np.pi * t)) / 2.0
+    else:
+        raise ValueError("blend_ramp: Unknown window " + str(window))
+    return ramp.astype(np.float32)
 
-def reverse_split(images_to_merge, rows, cols):
-    image1 = images_to_merge[0]
-    new_width = image1.size[0] * cols
-    new_height = image1.size[1] * rows
+def tile_weights(boxes, index, scale, window="cosine"):
+    """ Weights along one axis of the output of tile index of boxes (see tile_boxes), which
+    is scale times the size of the tile: 1 except where it overlaps its neighbours.
+    """
+    start, end = boxes[index]
+    weights = np.ones((end - start) * scale, dtype=np.float32)
+    if index > 0:
+        n = (boxes[index - 1][1] - start) * scale
+        weights[:n] = blend_ramp(n, window)
+    if index + 1 < len(boxes):
+        n = (end - boxes[index + 1][0]) * scale
+        weights[len(weights) - n:] = 1.0 - blend_ramp(n, window)
+    return weights
 
-    new_image = Image.new(image1.mode, (new_width, new_height))
+def upscale_tiled(image, upscale, scale, tile_size, overlap=32, window="cosine", progress=None, batch_size=1,
+                  prepare=None, finish=None):
+    """ Returns upscale applied to image, a (height, width, channels) uint8 array, in tiles of
+    at most tile_size x tile_size pixels. All tiles have the same size and are processed
+    batch_size at a time, as one (n, tile height, tile width, channels) uint8 array, in three
+    stages that run concurrently (see run_pipeline): prepare(tiles), e.g., normalization into
+    a tensor, upscale(prepared) on the calling thread, and finish(upscaled), which returns the
+    (n, scale * tile height, scale * tile width, channels) uint8 results. prepare and finish
+    default to passing the batch through. finish may reuse the array it returns for the next batch.
 
-    for i in range(0, rows):
-        for j in range(0, cols):
-            image = images_to_merge[i * cols + j]
-            new_image.paste(image, (j * image.size[0], i * image.size[1]))
+    Neighbouring tiles overlap by overlap input pixels and their outputs are cross-faded over
+    the overlap with a linear or cosine window. Everywhere else the results are written
+    straight into the output array, so two tilings give the same pixels except within the
+    overlaps. Images of any size are covered exactly. progress(done, count) is called with the
+    number of tiles done after each batch.
+    """
+    height, width = image.shape[:2]
+    grayscale = image.ndim == 2
+    channels = 1 if grayscale else image.shape[2]
+    image = image.reshape(height, width, channels)
+    rows = tile_boxes(height, tile_size, overlap)
+    columns = tile_boxes(width, tile_size, overlap)
+    count = len(rows) * len(columns)
 
-    return new_image
\ No newline at end of file
+    output = np.empty((height * scale, width * scale, channels), dtype=np.uint8)
+    tile_height = (rows[0][1] - rows[0][0]) * scale
+    tile_width = (columns[0][1] - columns[0][0]) * scale
+
+    # Weighted sums of the overlaps until all their tiles are in: between the rows of tiles i
+    # and i + 1, and between tiles j and j + 1 of row i outside of those
+    row_overlaps = {}
+    column_overlaps = {}
+
+    def blend(overlap, target):
+        target[...] = np.rint(np.clip(overlap, 0, 255)).astype(np.uint8)
+
+    def write(i, j, result):
+        y, x = rows[i][0] * scale, columns[j][0] * scale
+        above = (rows[i - 1][1] - rows[i][0]) * scale if i > 0 else 0
+        below = tile_height - (rows[i + 1][0] - rows[i][0]) * scale if i + 1 < len(rows) else 0
+        before = (columns[j - 1][1] - columns[j][0]) * scale if j > 0 else 0
+        after = tile_width - (columns[j + 1][0] - columns[j][0]) * scale if j + 1 < len(columns) else 0
+        middle = slice(above, tile_height - below)
+        row_weights = tile_weights(rows, i, scale, window)[:, np.newaxis, np.newaxis]
+        column_weights = tile_weights(columns, j, scale, window)[np.newaxis, :, np.newaxis]
+
+        output[y + above:y + tile_height - below, x + before:x + tile_width - after] = \
+            result[middle, before:tile_width - after]
+        if before:
+            column_overlaps[(i, j - 1)] += result[middle, :before] * column_weights[:, :before]
+            blend(column_overlaps.pop((i, j - 1)), output[y + above:y + tile_height - below, x:x + before])
+        if after:
+            column_overlaps[(i, j)] = result[middle, tile_width - after:] * column_weights[:, tile_width - after:]
+        if above:
+            row_overlaps[i - 1][:, x:x + tile_width] += result[:above] * (row_weights[:above] * column_weights)
+        if below:
+            if j == 0:
+                row_overlaps[i] = np.zeros((below, width * scale, channels), dtype=np.float32)
+            row_overlaps[i][:, x:x + tile_width] += result[tile_height - below:] * (row_weights[tile_height - below:] * column_weights)
+        if above and j == len(columns) - 1:
+            blend(row_overlaps.pop(i - 1), output[y:y + above])
+
+    tiles = [(i, j) for i in range(len(rows)) for j in range(len(columns))]
+    batches = [tiles[first:first + batch_size] for first in range(0, count, batch_size)]
+    done = [0]
+
+    def extract(batch):
+        tiles = np.stack([image[rows[i][0]:rows[i][1], columns[j][0]:columns[j][1]] for i, j in batch])
+        return prepare(tiles) if prepare is not None else tiles
+
+    def store(batch, upscaled):
+        results = finish(upscaled) if finish is not None else upscaled
+        results = results.reshape(results.shape[:3] + (-1,))
+        if results.shape != (len(batch), tile_height, tile_width, channels):
+            raise ValueError("upscale_tiled: Expected {} tiles of {}x{}, got {} of {}x{}".format(
+                len(batch), tile_width, tile_height, results.shape[0], results.shape[2], results.shape[1]))
+        for (i, j), result in zip(batch, results):
+            write(i, j, result)
+        done[0] += len(batch)
+        if progress is not None:
+            progress(done[0], count)
+
+    run_pipeline(batches, extract, upscale, store)
+    return output[..., 0] if grayscale else output
+
+# Marks the end of the items of a run_pipeline stage
+_end = object()
+
+def _put(stage_queue, item, stop):
+    # Put item, unless a stage failed meanwhile
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=0.05)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(stage_queue, stop):
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=0.05)
+        except queue.Empty:
+            pass
+    return _end
+
+def run_pipeline(items, prepare, process, finish, depth=2):
+    """ Calls finish(item, process(prepare(item))) for every item of items, in order, as three
+    stages that overlap: prepare runs on one thread of a pool for the next items, process on
+    the calling thread, and finish on another thread of the pool for the previous items. At
+    most depth items wait between two stages. An exception in any stage stops all of them and
+    is raised here.
+    """
+    prepared = queue.Queue(depth)
+    processed = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        for item in items:
+            if not _put(prepared, (item, prepare(item)), stop):
+                return
+        _put(prepared, _end, stop)
+
+    def consume():
+        while True:
+            entry = _get(processed, stop)
+            if entry is _end:
+                return
+            finish(*entry)
+
+    def stage(function):
+        def run():
+            try:
+                function()
+            except BaseException:
+                stop.set()
+                raise
+        return run
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        stages = [pool.submit(stage(produce)), pool.submit(stage(consume))]
+        try:
+            while True:
+                entry = _get(prepared, stop)
+                if entry is _end:
+                    break
+                item, value = entry
+                if not _put(processed, (item, process(value)), stop):
+                    break
+            _put(processed, _end, stop)
+        except BaseException:
+            stop.set()
+            raise
+        for future in stages:
+            future.result()
@@ -20,9 +20,12 @@ import pyqtgraph as pg
 from QColorPicker import QColorPicker
 import os
 from QFlowLayout import QFlowLayout
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image
 from QWorker import QWorker
 import QCurveWidget
+from AdjustmentStack import AdjustmentStack
+from QHistogram import QHistogram
+from QImageBuffer import QImageToImage, ImageToQImage
 
 def free_gpu_cache():
     import torch
@@ -87,6 +90,13 @@ class Gui(QtWidgets.QMainWindow):
         self.HistogramContent = None
         self.ImageHistogramPlot.hide()
 
+        # Counts the histograms of the displayed image while the plot is shown
+        self.histogram = QHistogram(self)
+        self.histogram.histogramChanged.connect(self.OnHistogramChanged)
+
+        # Selection the running tool works on, its result is blended back through it
+        self.toolSelection = None
+
         ##############################################################################################
         ##############################################################################################
         # Color Picker
@@ -114,6 +124,16 @@ class Gui(QtWidgets.QMainWindow):
         self.GaussianBlurRadius = 0
 
         self.timer_id = -1
+        self.sliderChangePending = False
+
+        # Incremented with every slider change, renders of older generations are stale
+        self.sliderGeneration = 0
+
+        # (generation, key) of the latest render, see renderSliderChange
+        self.sliderRender = None
+
+        # The sliders are baked into the layer once the latest render is done, see commitSliders
+        self.sliderCommitPending = False
         self.sliderExplanationOfChange = None
         self.sliderTypeOfChange = None
         self.sliderValueOfChange = None
@@ -635,7 +655,7 @@ class Gui(QtWidgets.QMainWindow):
         self.showMaximized()
 
         self.threadpool = QtCore.QThreadPool()
-        self.sliderChangedPixmap = None
+        self.sliderChangedImage = None
         self.sliderExplanationOfChange = None
         self.sliderTypeOfChange = None
         self.sliderValueOfChange = None
@@ -736,53 +756,36 @@ class Gui(QtWidgets.QMainWindow):
     def getCurrentLayerLatestPixmap(self):
         return self.image_viewer.getCurrentLayerLatestPixmap()
 
+    def getCurrentLayerLatestImage(self):
+        return self.image_viewer.getCurrentLayerLatestImage()
+
     def processSliderChange(self, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
         self.sliderExplanationOfChange = explanationOfChange
         self.sliderTypeOfChange = typeOfChange
         self.sliderValueOfChange = valueOfChange
         self.sliderObjectOfChange = objectOfChange
 
+        # Show the change right away on a screen-sized proxy, the full resolution
+        # image is rendered when the slider is released or the sliders are idle
+        self.sliderChangePending = True
+        self.sliderCommitPending = False
+        self.sliderGeneration += 1
+        self.image_viewer.previewAdjustments(self.sliderValues())
+
         if self.timer_id != -1:
             self.killTimer(self.timer_id)
 
         self.timer_id = self.startTimer(500)
 
-    def QPixmapToImage(self, pixmap):
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def ImageToQPixmap(self, image):
-        from PIL.ImageQt import ImageQt
-        return QPixmap.fromImage(ImageQt(image))
-
-    def EnhanceImage(self, Pixmap, Property, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-        AdjustedImage = Property(CurrentImage).enhance(float(value) / 100)
-        return self.ImageToQPixmap(AdjustedImage)
-
-    def ApplyGaussianBlur(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-        AdjustedImage = CurrentImage.filter(ImageFilter.GaussianBlur(radius=value))
-        return self.ImageToQPixmap(AdjustedImage)
-
-    def UpdateReds(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Reds
-        r = r.point(lambda i: i * value)
+    def sliderValues(self):
+        return {name: getattr(self, attribute) for name, _, attribute, _ in AdjustmentStack.steps}
 
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
+    def OnSliderReleased(self):
+        if self.timer_id != -1:
+            self.killTimer(self.timer_id)
+            self.timer_id = -1
+        if self.sliderChangePending:
+            self.renderSliderChange()
 
     def AddRedColorSlider(self, layout):
         self.RedColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
@@ -793,25 +796,12 @@ class Gui(QtWidgets.QMainWindow):
         self.RedColorSlider.setValue(100) 
 
         self.RedColorSlider.valueChanged.connect(self.OnRedColorChanged)
+        self.RedColorSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnRedColorChanged(self, value):
         self.RedFactor = value
         self.processSliderChange("Red", "Slider", value, "RedColorSlider")
 
-    def UpdateGreens(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Greens
-        g = g.point(lambda i: i * value)
-
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
-
     def AddGreenColorSlider(self, layout):
         self.GreenColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
         self.GreenColorSlider.setRange(0, 200) # 1 is original image, 0 is black image
@@ -821,25 +811,12 @@ class Gui(QtWidgets.QMainWindow):
         self.GreenColorSlider.setValue(100) 
 
         self.GreenColorSlider.valueChanged.connect(self.OnGreenColorChanged)
+        self.GreenColorSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnGreenColorChanged(self, value):
         self.GreenFactor = value
         self.processSliderChange("Green", "Slider", value, "GreenColorSlider")
 
-    def UpdateBlues(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Blues
-        b = b.point(lambda i: i * value)
-
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
-
     def AddBlueColorSlider(self, layout):
         self.BlueColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
         self.BlueColorSlider.setRange(0, 200) # 1 is original image, 0 is black image
@@ -849,6 +826,7 @@ class Gui(QtWidgets.QMainWindow):
         self.BlueColorSlider.setValue(100) 
 
         self.BlueColorSlider.valueChanged.connect(self.OnBlueColorChanged)
+        self.BlueColorSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnBlueColorChanged(self, value):
         self.BlueFactor = value
@@ -863,6 +841,7 @@ class Gui(QtWidgets.QMainWindow):
         self.TemperatureSlider.setValue(6000)
 
         self.TemperatureSlider.valueChanged.connect(self.OnTemperatureChanged)
+        self.TemperatureSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnTemperatureChanged(self, value):
         self.Temperature = value
@@ -877,6 +856,7 @@ class Gui(QtWidgets.QMainWindow):
         self.ColorSlider.setValue(100) 
 
         self.ColorSlider.valueChanged.connect(self.OnColorChanged)
+        self.ColorSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnColorChanged(self, value):
         self.Color = value
@@ -891,6 +871,7 @@ class Gui(QtWidgets.QMainWindow):
         self.BrightnessSlider.setValue(100) 
 
         self.BrightnessSlider.valueChanged.connect(self.OnBrightnessChanged)
+        self.BrightnessSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnBrightnessChanged(self, value):
         self.Brightness = value
@@ -905,6 +886,7 @@ class Gui(QtWidgets.QMainWindow):
         self.ContrastSlider.setValue(100) 
 
         self.ContrastSlider.valueChanged.connect(self.OnContrastChanged)
+        self.ContrastSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnContrastChanged(self, value):
         self.Contrast = value
@@ -919,6 +901,7 @@ class Gui(QtWidgets.QMainWindow):
         self.SharpnessSlider.setValue(100) 
 
         self.SharpnessSlider.valueChanged.connect(self.OnSharpnessChanged)
+        self.SharpnessSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnSharpnessChanged(self, value):
         self.Sharpness = value
@@ -929,113 +912,137 @@ class Gui(QtWidgets.QMainWindow):
         self.GaussianBlurSlider.setRange(0, 2000)
         layout.addRow("Gaussian Blur", self.GaussianBlurSlider)
         self.GaussianBlurSlider.valueChanged.connect(self.OnGaussianBlurChanged)
+        self.GaussianBlurSlider.sliderReleased.connect(self.OnSliderReleased)
 
     def OnGaussianBlurChanged(self, value):
         self.GaussianBlurRadius = value
         self.processSliderChange("Gaussian Blur", "Slider", value, "GaussianBlurSlider")
 
-    def UpdateHistogramPlot(self):
-        # Compute image histogram
-        img = self.QPixmapToImage(self.image_viewer.pixmap())
-        r, g, b, a = img.split()
-        r_histogram = r.histogram()
-        g_histogram = g.histogram()
-        b_histogram = b.histogram()
-
-        # ITU-R 601-2 luma transform:
-        luma_histogram = [sum(x) for x in zip([item * float(299/1000) for item in r_histogram],
-                                              [item * float(587/1000) for item in g_histogram],
-                                              [item * float(114/1000) for item in b_histogram])]
+    def UpdateHistogramPlot(self, changedRect=None, base=None):
+        # Histogram of the displayed image, of the bounding box of the selection if there is one.
+        # changedRect and base let brush edits update the counts from the pixels they changed
+        selection = self.image_viewer.selectionMask()
+        region = selection.rect if selection is not None else None
+        self.histogram.update(self.image_viewer.image(), region, changedRect, base)
 
+    def OnHistogramChanged(self, counts):
         # Update histogram plot
-        self.ImageHistogramGraphRed.setData(y=r_histogram)
-        self.ImageHistogramGraphGreen.setData(y=g_histogram)
-        self.ImageHistogramGraphBlue.setData(y=b_histogram)
-        self.ImageHistogramGraphLuma.setData(y=luma_histogram)
+        x = list(range(len(counts[0])))
+        self.ImageHistogramGraphRed.setData(x=x, y=counts[0])
+        self.ImageHistogramGraphGreen.setData(x=x, y=counts[1])
+        self.ImageHistogramGraphBlue.setData(x=x, y=counts[2])
+        self.ImageHistogramGraphLuma.setData(x=x, y=counts[3])
 
     @QtCore.pyqtSlot()
     def onUpdateImageCompleted(self):
-        if self.sliderChangedPixmap:
-            self.image_viewer.setImage(self.sliderChangedPixmap, False, self.sliderExplanationOfChange, 
+        if self.sliderChangedImage is not None:
+            # The layer is drawn from the QImage, no pixmap of it is made
+            self.image_viewer.setImage(self.sliderChangedImage, False, self.sliderExplanationOfChange, 
                                        self.sliderTypeOfChange, self.sliderValueOfChange, self.sliderObjectOfChange)
-            self.UpdateHistogramPlot()
 
     def timerEvent(self, event):
         self.killTimer(self.timer_id)
         self.timer_id = -1
 
-        Pixmap = self.image_viewer.getCurrentLayerLatestPixmap()
-        OriginalPixmap = Pixmap.copy()
-
-        # TODO: If a selection is active
-        # Only apply changes to the selected region
-        if self.image_viewer._isSelectingRect:
-            print(self.image_viewer._selectRect)
-            Pixmap = Pixmap.copy(self.image_viewer._selectRect.toRect())
-        elif self.image_viewer._isSelectingPath:
-            Pixmap = self.image_viewer.getSelectedRegionAsPixmap()
-
-        if Pixmap:
-            if self.RedFactor != 100:
-                Pixmap = self.UpdateReds(Pixmap, float(self.RedFactor / 100))
-            if self.GreenFactor != 100:
-                Pixmap = self.UpdateGreens(Pixmap, float(self.GreenFactor / 100))
-            if self.BlueFactor != 100:
-                Pixmap = self.UpdateBlues(Pixmap, float(self.BlueFactor / 100))
-            if self.Temperature != 6000:
-                import AdjustTemperature
-                img = self.QPixmapToImage(Pixmap)
-                import numpy as np
-                import cv2
-                arr = np.asarray(img)
-                b, g, r, a = cv2.split(arr)
-                img = Image.fromarray(np.dstack((b, g, r)))
-
-                def FindClosest(lst, K):
-                    return lst[min(range(len(lst)), key = lambda i: abs(lst[i]-K))]
-
-                img = AdjustTemperature.convert_temp(img, FindClosest(list(AdjustTemperature.kelvin_table.keys()), self.Temperature))
-                img = np.asarray(img)
-                img = np.dstack((img, a))
-                img = Image.fromarray(img)
-                Pixmap = self.ImageToQPixmap(img)
-            if self.Color != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Color, self.Color)
-            if self.Brightness != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Brightness, self.Brightness)
-            if self.Contrast != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Contrast, self.Contrast)
-            if self.Sharpness != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Sharpness, self.Sharpness)
-            if self.GaussianBlurRadius > 0:
-                Pixmap = self.ApplyGaussianBlur(Pixmap, float(self.GaussianBlurRadius / 100))
-
-            if self.image_viewer._isSelectingRect:
-                painter = QtGui.QPainter(OriginalPixmap)
-                selectRect = self.image_viewer._selectRect
-                point = QtCore.QPoint(int(selectRect.x()), int(selectRect.y()))
-                painter.drawPixmap(point, Pixmap)
-                painter.end()
-                Pixmap = OriginalPixmap
-            elif self.image_viewer._isSelectingPath:
-                painter = QtGui.QPainter(OriginalPixmap)
-                painter.drawPixmap(QtCore.QPoint(), Pixmap)
-                painter.end()
-                Pixmap = OriginalPixmap
-
-            self.sliderChangedPixmap = Pixmap
-            self.sliderExplanationOfChange = self.sliderExplanationOfChange
-            self.sliderTypeOfChange = self.sliderTypeOfChange
-            self.sliderValueOfChange = self.sliderValueOfChange
-            self.sliderObjectOfChange = self.sliderObjectOfChange
-            self.sliderChangeSignal.emit()
+        # While a slider is dragged the preview is enough, it is rendered on release
+        for _, slider, _, _ in AdjustmentStack.steps:
+            if getattr(self, slider, None) and getattr(self, slider).isSliderDown():
+                return
+
+        self.renderSliderChange()
+
+    def renderSliderChange(self):
+        self.sliderChangePending = False
+        if self.image_viewer.getCurrentLayerLatestImageBeforeSliderChange() is None:
+            return
+
+        self.addSliderChangesToHistory()
+
+        # Render on the thread pool. A newer slider change makes this render stale,
+        # it is then cancelled and its result, if any, discarded.
+        self.sliderGeneration += 1
+        adjustments = self.image_viewer.getCurrentLayerAdjustments()
+        key = self.image_viewer.adjustedLayerKey()
+        self.sliderRender = (self.sliderGeneration, key)
+        worker = QWorker(self.renderSliderJob, self.image_viewer.adjustmentJob(), adjustments, key, self.sliderGeneration)
+        worker.signals.result.connect(self.onSliderRenderCompleted)
+        self.threadpool.start(worker)
+
+    def addSliderChangesToHistory(self):
+        # Only the parameters are stored in the history, the layer is rendered
+        # from its pixels before the first slider change
+        adjustments = self.image_viewer.getCurrentLayerAdjustments()
+        for name, slider, value in adjustments.setValues(self.sliderValues()):
+            self.image_viewer.addParameterToHistory(name, "Slider", value, slider)
+
+    def commitSliders(self):
+        """ Bake the adjustments into the layer, the next slider change starts from there.
+        The render of the latest parameters is baked, if it is not done yet the adjustments
+        are baked when it is.
+        """
+        if self.timer_id != -1:
+            self.killTimer(self.timer_id)
+            self.timer_id = -1
+        self.sliderChangePending = False
+        if self.image_viewer.getCurrentLayerLatestImageBeforeSliderChange() is None:
+            return
+
+        self.addSliderChangesToHistory()
+        if self.image_viewer.adjustedLayer(render=False) is None:
+            if self.sliderRender != (self.sliderGeneration, self.image_viewer.adjustedLayerKey()):
+                self.renderSliderChange()
+            self.sliderCommitPending = True
+            return
+
+        self.sliderGeneration += 1
+        self.bakeSliders()
+
+    def bakeSliders(self):
+        if self.image_viewer.bakeAdjustments():
+            self.image_viewer.showCurrentLayerLatestPixmap()
+        self.image_viewer.getCurrentLayerAdjustments().reset()
+
+    def renderSliderJob(self, job, adjustments, key, generation):
+        # Runs on a worker thread
+        return generation, adjustments, key, job(lambda: generation != self.sliderGeneration)
+
+    @QtCore.pyqtSlot(object)
+    def onSliderRenderCompleted(self, result):
+        generation, adjustments, key, image = result
+        if generation != self.sliderGeneration or image is None:
+            return
+
+        # Showing or baking the layer reuses the render
+        adjustments.setRendered(key, image)
+        commit = self.sliderCommitPending
+        self.sliderCommitPending = False
+        if self.image_viewer.adjustedLayer(render=False) is not image:
+            # Another layer or selection by now
+            return
+
+        if commit:
+            self.bakeSliders()
+            return
+        self.sliderChangedImage = image
+        self.sliderChangeSignal.emit()
+
+    def UpdateSliders(self, values):
+        """ Set the adjustment sliders to values, e.g., after undo, without starting a new slider change.
+        """
+        self.sliderGeneration += 1
+        self.sliderCommitPending = False
+        for name, slider, attribute, _ in AdjustmentStack.steps:
+            setattr(self, attribute, values[name])
+            if getattr(self, slider, None):
+                getattr(self, slider).blockSignals(True)
+                getattr(self, slider).setValue(values[name])
+                getattr(self, slider).blockSignals(False)
 
     def RemoveRenderedCursor(self):
         # The cursor overlay is being rendered in the view
         # Remove it
-        if any([self.image_viewer._isBlurring, self.image_viewer._isRemovingSpots]):
-            pixmap = self.getCurrentLayerLatestPixmap()
-            self.image_viewer.setImage(pixmap, False)
+        self.image_viewer.hideCursorOverlay()
+        self.image_viewer.exitSpotRemoval()
 
     def InitTool(self):
         self.RemoveRenderedCursor()
@@ -1097,6 +1104,7 @@ class Gui(QtWidgets.QMainWindow):
                 self.HistogramLayout = QtWidgets.QVBoxLayout(self.HistogramContent)
                 self.HistogramLayout.addWidget(self.ImageHistogramPlot)
                 self.HistogramContent.setWindowFlags(Qt.WindowType.WindowStaysOnTopHint)
+            self.histogram.setEnabled(True)
             self.ImageHistogramPlot.show()
             self.HistogramContent.show()
             # Create a local event loop for this widget
@@ -1105,6 +1113,7 @@ class Gui(QtWidgets.QMainWindow):
             loop.exec() # wait
         else:
             self.DisableTool("histogram")
+            self.histogram.setEnabled(False)
             self.HistogramContent.hide()
             #del self.HistogramContent
             #del self.HistogramLayout
@@ -1183,21 +1192,21 @@ class Gui(QtWidgets.QMainWindow):
     def OnRotateLeftToolButton(self, checked):
         if checked:
             self.InitTool()
-            pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
+            currentImage = self.getCurrentLayerLatestImage()
+            pil = QImageToImage(currentImage)
             pil = pil.rotate(90, expand=True)
-            updatedPixmap = self.ImageToQPixmap(pil)
-            self.image_viewer.setImage(updatedPixmap, True, "Rotate Left", "Tool", None, None)
+            updatedImage = ImageToQImage(pil)
+            self.image_viewer.setImage(updatedImage, True, "Rotate Left", "Tool", None, None)
         self.RotateLeftToolButton.setChecked(False)
 
     def OnRotateRightToolButton(self, checked):
         if checked:
             self.InitTool()
-            pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
+            currentImage = self.getCurrentLayerLatestImage()
+            pil = QImageToImage(currentImage)
             pil = pil.rotate(-90, expand=True)
-            updatedPixmap = self.ImageToQPixmap(pil)
-            self.image_viewer.setImage(updatedPixmap, True, "Rotate Right", "Tool", None, None)
+            updatedImage = ImageToQImage(pil)
+            self.image_viewer.setImage(updatedImage, True, "Rotate Right", "Tool", None, None)
         self.RotateRightToolButton.setChecked(False)
 
     def OnHStackToolButton(self, checked):
@@ -1205,10 +1214,10 @@ class Gui(QtWidgets.QMainWindow):
             self.InitTool()
             if self.image_viewer._current_filename:
 
-                pixmap = self.getCurrentLayerLatestPixmap()
-                first = self.QPixmapToImage(pixmap)
+                currentImage = self.getCurrentLayerLatestImage()
+                first = QImageToImage(currentImage)
 
-                if pixmap:
+                if currentImage is not None:
 
                     # Open second image
                     filepath, _ = QFileDialog.getOpenFileName(self, "Open Image")
@@ -1268,8 +1277,8 @@ class Gui(QtWidgets.QMainWindow):
                         dst.paste(second, (first.width, 0))
 
                         # Save result
-                        updatedPixmap = self.ImageToQPixmap(dst)
-                        self.image_viewer.setImage(updatedPixmap, True, "HStack", "Tool", None, None)
+                        updatedImage = ImageToQImage(dst)
+                        self.image_viewer.setImage(updatedImage, True, "HStack", "Tool", None, None)
 
         self.HStackToolButton.setChecked(False)
 
@@ -1278,10 +1287,10 @@ class Gui(QtWidgets.QMainWindow):
             self.InitTool()
             if self.image_viewer._current_filename:
 
-                pixmap = self.getCurrentLayerLatestPixmap()
-                first = self.QPixmapToImage(pixmap)
+                currentImage = self.getCurrentLayerLatestImage()
+                first = QImageToImage(currentImage)
 
-                if pixmap:
+                if currentImage is not None:
 
                     # Open second image
                     filepath, _ = QFileDialog.getOpenFileName(self, "Open Image")
@@ -1341,8 +1350,8 @@ class Gui(QtWidgets.QMainWindow):
                         dst.paste(second, (0, first.height))
 
                         # Save result
-                        updatedPixmap = self.ImageToQPixmap(dst)
-                        self.image_viewer.setImage(updatedPixmap, True, "VStack", "Tool", None, None)
+                        updatedImage = ImageToQImage(dst)
+                        self.image_viewer.setImage(updatedImage, True, "VStack", "Tool", None, None)
 
         self.VStackToolButton.setChecked(False)
 
@@ -1351,10 +1360,10 @@ class Gui(QtWidgets.QMainWindow):
             self.InitTool()
             if self.image_viewer._current_filename:
 
-                pixmap = self.getCurrentLayerLatestPixmap()
-                first = self.QPixmapToImage(pixmap)
+                currentImage = self.getCurrentLayerLatestImage()
+                first = QImageToImage(currentImage)
 
-                if pixmap:
+                if currentImage is not None:
 
                     # Open second image
                     filepath, _ = QFileDialog.getOpenFileName(self, "Open Image")
@@ -1383,28 +1392,28 @@ class Gui(QtWidgets.QMainWindow):
                             dst = Image.fromarray(dst).convert("RGBA")
 
                             # Save result
-                            updatedPixmap = self.ImageToQPixmap(dst)
-                            self.image_viewer.setImage(updatedPixmap, True, "Landscape Panorama", "Tool", None, None)
+                            updatedImage = ImageToQImage(dst)
+                            self.image_viewer.setImage(updatedImage, True, "Landscape Panorama", "Tool", None, None)
         self.LandscapePanoramaToolButton.setChecked(False)
 
     def OnFlipLeftRightToolButton(self, checked):
         if checked:
             self.InitTool()
-            pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
+            currentImage = self.getCurrentLayerLatestImage()
+            pil = QImageToImage(currentImage)
             pil = pil.transpose(Image.FLIP_LEFT_RIGHT)
-            updatedPixmap = self.ImageToQPixmap(pil)
-            self.image_viewer.setImage(updatedPixmap, True, "Flip Left-Right", "Tool", None, None)
+            updatedImage = ImageToQImage(pil)
+            self.image_viewer.setImage(updatedImage, True, "Flip Left-Right", "Tool", None, None)
         self.FlipLeftRightToolButton.setChecked(False)
 
     def OnFlipTopBottomToolButton(self, checked):
         if checked:
             self.InitTool()
-            pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
+            currentImage = self.getCurrentLayerLatestImage()
+            pil = QImageToImage(currentImage)
             pil = pil.transpose(Image.FLIP_TOP_BOTTOM)
-            updatedPixmap = self.ImageToQPixmap(pil)
-            self.image_viewer.setImage(updatedPixmap, True, "Flip Top-Bottom", "Tool", None, None)
+            updatedImage = ImageToQImage(pil)
+            self.image_viewer.setImage(updatedImage, True, "Flip Top-Bottom", "Tool", None, None)
         self.FlipTopBottomToolButton.setChecked(False)
 
     def OnRectSelectToolButton(self, checked):
@@ -1424,8 +1433,8 @@ class Gui(QtWidgets.QMainWindow):
         output = tool.output
         if output is not None:
             # Save new pixmap
-            updatedPixmap = self.ImageToQPixmap(output)
-            self.image_viewer.setImage(updatedPixmap, True, "Background Removal")
+            updatedImage = ImageToQImage(output)
+            self.image_viewer.setSelectedImage(updatedImage, self.toolSelection, "Background Removal")
 
         self.BackgroundRemovalToolButton.setChecked(False)
         del tool
@@ -1434,8 +1443,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnBackgroundRemovalToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolBackgroundRemoval import QToolBackgroundRemoval
             widget = QToolBackgroundRemoval(None, image, self.onBackgroundRemovalCompleted)
@@ -1446,21 +1455,21 @@ class Gui(QtWidgets.QMainWindow):
         backgroundRemoved = None
         if tool.backgroundRemoved:
             backgroundRemoved = tool.backgroundRemoved
-            backgroundRemoved = self.ImageToQPixmap(backgroundRemoved)
+            backgroundRemoved = ImageToQImage(backgroundRemoved)
 
         output = tool.output
         if output is not None and backgroundRemoved is not None:
 
             # Depth prediction output
             # Blurred based on predicted depth
-            updatedPixmap = self.ImageToQPixmap(output)
+            updatedImage = ImageToQImage(output)
 
             # Draw foreground on top of the blurred background
-            painter = QtGui.QPainter(updatedPixmap)
-            painter.drawPixmap(QtCore.QPoint(), backgroundRemoved)
+            painter = QtGui.QPainter(updatedImage)
+            painter.drawImage(QtCore.QPoint(), backgroundRemoved)
             painter.end()
 
-            self.image_viewer.setImage(updatedPixmap, True, "Portrait Mode Background Blur")
+            self.image_viewer.setSelectedImage(updatedImage, self.toolSelection, "Portrait Mode Background Blur")
 
         self.PortraitModeBackgroundBlurToolButton.setChecked(False)
         del tool
@@ -1469,8 +1478,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnPortraitModeBackgroundBlurToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolPortraitMode import QToolPortraitMode
 
@@ -1481,13 +1490,16 @@ class Gui(QtWidgets.QMainWindow):
     @QtCore.pyqtSlot()
     def onGrayscaleBackgroundCompleted(self, tool):
         foreground = None
-        foregroundPixmap = None
+        foregroundImage = None
 
         if tool.output:
             foreground = tool.output
-            foregroundPixmap = self.ImageToQPixmap(foreground)
+            foregroundImage = ImageToQImage(foreground)
 
-        background = self.QPixmapToImage(self.getCurrentLayerLatestPixmap())
+        currentImage = self.getCurrentLayerLatestImage()
+        if self.toolSelection is not None:
+            currentImage = self.toolSelection.crop(currentImage)
+        background = QImageToImage(currentImage)
         if foreground is not None and background is not None:
 
             # Depth prediction output
@@ -1495,14 +1507,14 @@ class Gui(QtWidgets.QMainWindow):
             # Grayscale the background
             from PIL import ImageOps
             background = ImageOps.grayscale(background)
-            backgroundPixmap = self.ImageToQPixmap(background)
+            backgroundImage = ImageToQImage(background.convert("RGBA"))
 
             # Draw foreground on top of the blurred background
-            painter = QtGui.QPainter(backgroundPixmap)
-            painter.drawPixmap(QtCore.QPoint(), foregroundPixmap)
+            painter = QtGui.QPainter(backgroundImage)
+            painter.drawImage(QtCore.QPoint(), foregroundImage)
             painter.end()
 
-            self.image_viewer.setImage(backgroundPixmap, True, "Grayscale Background")
+            self.image_viewer.setSelectedImage(backgroundImage, self.toolSelection, "Grayscale Background")
 
         self.GrayscaleBackgroundToolButton.setChecked(False)
         del tool
@@ -1511,8 +1523,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnGrayscaleBackgroundToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolGrayscaleBackground import QToolGrayscaleBackground
 
@@ -1525,8 +1537,8 @@ class Gui(QtWidgets.QMainWindow):
         output = tool.output
         if output is not None:
             # Save new pixmap
-            updatedPixmap = self.ImageToQPixmap(output)
-            self.image_viewer.setImage(updatedPixmap, True, "Human Segmentation")
+            updatedImage = ImageToQImage(output)
+            self.image_viewer.setSelectedImage(updatedImage, self.toolSelection, "Human Segmentation")
 
         self.HumanSegmentationToolButton.setChecked(False)
         del tool
@@ -1535,8 +1547,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnHumanSegmentationToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolHumanSegmentation import QToolHumanSegmentation
             widget = QToolHumanSegmentation(None, image, self.onHumanSegmentationCompleted)
@@ -1549,8 +1561,8 @@ class Gui(QtWidgets.QMainWindow):
             if output is not None:
 
                 # Show Interactive Colorization widget
-                currentPixmap = self.getCurrentLayerLatestPixmap()
-                image = self.QPixmapToImage(currentPixmap)
+                currentImage, selection = self.image_viewer.getCurrentLayerSelectedImage()
+                image = QImageToImage(currentImage)
                 import numpy as np
                 import cv2
                 import torch
@@ -1568,7 +1580,8 @@ class Gui(QtWidgets.QMainWindow):
                     alphaChannel=a,
                     color_model=output, 
                     im_bgr=np.dstack((b, g, r)),
-                    load_size=224, win_size=720, device=torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+                    load_size=224, win_size=720, device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+                    selection=selection)
                 colorizerWidget.setWindowModality(Qt.WindowModality.ApplicationModal)
 
                 colorizerWidget.setStyleSheet('''
@@ -1599,8 +1612,8 @@ class Gui(QtWidgets.QMainWindow):
         if output is not None:
             # Save new pixmap
             output = Image.fromarray(output)
-            updatedPixmap = self.ImageToQPixmap(output)
-            self.image_viewer.setImage(updatedPixmap, True, "Super Resolution")
+            updatedImage = ImageToQImage(output)
+            self.image_viewer.setImage(updatedImage, True, "Super Resolution")
 
         self.SuperResolutionToolButton.setChecked(False)
         del tool
@@ -1609,8 +1622,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnSuperResolutionToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage = self.getCurrentLayerLatestImage()
+            image = QImageToImage(currentImage)
 
             from QToolSuperResolution import QToolSuperResolution
             widget = QToolSuperResolution(None, image, self.onSuperResolutionCompleted)
@@ -1621,8 +1634,8 @@ class Gui(QtWidgets.QMainWindow):
         output = tool.output
         if output is not None:
             # Save new pixmap
-            updatedPixmap = self.ImageToQPixmap(output)
-            self.image_viewer.setImage(updatedPixmap, True, "Anime GAN v2")
+            updatedImage = ImageToQImage(output)
+            self.image_viewer.setSelectedImage(updatedImage, self.toolSelection, "Anime GAN v2")
 
         self.AnimeGanV2ToolButton.setChecked(False)
         del tool
@@ -1631,8 +1644,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnAnimeGanV2ToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolAnimeGANv2 import QToolAnimeGANv2
             widget = QToolAnimeGANv2(None, image, self.OnAnimeGanV2Completed)
@@ -1643,8 +1656,8 @@ class Gui(QtWidgets.QMainWindow):
         output = tool.output
         if output is not None:
             # Save new pixmap
-            updatedPixmap = self.ImageToQPixmap(output)
-            self.image_viewer.setImage(updatedPixmap, True, "White Balance")
+            updatedImage = ImageToQImage(output)
+            self.image_viewer.setSelectedImage(updatedImage, self.toolSelection, "White Balance")
 
         self.WhiteBalanceToolButton.setChecked(False)
         del tool
@@ -1653,8 +1666,8 @@ class Gui(QtWidgets.QMainWindow):
     def OnWhiteBalanceToolButton(self, checked):
         if checked:
             self.InitTool()
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
+            image = QImageToImage(currentImage)
 
             from QToolWhiteBalance import QToolWhiteBalance
             widget = QToolWhiteBalance(None, image, self.onWhiteBalanceCompleted)
@@ -1675,7 +1688,8 @@ class Gui(QtWidgets.QMainWindow):
                     event.accept()
                     self.closed = True
                     self.mainWindow.SlidersToolButton.setChecked(False)
-                    self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Sliders")
+
+                    self.mainWindow.commitSliders()
 
             self.slidersScroll = SlidersScrollWidget(None, self)
             self.slidersContent = QtWidgets.QWidget()
@@ -1697,24 +1711,15 @@ class Gui(QtWidgets.QMainWindow):
             self.AddContrastSlider(self.slidersLayout)
             self.AddSharpnessSlider(self.slidersLayout)
 
-            # State of enhance sliders
-            self.RedFactor = 100
-            self.GreenFactor = 100
-            self.BlueFactor = 100
-            self.Color = 100
-            self.Brightness = 100
-            self.Contrast = 100
-            self.Sharpness = 100
-
             # Filter sliders
             filter_label = QLabel("Filter")
             self.slidersLayout.addWidget(filter_label)
 
-            # State of filter sliders
-            self.GaussianBlurRadius = 0
-
             self.AddGaussianBlurSlider(self.slidersLayout)
 
+            # State of the sliders
+            self.UpdateSliders(self.image_viewer.getCurrentLayerAdjustments().values)
+
             self.slidersScroll.setStyleSheet('''
                 background-color: rgb(44, 44, 44);
             ''')
@@ -1765,14 +1770,17 @@ class Gui(QtWidgets.QMainWindow):
                     event.accept()
                     self.closed = True
                     self.mainWindow.InstagramFiltersToolButton.setChecked(False)
-                    self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Instagram Filters")
+                    selection = self.mainWindow.toolSelection
+                    self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Instagram Filters",
+                                                          changedRect=selection.rect if selection is not None else None)
 
+            # Enabling the tool ends the selection, take it first
+            currentImage, self.toolSelection = self.image_viewer.getCurrentLayerSelectedImage()
             self.EnableTool("instagram_filters") if checked else self.DisableTool("instagram_filters")
-            currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            image = QImageToImage(currentImage)
 
             from QToolInstagramFilters import QToolInstagramFilters
-            tool = QToolInstagramFilters(self, image)
+            tool = QToolInstagramFilters(self, image, self.toolSelection)
             self.filtersDock = QInstagramToolDockWidget(None, self)
             self.filtersDock.setWidget(tool)
             self.addDockWidget(QtCore.Qt.DockWidgetArea.BottomDockWidgetArea, self.filtersDock)
@@ -1823,11 +1831,10 @@ class Gui(QtWidgets.QMainWindow):
         if "destructor" in value:
             getattr(self.image_viewer, value["destructor"])()
 
-        if tool in ["blur", "spot_removal"]:
+        if tool in ["paint", "eraser", "blur", "spot_removal"]:
             # The cursor overlay is being rendered in the view
             # Remove it
-            pixmap = self.getCurrentLayerLatestPixmap()
-            self.image_viewer.setImage(pixmap, False)
+            self.RemoveRenderedCursor()
 
     def DisableAllTools(self):
         for _, value in self.tools.items():
@@ -1838,47 +1845,14 @@ class Gui(QtWidgets.QMainWindow):
 
     def updateHistogram(self):
         # Update Histogram
-
-        # Compute image histogram
-        img = self.QPixmapToImage(self.getCurrentLayerLatestPixmap())
-        r, g, b, a = img.split()
-        r_histogram = r.histogram()
-        g_histogram = g.histogram()
-        b_histogram = b.histogram()
-        
-        # ITU-R 601-2 luma transform:
-        luma_histogram = [sum(x) for x in zip([item * float(299/1000) for item in r_histogram],
-                                              [item * float(587/1000) for item in g_histogram],
-                                              [item * float(114/1000) for item in b_histogram])]
-
-        # Create histogram plot
-        x = list(range(len(r_histogram)))
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphRed)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphGreen)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphBlue)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphLuma)
-        self.ImageHistogramGraphRed = pg.PlotCurveItem(x = x, y = r_histogram, fillLevel=2, width = 1.0, brush=(255,0,0,80))
-        self.ImageHistogramGraphGreen = pg.PlotCurveItem(x = x, y = g_histogram, fillLevel=2, width = 1.0, brush=(0,255,0,80))
-        self.ImageHistogramGraphBlue = pg.PlotCurveItem(x = x, y = b_histogram, fillLevel=2, width = 1.0, brush=(0,0,255,80))
-        self.ImageHistogramGraphLuma = pg.PlotCurveItem(x = x, y = luma_histogram, fillLevel=2, width = 1.0, brush=(255,255,255,80))
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphRed)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphGreen)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphBlue)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphLuma)
+        self.histogram.update(self.getCurrentLayerLatestImage())
 
     def OnOpen(self):
         # Load an image file to be displayed (will popup a file dialog).
-        self.image_viewer.numLayersCreated = 1
-        self.image_viewer.currentLayer = 0
-        self.image_viewer.layerHistory = {
-            0: []
-        }
+        self.image_viewer.resetLayerHistory()
         self.image_viewer.open()
         if self.image_viewer._current_filename != None:
-            size = self.image_viewer.currentPixmapSize()
-            if size:
-                w, h = size.width(), size.height()
-                self.statusBar.showMessage(str(w) + "x" + str(h))
+            self.UpdateStatusBar()
             self.InitTool()
             self.DisableAllTools()
             filename = self.image_viewer._current_filename
@@ -1921,6 +1895,12 @@ class Gui(QtWidgets.QMainWindow):
         filename = self.image_viewer._current_filename
         filename = os.path.basename(filename)
 
+    def UpdateStatusBar(self):
+        size = self.image_viewer.currentPixmapSize()
+        if size:
+            w, h = size.width(), size.height()
+            self.statusBar.showMessage(str(w) + "x" + str(h) + "    " + self.image_viewer.historyPool.report())
+
     def OnUndo(self):
         self.image_viewer.undoCurrentLayerLatestChange()
 